@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+
+"""
+Live airspace state kept by a UTM server: the latest known state of each aircraft, indexed on a uniform grid
+"""
+__author__ = "Bruno Chianca Ferreira"
+__license__ = "MIT"
+__version__ = "0.1"
+__maintainer__ = "Bruno Chianca Ferreira"
+__email__ = "brunobcf@gmail.com"
+
+import math
+import heapq
+import threading
+
+
+class AircraftState():
+  """
+  Latest known state of one aircraft
+  """
+  __slots__ = ('aircraft_id', 'position', 'velocity', 'status', 'created', 'revision', 'cell')
+
+  def __init__(self, aircraft_id, position, velocity, status, created, revision, cell):
+    self.aircraft_id = aircraft_id
+    self.position = position
+    self.velocity = velocity
+    self.status = status
+    self.created = created
+    self.revision = revision
+    self.cell = cell
+
+  def as_dict(self):
+    return {"aircraft" : self.aircraft_id,
+            "position" : self.position,
+            "velocity" : self.velocity,
+            "status" : self.status,
+            "created" : self.created,
+            "revision" : self.revision,
+    }
+
+
+class AirspaceState():
+  """
+  Table of aircraft keyed by id, with a uniform grid over the horizontal position for spatial queries
+
+  .. note::
+
+      Cells are cell_size x cell_size on x/y, altitude is only checked on the candidates of the visited cells.
+      Updates created before the stored one, or with an etcd revision not above the stored one, are ignored,
+      so the table can be fed from the UAS endpoint and from the etcd watch in any order. All methods are thread safe.
+
+  """
+  def __init__(self, cell_size=100.0):
+    """AirspaceState
+
+    Args:
+
+    Kwargs:
+        cell_size (float) - Side of the grid cells, in position units. Close to the usual query radius works best
+
+    """
+    self.cell_size = float(cell_size)
+    self.lock = threading.Lock()
+    self.aircrafts = {}
+    self.grid = {}
+    self.extent = None # [min x, min y, max x, max y] of the cells ever used
+    self.updates = 0
+    self.stale = 0
+
+  def _cell(self, position):
+    return (int(math.floor(position[0] / self.cell_size)), int(math.floor(position[1] / self.cell_size)))
+
+  def update(self, aircraft_id, position, velocity, status, created, revision=None):
+    """
+    Stores the state of an aircraft, moving it across grid cells when needed
+
+    Parameters
+    ----------
+    aircraft_id (str) - Aircraft id
+    position (list) - [x, y, z]
+    velocity (float) - Velocity
+    status (str) - Status
+    created (int) - Time the data was created on the aircraft
+    revision (int) - etcd mod_revision, when the update came from etcd
+
+    Returns
+    --------
+    updated (bool) - False when the update was older than the stored state
+
+    """
+    position = (float(position[0]), float(position[1]), float(position[2]) if len(position) > 2 else 0.0)
+    cell = self._cell(position)
+    with self.lock:
+      state = self.aircrafts.get(aircraft_id)
+      if state is None:
+        self.aircrafts[aircraft_id] = AircraftState(aircraft_id, position, velocity, status, created, revision, cell)
+        self._link(aircraft_id, cell)
+        self.updates += 1
+        return True
+      if created < state.created or (revision is not None and state.revision is not None and revision <= state.revision):
+        self.stale += 1
+        return False
+      if cell != state.cell:
+        self._unlink(aircraft_id, state.cell)
+        self._link(aircraft_id, cell)
+        state.cell = cell
+      state.position = position
+      state.velocity = velocity
+      state.status = status
+      state.created = created
+      if revision is not None:
+        state.revision = revision
+      self.updates += 1
+      return True
+
+  def _link(self, aircraft_id, cell):
+    members = self.grid.get(cell)
+    if members is None:
+      members = self.grid[cell] = set()
+      if self.extent is None:
+        self.extent = [cell[0], cell[1], cell[0], cell[1]]
+      else:
+        self.extent = [min(self.extent[0], cell[0]), min(self.extent[1], cell[1]), max(self.extent[2], cell[0]), max(self.extent[3], cell[1])]
+    members.add(aircraft_id)
+
+  def _unlink(self, aircraft_id, cell):
+    members = self.grid[cell]
+    members.discard(aircraft_id)
+    if len(members) == 0:
+      del self.grid[cell]
+
+  def remove(self, aircraft_id):
+    """ Drops an aircraft from the table, returns its last state or None """
+    with self.lock:
+      state = self.aircrafts.pop(aircraft_id, None)
+      if state is not None:
+        self._unlink(aircraft_id, state.cell)
+      return state
+
+  def get(self, aircraft_id):
+    """ Last state of an aircraft as a dict, or None """
+    with self.lock:
+      state = self.aircrafts.get(aircraft_id)
+      return None if state is None else state.as_dict()
+
+  def __len__(self):
+    return len(self.aircrafts)
+
+  def __contains__(self, aircraft_id):
+    return aircraft_id in self.aircrafts
+
+  def snapshot(self):
+    """ Every aircraft as a dict keyed by id """
+    with self.lock:
+      return {aircraft_id: state.as_dict() for aircraft_id, state in self.aircrafts.items()}
+
+  def within_box(self, lower, upper):
+    """
+    Aircraft inside an axis aligned box
+
+    Parameters
+    ----------
+    lower (list) - [x, y, z] lower corner, z may be omitted to ignore altitude
+    upper (list) - [x, y, z] upper corner
+
+    Returns
+    --------
+    aircrafts (list) - Aircraft ids
+
+    """
+    low_x, low_y = self._cell(lower)
+    high_x, high_y = self._cell(upper)
+    check_z = len(lower) > 2 and len(upper) > 2
+    found = []
+    with self.lock:
+      if self.extent is None:
+        return found
+      low_x, low_y = max(low_x, self.extent[0]), max(low_y, self.extent[1])
+      high_x, high_y = min(high_x, self.extent[2]), min(high_y, self.extent[3])
+      for cell_x in range(low_x, high_x + 1):
+        for cell_y in range(low_y, high_y + 1):
+          for aircraft_id in self.grid.get((cell_x, cell_y), ()):
+            x, y, z = self.aircrafts[aircraft_id].position
+            if lower[0] <= x <= upper[0] and lower[1] <= y <= upper[1] and (not check_z or lower[2] <= z <= upper[2]):
+              found.append(aircraft_id)
+    return found
+
+  def within_radius(self, center, radius):
+    """
+    Aircraft within a distance of a point
+
+    Parameters
+    ----------
+    center (list) - [x, y, z]
+    radius (float) - Distance, 3D when center has an altitude
+
+    Returns
+    --------
+    aircrafts (list) - (distance, aircraft id) sorted by distance
+
+    """
+    low_x, low_y = self._cell((center[0] - radius, center[1] - radius))
+    high_x, high_y = self._cell((center[0] + radius, center[1] + radius))
+    found = []
+    with self.lock:
+      if self.extent is None:
+        return found
+      low_x, low_y = max(low_x, self.extent[0]), max(low_y, self.extent[1])
+      high_x, high_y = min(high_x, self.extent[2]), min(high_y, self.extent[3])
+      for cell_x in range(low_x, high_x + 1):
+        for cell_y in range(low_y, high_y + 1):
+          for aircraft_id in self.grid.get((cell_x, cell_y), ()):
+            distance = self._distance(center, self.aircrafts[aircraft_id].position)
+            if distance <= radius:
+              found.append((distance, aircraft_id))
+    found.sort()
+    return found
+
+  def nearest(self, center, k=1, max_distance=None):
+    """
+    k nearest aircraft to a point, searching rings of cells outwards from the point's cell
+
+    Parameters
+    ----------
+    center (list) - [x, y, z]
+    k (int) - Number of aircraft
+    max_distance (float) - Ignore aircraft further than this
+
+    Returns
+    --------
+    aircrafts (list) - (distance, aircraft id) sorted by distance, at most k
+
+    """
+    center_x, center_y = self._cell(center)
+    best = [] # max heap on distance, as (-distance, aircraft id)
+    with self.lock:
+      if len(self.aircrafts) == 0:
+        return []
+      low_x, low_y, high_x, high_y = self.extent
+      max_ring = max(center_x - low_x, high_x - center_x, center_y - low_y, high_y - center_y)
+      if max_distance is not None:
+        max_ring = min(max_ring, int(math.ceil(max_distance / self.cell_size)) + 1)
+      for ring in range(max_ring + 1):
+        # Nothing beyond this ring can be closer than the horizontal gap to it
+        if len(best) == k and -best[0][0] <= (ring - 1) * self.cell_size:
+          break
+        for cell in self._ring(center_x, center_y, ring):
+          for aircraft_id in self.grid.get(cell, ()):
+            distance = self._distance(center, self.aircrafts[aircraft_id].position)
+            if max_distance is not None and distance > max_distance:
+              continue
+            if len(best) < k:
+              heapq.heappush(best, (-distance, aircraft_id))
+            elif distance < -best[0][0]:
+              heapq.heapreplace(best, (-distance, aircraft_id))
+    return sorted((-distance, aircraft_id) for distance, aircraft_id in best)
+
+  def _ring(self, center_x, center_y, ring):
+    if ring == 0:
+      yield (center_x, center_y)
+      return
+    for cell_x in range(center_x - ring, center_x + ring + 1):
+      yield (cell_x, center_y - ring)
+      yield (cell_x, center_y + ring)
+    for cell_y in range(center_y - ring + 1, center_y + ring):
+      yield (center_x - ring, cell_y)
+      yield (center_x + ring, cell_y)
+
+  def _distance(self, center, position):
+    if len(center) > 2:
+      return math.sqrt((center[0] - position[0]) ** 2 + (center[1] - position[1]) ** 2 + (center[2] - position[2]) ** 2)
+    return math.sqrt((center[0] - position[0]) ** 2 + (center[1] - position[1]) ** 2)
+
+  def metrics(self):
+    """ Table counters """
+    with self.lock:
+      return {"aircrafts": len(self.aircrafts), "cells": len(self.grid), "updates": self.updates, "stale": self.stale}
@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+
+"""
+asyncio counterpart of network_sockets, to be used together with UAS/UTM applications
+
+All interfaces of a process share one event loop running in a background thread.
+Classes keep the names, constructor arguments and callback contract of network_sockets
+(callback(payload, sender_ip, connection)) so they can be swapped in directly.
+"""
+__author__ = "Bruno Chianca Ferreira"
+__license__ = "MIT"
+__version__ = "0.1"
+__maintainer__ = "Bruno Chianca Ferreira"
+__email__ = "brunobcf@gmail.com"
+
+import socket, struct, traceback, threading, time, pickle, asyncio
+import message_codec
+import telemetry
+
+_loop = None
+_loop_lock = threading.Lock()
+
+def get_loop():
+    """
+    Returns the shared event loop, starting its thread on first use
+
+    Parameters
+    ----------
+
+    Returns
+    --------
+    loop (asyncio.AbstractEventLoop) - Running event loop
+
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            loop_td = threading.Thread(target=_loop.run_forever, name="async_sockets", daemon=True)
+            loop_td.start()
+    return _loop
+
+async def read_frame(reader):
+    """ Reads one '!I' length prefixed frame from a stream """
+    lengthbuf = await reader.readexactly(4)
+    length, = struct.unpack('!I', lengthbuf)
+    return await reader.readexactly(length)
+
+def frame(bytes_to_send):
+    """ Prefixes a payload with its '!I' length """
+    return struct.pack('!I', len(bytes_to_send)) + bytes_to_send
+
+class TcpPersistent():
+    def __init__(self, callback, debug=False, port=55123, interface='', codec=None, lazy_decode=False):
+        self.callback = callback
+        self.codec = codec
+        self.lazy_decode = lazy_decode
+        self.debug = debug
+        self.port = port
+        self.interface = interface
+        self.running = True
+        self.max_packet = 65535 #max packet size to listen
+        self.loop = get_loop()
+        self.server = None
+        # Same instruments as network_sockets.TcpPersistent, there is no pool to reject connections here
+        self.frames_received = telemetry.counter("tcp_received", "Frames received by TcpPersistent")
+        self.decode_time = telemetry.histogram("tcp_decode_seconds", "Decode time of a received frame")
+        self.callback_time = telemetry.histogram("tcp_callback_seconds", "Callback duration of a received frame")
+        try:
+            self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.listener.bind((self.interface, self.port))
+            self.listener.listen(10000)
+        except OSError:
+            traceback.print_exc()
+            print("Error: unable to open socket on ports '%d' " % (self.port))
+            exit(0)
+
+    def start(self):
+        """ Starts serving on the shared loop """
+        self.server = asyncio.run_coroutine_threadsafe(asyncio.start_server(self.connection_handler, sock=self.listener), self.loop).result()
+
+    def stop(self):
+        self.running = False
+        if self.server is not None:
+            self.loop.call_soon_threadsafe(self.server.close)
+        else:
+            self.listener.close()
+
+    def shutdown(self):
+        self.stop()
+
+    def respond(self, bytes_to_send, msg_id, connection):
+        """ Answers a request, connection is the StreamWriter handed to the callback. Safe from any thread """
+        try:
+            bytes_to_send = frame(message_codec.encode_message(self.codec, msg_id, bytes_to_send))
+            self.loop.call_soon_threadsafe(self._respond, bytes_to_send, connection)
+        except:
+            traceback.print_exc()
+
+    def _respond(self, bytes_to_send, connection):
+        connection.write(bytes_to_send)
+        connection.close()
+
+    def send(self, destination, bytes_to_send, msg_id, timeout=4):
+        """ Send a message over a TCP link and wait for the response. Must not be called from the loop thread """
+        try:
+            bytes_to_send = frame(message_codec.encode_message(self.codec, msg_id, bytes_to_send))
+            request = asyncio.run_coroutine_threadsafe(asyncio.wait_for(self._send(destination, bytes_to_send), timeout), self.loop)
+            response = request.result()
+            if response is None:
+                return None
+            return message_codec.decode_message(self.codec, response, self.lazy_decode)
+        except ConnectionRefusedError:
+            if self.codec is not None:
+                return ['TIMEOUT']
+            bytes_to_send = pickle.dumps(['TIMEOUT'])
+            return(bytes_to_send)
+        except:
+            if self.debug: traceback.print_exc()
+            if self.debug: print("Could not send data to: " + str(destination))
+
+    async def _send(self, destination, bytes_to_send):
+        reader, writer = await asyncio.open_connection(destination, self.port)
+        try:
+            writer.write(bytes_to_send)
+            await writer.drain()
+            try:
+                return await read_frame(reader)
+            except asyncio.IncompleteReadError:
+                return None
+        finally:
+            writer.close()
+
+    async def connection_handler(self, reader, writer):
+        sender_ip = str(writer.get_extra_info('peername')[0])
+        try:
+            payload = await read_frame(reader)
+            self.frames_received.inc()
+            start = self.decode_time.start()
+            if self.codec is None:
+                pickle.loads(payload)
+            payload = message_codec.decode_message(self.codec, payload, self.lazy_decode)
+            start = self.decode_time.stop(start)
+        except:
+            if self.debug: traceback.print_exc()
+            writer.close()
+            return
+        try:
+            self.callback(payload, sender_ip, writer)
+        except:
+            traceback.print_exc()
+        self.callback_time.stop(start)
+
+class TcpInterface():
+    def __init__(self, callback, debug=False, port=55123, interface='', codec=None, lazy_decode=False):
+        self.callback = callback
+        self.codec = codec
+        self.lazy_decode = lazy_decode
+        self.debug = debug
+        self.port = port
+        self.interface = interface
+        self.running = True
+        self.max_packet = 65535 #max packet size to listen
+        self.loop = get_loop()
+        self.server = None
+        try:
+            self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.listener.bind((self.interface, self.port))
+            self.listener.listen(10000)
+        except OSError:
+            print("Error: unable to open socket on ports '%d' " % (self.port))
+            exit(0)
+
+    def start(self):
+        """ Starts serving on the shared loop """
+        self.server = asyncio.run_coroutine_threadsafe(asyncio.start_server(self.connection_handler, sock=self.listener), self.loop).result()
+
+    def stop(self):
+        self.running = False
+        if self.server is not None:
+            self.loop.call_soon_threadsafe(self.server.close)
+        else:
+            self.listener.close()
+
+    def send(self, destination, bytes_to_send, msg_id):
+        """ Send a message over a TCP link, without waiting for it to be delivered """
+        try:
+            bytes_to_send = frame(message_codec.encode_message(self.codec, msg_id, bytes_to_send))
+            asyncio.run_coroutine_threadsafe(self._send(destination, bytes_to_send), self.loop)
+        except:
+            if self.debug: print("Could not send data to: " + str(destination))
+
+    async def _send(self, destination, bytes_to_send):
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(destination, self.port), 5)
+            writer.write(bytes_to_send)
+            await writer.drain()
+            writer.close()
+        except:
+            if self.debug: print("Could not send data to: " + str(destination))
+
+    async def connection_handler(self, reader, writer):
+        sender_ip = str(writer.get_extra_info('peername')[0])
+        try:
+            payload = await read_frame(reader)
+            payload = message_codec.decode_message(self.codec, payload, self.lazy_decode)
+        except:
+            writer.close()
+            return
+        try:
+            self.callback(payload, sender_ip, writer)
+        except:
+            traceback.print_exc()
+        writer.close()
+
+class UdpProtocol(asyncio.DatagramProtocol):
+    """ Forwards datagrams to the UdpInterface callback """
+
+    def __init__(self, interface):
+        self.interface = interface
+
+    def datagram_received(self, payload, address):
+        received_at = time.time()
+        interface = self.interface
+        interface.packets_received.inc()
+        if interface.debug: print(payload)
+        try:
+            start = interface.decode_time.start()
+            try:
+                payload = message_codec.decode_message(interface.codec, payload, interface.lazy_decode)
+            except ValueError:
+                interface.reject(payload)
+                return
+            start = interface.decode_time.stop(start)
+            if interface.stamped:
+                interface.callback(payload, str(address[0]), None, received_at)
+            else:
+                interface.callback(payload, str(address[0]), None)
+            interface.callback_time.stop(start)
+        except:
+            traceback.print_exc()
+            print("Error receiving UDP data.")
+
+    def error_received(self, exc):
+        if self.interface.debug: print("UDP error: " + str(exc))
+
+class UdpInterface():
+    """
+    UDP Interface on the shared event loop, used both to send and receive data over UDP
+
+    .. note::
+
+       Datagrams are sent through the bound socket. send and send_many can be called from any thread.
+
+    """
+    def __init__(self, callback, debug=False, port=55123, interface='', rcvbuf=None, codec=None, lazy_decode=False, stamped=False):
+        """UdpInterface socket class
+
+        Args:
+           callback (function): This function will be called when data is received
+           debug (bool): When set to true, more information is printed in stdout
+           port (int): Integer with port number to be used both to send and received data
+
+        Kwargs:
+           interface (str): Interface to where socket will be bind, it not set bind to every interface
+           rcvbuf (int): SO_RCVBUF size in bytes, kernel default when not set
+           codec (object): message_codec codec used to encode sent messages and decode received ones once, callbacks then get the decoded message.
+                           When not set messages are pickled and callbacks get the raw payload.
+           lazy_decode (bool): Hand callbacks a message_codec.LazyMessage decoded on first access
+           stamped (bool): Call back with the receive time of the datagram (time.time()) as a fourth argument, for traces
+
+        """
+        self.callback = callback
+        self.codec = codec
+        self.lazy_decode = lazy_decode
+        self.debug = debug
+        self.port = port
+        self.interface = interface
+        self.running = True
+        self.max_packet = 65535 #max packet size to listen
+        self.loop = get_loop()
+        self.transport = None
+        self.stamped = stamped
+        self.rejected = 0
+        # Same instruments as network_sockets.UdpInterface, there is no queue to drop datagrams here
+        self.packets_received = telemetry.counter("udp_received", "Datagrams received by UdpInterface")
+        self.packets_sent = telemetry.counter("udp_sent", "Datagrams sent by UdpInterface")
+        self.packets_rejected = telemetry.counter("udp_rejected", "Datagrams the codec could not decode, dropped")
+        self.decode_time = telemetry.histogram("udp_decode_seconds", "Decode time of a received datagram")
+        self.callback_time = telemetry.histogram("udp_callback_seconds", "Callback duration of a received datagram")
+        try:
+            self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            if rcvbuf is not None:
+                self.server.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+            self.server.bind((self.interface, self.port))
+        except OSError:
+            print("Error: unable to open socket on ports '%d' " % (self.port))
+            exit(0)
+
+    def start(self):
+        """
+        Starts receiving on the shared loop
+
+        Parameters
+        ----------
+
+        Returns
+        --------
+
+        """
+        endpoint = self.loop.create_datagram_endpoint(lambda: UdpProtocol(self), sock=self.server)
+        self.transport, _ = asyncio.run_coroutine_threadsafe(endpoint, self.loop).result()
+
+    def stop(self):
+        """
+        Stops execution to free the socket
+
+        Parameters
+        ----------
+
+        Returns
+        --------
+
+        """
+        self.running = False
+        if self.transport is not None:
+            self.loop.call_soon_threadsafe(self.transport.close)
+        else:
+            self.server.close()
+
+    def reject(self, payload):
+        """
+        Drops a datagram the codec rejected (unknown header, or pickle without legacy decoding) and counts it
+
+        Parameters
+        ----------
+        payload (bytes) - Received datagram
+
+        Returns
+        --------
+
+        """
+        self.rejected += 1
+        self.packets_rejected.inc()
+        if self.debug: print("Rejected UDP datagram: " + payload[:2].hex())
+
+    def shutdown(self):
+        """
+        Shuts down current instance
+
+        Parameters
+        ----------
+
+        Returns
+        --------
+
+        """
+        self.stop()
+
+    def send(self, destination, msg_to_send, msg_id):
+        """
+        Send a message over a UDP link.
+        The message is encoded with the configured codec (pickled by default) and sent over a UDP socket
+
+        Parameters
+        ----------
+        destination (str) - IP address of final destination
+        msg_to_send (str) - Unencoded message to be sent
+        msg_id (binary) - Unique id for the message CRC32
+
+        Returns
+        --------
+
+        """
+        try:
+            bytes_to_send = message_codec.encode_message(self.codec, msg_id, msg_to_send)
+        except:
+            if self.debug: print("Could not send data to: " + str(destination))
+            return
+        self.send_bytes(destination, bytes_to_send)
+
+    def send_bytes(self, destination, bytes_to_send):
+        """
+        Send an already encoded message over a UDP link.
+
+        Parameters
+        ----------
+        destination (str) - IP address of final destination
+        bytes_to_send (bytes) - Encoded message to be sent
+
+        Returns
+        --------
+
+        """
+        self.send_many(destination, [bytes_to_send])
+
+    def send_many(self, destination, messages):
+        """
+        Send a burst of already encoded messages over a UDP link, in one loop iteration
+
+        Parameters
+        ----------
+        destination (str) - IP address of final destination
+        messages (list) - Encoded messages (bytes) to be sent
+
+        Returns
+        --------
+        sent (int) - Number of datagrams queued on the transport
+
+        """
+        if self.transport is None:
+            if self.debug: print("Could not send data to: " + str(destination))
+            return 0
+        self.loop.call_soon_threadsafe(self._send_many, (destination, self.port), messages)
+        return len(messages)
+
+    def _send_many(self, address, messages):
+        for bytes_to_send in messages:
+            try:
+                self.transport.sendto(bytes_to_send, address)
+                self.packets_sent.inc()
+            except:
+                if self.debug: print("Could not send data to: " + str(address[0]))
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of the UTM server airspace state: update rate and spatial queries against a linear scan
+"""
+__author__ = "Bruno Chianca Ferreira"
+__license__ = "MIT"
+__version__ = "0.1"
+__maintainer__ = "Bruno Chianca Ferreira"
+__email__ = "brunobcf@gmail.com"
+
+import os, sys, time, math, random, argparse
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from airspace import AirspaceState
+
+def scan_radius(positions, center, radius):
+    """ Linear scan, what a query costs without the index """
+    return sorted((math.dist(center, position), aircraft_id) for aircraft_id, position in positions.items() if math.dist(center, position) <= radius)
+
+def scan_nearest(positions, center, k):
+    return sorted((math.dist(center, position), aircraft_id) for aircraft_id, position in positions.items())[:k]
+
+def box_query(airspace, center, half):
+    return airspace.within_box([center[0] - half, center[1] - half, 0], [center[0] + half, center[1] + half, 120])
+
+def timed(function, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+def main():
+    parser = argparse.ArgumentParser(description='Options as below')
+    parser.add_argument("-n", "--aircrafts", help="Number of aircraft", type=int, nargs='+', default=[1000, 10000, 50000])
+    parser.add_argument("-a", "--area", help="Side of the square airspace", type=float, default=20000.0)
+    parser.add_argument("-c", "--cell-size", help="Grid cell size", type=float, default=100.0)
+    parser.add_argument("-r", "--radius", help="Query radius", type=float, default=500.0)
+    parser.add_argument("-q", "--queries", help="Queries per measure", type=int, default=200)
+    arguments = parser.parse_args()
+
+    random.seed(1)
+    print("aircrafts\tupdates/s\tradius us\tscan us\t\tnearest us\tscan us\t\tbox us")
+    for aircrafts in arguments.aircrafts:
+        airspace = AirspaceState(arguments.cell_size)
+        positions = {}
+        moves = []
+        for i in range(aircrafts):
+            position = [random.uniform(0, arguments.area), random.uniform(0, arguments.area), random.uniform(0, 150)]
+            positions['uas' + str(i)] = position
+            moves.append(('uas' + str(i), [position[0] + random.uniform(-20, 20), position[1] + random.uniform(-20, 20), position[2]]))
+        for aircraft_id, position in positions.items():
+            airspace.update(aircraft_id, position, 10.0, 'OK', 0)
+        start = time.perf_counter()
+        for created, (aircraft_id, position) in enumerate(moves, 1):
+            airspace.update(aircraft_id, position, 10.0, 'OK', created)
+        update_rate = len(moves) / (time.perf_counter() - start)
+        positions = {aircraft_id: position for aircraft_id, position in moves}
+
+        centers = [[random.uniform(0, arguments.area), random.uniform(0, arguments.area), 75.0] for i in range(arguments.queries)]
+        queries = iter(centers * 2)
+        radius = timed(lambda: airspace.within_radius(next(queries), arguments.radius), arguments.queries)
+        scans = max(1, min(arguments.queries, 2000000 // aircrafts))
+        queries = iter(centers * 2)
+        radius_scan = timed(lambda: scan_radius(positions, next(queries), arguments.radius), scans)
+        queries = iter(centers * 2)
+        nearest = timed(lambda: airspace.nearest(next(queries), 5), arguments.queries)
+        queries = iter(centers * 2)
+        nearest_scan = timed(lambda: scan_nearest(positions, next(queries), 5), scans)
+        queries = iter(centers * 2)
+        box = timed(lambda: box_query(airspace, next(queries), arguments.radius), arguments.queries)
+
+        for center in centers[:10]:
+            assert [entry[1] for entry in airspace.nearest(center, 5)] == [entry[1] for entry in scan_nearest(positions, center, 5)]
+        print(str(aircrafts) + "\t\t" + format(update_rate, ".0f") + "\t\t" + format(radius * 1e6, ".1f") + "\t\t" + format(radius_scan * 1e6, ".1f")
+              + "\t\t" + format(nearest * 1e6, ".1f") + "\t\t" + format(nearest_scan * 1e6, ".1f") + "\t\t" + format(box * 1e6, ".1f"))
+
+if __name__ == '__main__':
+    main()
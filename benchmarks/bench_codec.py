@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of the message codecs pluggable in network_sockets, on a UAS broadcast message
+Also measures the receive path cost per message with and without the codec layer.
+"""
+__author__ = "Bruno Chianca Ferreira"
+__license__ = "MIT"
+__version__ = "0.2"
+__maintainer__ = "Bruno Chianca Ferreira"
+__email__ = "brunobcf@gmail.com"
+
+import os, sys, time, pickle, zlib, timeit, argparse
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import message_codec
+
+def sample():
+    created = int(time.time()*1000000)
+    msg_id = zlib.crc32(str(created).encode())
+    return [hex(msg_id), [created, "uas12", [1234.5678, -987.654, 120.0], 12.5, "OK"]]
+
+def measure(statement, number):
+    best = min(timeit.repeat(statement, number=number, repeat=5))
+    return best / number * 1e9
+
+def codecs():
+    available = [("pickle", message_codec.PickleCodec()), ("struct", message_codec.UasStructCodec())]
+    try:
+        available.append(("msgpack", message_codec.MsgpackCodec()))
+    except RuntimeError:
+        print("msgpack not installed, skipping MsgpackCodec")
+    return available
+
+def main():
+    parser = argparse.ArgumentParser(description='Options as below')
+    parser.add_argument("-n", "--number", help="Operations per measurement", type=int, default=100000)
+    arguments = parser.parse_args()
+
+    message = sample()
+    print("codec\tbytes/msg\tencode ns/op\tdecode ns/op")
+    for name, codec in codecs():
+        payload = codec.encode(message)
+        encode = measure(lambda: codec.encode(message), arguments.number)
+        decode = measure(lambda: codec.decode(payload), arguments.number)
+        print(name + "\t" + str(len(payload)) + "\t\t" + format(encode, ".0f") + "\t\t" + format(decode, ".0f"))
+
+    # Receive path: validate then decode again in the handler (before the codec layer), decode once, lazy and never read
+    payload = pickle.dumps(message)
+    codec = message_codec.PickleCodec()
+    rows = [
+        ("validate + handler decode", lambda: (pickle.loads(payload), pickle.loads(payload))),
+        ("codec decode once", lambda: message_codec.decode_message(codec, payload)),
+        ("lazy, read by handler", lambda: message_codec.decode_message(codec, payload, True)[1]),
+        ("lazy, ignored by handler", lambda: message_codec.decode_message(codec, payload, True)),
+    ]
+    print()
+    print("receive path (pickle)\t\tns/msg")
+    for name, statement in rows:
+        print(name.ljust(32) + format(measure(statement, arguments.number), ".0f"))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of conflicts.ConflictDetector from 100 to 50k aircraft: full tick, incremental tick and an all pairs check
+"""
+__author__ = "Bruno Chianca Ferreira"
+__license__ = "MIT"
+__version__ = "0.1"
+__maintainer__ = "Bruno Chianca Ferreira"
+__email__ = "brunobcf@gmail.com"
+
+import os, sys, time, logging, argparse
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import numpy as np
+import conflicts
+
+def all_pairs(position, velocity, detector):
+    """ The O(n^2) check the grid avoids """
+    first, second = np.triu_indices(len(position), 1)
+    time_to_cpa, horizontal, vertical, horizontal_cpa, vertical_cpa = conflicts.closest_approach(position, velocity, first, second)
+    loss = (horizontal < detector.horizontal_separation) & (vertical < detector.vertical_separation)
+    conflict = loss | ((horizontal_cpa < detector.horizontal_separation) & (time_to_cpa <= detector.lookahead) & (vertical_cpa < detector.vertical_separation))
+    return int(conflict.sum())
+
+def main():
+    parser = argparse.ArgumentParser(description='Options as below')
+    parser.add_argument("-n", "--aircrafts", help="Number of aircraft", type=int, nargs='+', default=[100, 1000, 5000, 10000, 50000])
+    parser.add_argument("-s", "--spacing", help="Mean distance between aircraft, the airspace grows with the fleet", type=float, default=500.0)
+    parser.add_argument("-v", "--speed", help="Max horizontal speed per axis", type=float, default=15.0)
+    parser.add_argument("-u", "--updated", help="Fraction of the fleet updated between incremental ticks", type=float, default=0.1)
+    parser.add_argument("-b", "--brute-max", help="Largest fleet also checked with all pairs", type=int, default=2000)
+    arguments = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    rng = np.random.default_rng(1)
+    print("aircrafts\tfull tick ms\tincr tick ms\tpairs/tick\tconflicts\tall pairs ms")
+    for aircrafts in arguments.aircrafts:
+        side = np.sqrt(aircrafts) * arguments.spacing
+        position = np.c_[rng.uniform(0, side, (aircrafts, 2)), rng.uniform(0, 120, aircrafts)]
+        velocity = np.c_[rng.uniform(-arguments.speed, arguments.speed, (aircrafts, 2)), rng.uniform(-1, 1, aircrafts)]
+        detector = conflicts.ConflictDetector(capacity=aircrafts)
+        now = 1000.0
+        ids = ['uas' + str(i) for i in range(aircrafts)]
+        for i in range(aircrafts):
+            detector.update(ids[i], position[i], int(now * 1000000), velocity[i])
+        start = time.perf_counter()
+        alerts = detector.tick(now)
+        full = time.perf_counter() - start
+        checked = detector.pairs_checked
+
+        updated = max(1, int(aircrafts * arguments.updated))
+        incremental = []
+        for tick in range(5):
+            now += 1.0
+            for i in rng.choice(aircrafts, updated, replace=False):
+                detector.update(ids[i], position[i] + velocity[i] * (now - 1000.0), int(now * 1000000), velocity[i])
+            start = time.perf_counter()
+            detector.tick(now)
+            incremental.append(time.perf_counter() - start)
+        pairs = (detector.pairs_checked - checked) // len(incremental)
+
+        brute = "-"
+        if aircrafts <= arguments.brute_max:
+            start = time.perf_counter()
+            assert all_pairs(position, velocity, detector) == len(alerts)
+            brute = format((time.perf_counter() - start) * 1e3, ".1f")
+        print(str(aircrafts) + "\t\t" + format(full * 1e3, ".1f") + "\t\t" + format(np.median(incremental) * 1e3, ".1f") + "\t\t"
+              + str(pairs) + "\t\t" + str(len(alerts)) + "\t\t" + brute)
+
+if __name__ == '__main__':
+    main()
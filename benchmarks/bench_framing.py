@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+"""
+Microbenchmark of the framed TCP readers: concatenating recv() chunks against network_sockets.recv_frame
+"""
+__author__ = "Bruno Chianca Ferreira"
+__license__ = "MIT"
+__version__ = "0.1"
+__maintainer__ = "Bruno Chianca Ferreira"
+__email__ = "brunobcf@gmail.com"
+
+import os, sys, time, socket, struct, threading, argparse
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import network_sockets
+
+SIZES = [100, 1024, 16 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024]
+
+def concat_frame(connection):
+    """ The reader used before recv_frame """
+    lengthbuf = connection.recv(4)
+    length, = struct.unpack('!I', lengthbuf)
+    payload = b''
+    while length:
+        newbuf = connection.recv(length)
+        if not newbuf: return None
+        payload += newbuf
+        length -= len(newbuf)
+    return payload
+
+def measure(reader, size, frames):
+    receiver, sender = socket.socketpair()
+    frame = struct.pack('!I', size) + b'x' * size
+    def produce():
+        for i in range(frames):
+            sender.sendall(frame)
+    producer = threading.Thread(target=produce)
+    producer.start()
+    start = time.perf_counter()
+    for i in range(frames):
+        reader(receiver)
+    elapsed = time.perf_counter() - start
+    producer.join()
+    receiver.close()
+    sender.close()
+    return elapsed / frames
+
+def main():
+    parser = argparse.ArgumentParser(description='Options as below')
+    parser.add_argument("-b", "--bytes", help="Bytes transferred per size and reader", type=int, default=256 * 1024 * 1024)
+    arguments = parser.parse_args()
+
+    print("size\t\tconcat us\trecv_frame us\tspeedup")
+    for size in SIZES:
+        frames = max(10, min(20000, arguments.bytes // size))
+        concat = measure(concat_frame, size, frames)
+        framed = measure(lambda connection: network_sockets.recv_frame(connection, max(size, network_sockets.MAX_FRAME)), size, frames)
+        print(str(size) + "\t\t" + format(concat * 1e6, ".1f") + "\t\t" + format(framed * 1e6, ".1f") + "\t\t" + format(concat / framed, ".2f"))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of GPSBridge.get_position against a local_gps.LocalGPS stand-in: connection per poll, persistent connection, subscription
+and the shared-memory position feed
+"""
+__author__ = "Bruno Chianca Ferreira"
+__license__ = "MIT"
+__version__ = "0.1"
+__maintainer__ = "Bruno Chianca Ferreira"
+__email__ = "brunobcf@gmail.com"
+
+import os, sys, time, tempfile, argparse
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from gps_bridge import GPSBridge
+from local_gps import LocalGPS
+
+def main():
+    parser = argparse.ArgumentParser(description='Options as below')
+    parser.add_argument("-d", "--duration", help="Seconds per mode", type=float, default=2.0)
+    parser.add_argument("-s", "--stream-interval", help="Seconds between positions streamed to subscribers", type=float, default=0.01)
+    arguments = parser.parse_args()
+
+    feed = os.path.join(tempfile.mkdtemp(dir='/dev/shm' if os.path.isdir('/dev/shm') else None), 'bench.feed')
+    gps = LocalGPS('bench', stream_interval=arguments.stream_interval, feed=feed)
+    print("mode\t\treads/s\t\tus/read\t\tfix age ms")
+    for mode in ['connect', 'poll', 'subscribe', 'shm']:
+        bridge = GPSBridge('bench', mode=mode, feed=feed)
+        while bridge.get_fix()[1] is None:
+            time.sleep(0.01)
+        reads, ages = 0, 0.0
+        start = time.perf_counter()
+        while time.perf_counter() - start < arguments.duration:
+            position, age = bridge.get_fix()
+            reads += 1
+            ages += age
+        elapsed = time.perf_counter() - start
+        bridge.stop()
+        print(mode + "\t" + ("\t" if len(mode) < 8 else "") + format(reads / elapsed, ".0f") + "\t\t" + format(elapsed / reads * 1e6, ".2f") + "\t\t" + format(ages / reads * 1e3, ".2f"))
+    gps.stop()
+
+if __name__ == '__main__':
+    main()
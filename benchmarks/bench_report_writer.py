@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+"""
+Broadcast timing jitter of a UAS client loop with the report written on the broadcast thread or by report_writer.ReportWriter
+"""
+__author__ = "Bruno Chianca Ferreira"
+__license__ = "MIT"
+__version__ = "0.1"
+__maintainer__ = "Bruno Chianca Ferreira"
+__email__ = "brunobcf@gmail.com"
+
+import os, sys, time, socket, tempfile, argparse
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import numpy as np
+import message_codec
+from report_writer import ReportWriter
+
+def broadcast_loop(writer, mode, rate, duration):
+    """ Broadcasts at rate Hz like adsb_broadcaster, returns the time spent per tick and the interval between broadcasts in seconds """
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    interval = 1.0 / rate
+    ticks = int(duration * rate)
+    busy, sent = [], []
+    deadline = time.monotonic()
+    for tick in range(ticks):
+        deadline += interval
+        start = time.monotonic()
+        created = int(time.time() * 1000000)
+        position = [tick * 0.5, 100.0, 30.0]
+        payload = [created, 'uas1', position, 10.0, 'OK']
+        sender.sendto(message_codec.encode(tick, payload), ('127.0.0.1', 44445))
+        sent.append(time.monotonic())
+        record = [int(time.time() * 1000000), created, hex(tick), 'uas1', position, 10.0, 'OK']
+        if mode == 'sync':
+            writer.write_now(record)
+        else:
+            writer.write(record)
+        busy.append(time.monotonic() - start)
+        time.sleep(max(0.0, deadline - time.monotonic()))
+    sender.close()
+    return np.array(busy), np.diff(np.array(sent))
+
+def main():
+    parser = argparse.ArgumentParser(description='Options as below')
+    parser.add_argument("-r", "--rate", help="Broadcasts per second", type=float, default=100.0)
+    parser.add_argument("-d", "--duration", help="Seconds per mode", type=float, default=10.0)
+    parser.add_argument("-f", "--fsync", help="fsync the report (sync mode fsyncs every record)", action="store_true")
+    arguments = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    print("mode\ttick mean us\ttick p99 us\ttick max us\tinterval std us\tinterval p99 us")
+    for mode in ['sync', 'async']:
+        writer = ReportWriter(os.path.join(folder, mode + '.csv'), fsync=arguments.fsync)
+        if mode == 'async':
+            writer.start()
+        busy, intervals = broadcast_loop(writer, mode, arguments.rate, arguments.duration)
+        writer.stop()
+        error = np.abs(intervals - 1.0 / arguments.rate)
+        print(mode + "\t" + format(busy.mean() * 1e6, ".1f") + "\t\t" + format(np.percentile(busy, 99) * 1e6, ".1f") + "\t\t" + format(busy.max() * 1e6, ".1f")
+              + "\t\t" + format(intervals.std() * 1e6, ".1f") + "\t\t" + format(np.percentile(error, 99) * 1e6, ".1f"))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+"""
+Achieved rate and jitter of scheduler.PeriodicScheduler at broadcast rates, against APScheduler when it is installed
+"""
+__author__ = "Bruno Chianca Ferreira"
+__license__ = "MIT"
+__version__ = "0.1"
+__maintainer__ = "Bruno Chianca Ferreira"
+__email__ = "brunobcf@gmail.com"
+
+import os, sys, time, logging, argparse
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import numpy as np
+from scheduler import PeriodicScheduler
+try:
+    from apscheduler.schedulers.background import BackgroundScheduler
+except ImportError:
+    BackgroundScheduler = None
+
+def summary(name, rate, ticks):
+    ticks = np.array(ticks)
+    intervals = np.diff(ticks)
+    error = np.abs(intervals - 1.0 / rate)
+    achieved = (len(ticks) - 1) / (ticks[-1] - ticks[0])
+    print(name + "\t" + format(rate, ".0f") + "\t" + format(achieved, ".3f") + "\t\t" + format(intervals.std() * 1e6, ".1f") + "\t\t"
+          + format(np.percentile(error, 99) * 1e6, ".1f") + "\t\t" + format(error.max() * 1e6, ".1f"))
+
+def run_periodic(rate, duration, spin, work):
+    ticks = []
+    def tick():
+        ticks.append(time.monotonic())
+        time.sleep(work)
+    scheduler = PeriodicScheduler(tick, 1.0 / rate, spin=spin)
+    scheduler.start()
+    time.sleep(duration)
+    scheduler.stop()
+    return ticks, scheduler.metrics()
+
+def run_apscheduler(rate, duration, work):
+    ticks = []
+    def tick():
+        ticks.append(time.monotonic())
+        time.sleep(work)
+    scheduler = BackgroundScheduler()
+    logging.getLogger('apscheduler').setLevel(logging.ERROR)
+    scheduler.add_job(tick, 'interval', seconds=1.0 / rate, max_instances=1)
+    scheduler.start()
+    time.sleep(duration)
+    scheduler.shutdown()
+    return ticks
+
+def main():
+    parser = argparse.ArgumentParser(description='Options as below')
+    parser.add_argument("-r", "--rates", help="Broadcast rates in Hz", type=float, nargs='+', default=[1, 10, 50])
+    parser.add_argument("-d", "--duration", help="Seconds per rate, at least 10 ticks", type=float, default=10.0)
+    parser.add_argument("-s", "--spin", help="Seconds busy waited before each deadline", type=float, default=0.0005)
+    parser.add_argument("-w", "--work", help="Seconds spent in each call", type=float, default=0.0002)
+    arguments = parser.parse_args()
+
+    print("sched\tHz\tachieved Hz\tinterval std us\tp99 error us\tmax error us")
+    for rate in arguments.rates:
+        duration = max(arguments.duration, 10.0 / rate)
+        for spin in sorted(set([0.0, arguments.spin])):
+            ticks, metrics = run_periodic(rate, duration, spin, arguments.work)
+            summary("spin" + format(spin * 1e3, ".1f") if spin else "sleep", rate, ticks)
+        if BackgroundScheduler is not None:
+            summary("aps", rate, run_apscheduler(rate, duration, arguments.work))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+"""
+Memory and CPU per aircraft of uas_swarm.py, n aircraft in one process, against the per-process model, n processes of one aircraft
+Both run uas_swarm.py with synthetic positions so the emulator is not needed, a one aircraft swarm costs the same
+interpreter, imports, socket and scheduler thread as a uas_client.py process
+"""
+__author__ = "Bruno Chianca Ferreira"
+__license__ = "MIT"
+__version__ = "0.1"
+__maintainer__ = "Bruno Chianca Ferreira"
+__email__ = "brunobcf@gmail.com"
+
+import os, sys, time, argparse, subprocess, tempfile
+
+SWARM = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'uas_swarm.py'))
+TICKS = os.sysconf('SC_CLK_TCK')
+
+def rss(pid):
+    with open('/proc/' + str(pid) + '/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+def cpu(pid):
+    with open('/proc/' + str(pid) + '/stat') as stat:
+        fields = stat.read().rsplit(')', 1)[1].split()
+    # utime and stime, fields 14 and 15 of proc(5)
+    return (int(fields[11]) + int(fields[12])) / TICKS
+
+def launch(tag, count, arguments):
+    # stderr goes to a file, not a pipe nobody reads, so a failing child can be reported
+    log = tempfile.TemporaryFile()
+    process = subprocess.Popen([sys.executable, SWARM, '-t', tag, '-n', str(count), '-i', str(arguments.interval), '-G', str(arguments.groups),
+                                '-d', arguments.destination, '-T', str(int(arguments.warmup + arguments.duration + 5)), '-W', '0',
+                                '-R', arguments.report_dir],
+                               stdout=subprocess.DEVNULL, stderr=log)
+    process.log = log
+    return process
+
+def check(processes):
+    """ Fails when a child already exited, its RSS would read 0 and its CPU would stop counting """
+    for process in processes:
+        if process.poll() is not None:
+            process.log.seek(0)
+            error = process.log.read().decode(errors='replace').strip().splitlines()[-5:]
+            raise RuntimeError("uas_swarm.py exited with code " + str(process.returncode) + " before being measured:\n" + "\n".join(error))
+
+def measure(processes, arguments):
+    try:
+        time.sleep(arguments.warmup)
+        check(processes)
+        before = sum(cpu(process.pid) for process in processes)
+        start = time.monotonic()
+        time.sleep(arguments.duration)
+        check(processes)
+        used = sum(cpu(process.pid) for process in processes) - before
+        elapsed = time.monotonic() - start
+        memory = sum(rss(process.pid) for process in processes)
+        check(processes)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+            process.log.close()
+    return memory, used / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description='Options as below')
+    parser.add_argument("-n", "--counts", help="Numbers of aircraft", type=int, nargs='+', default=[10, 50, 200])
+    parser.add_argument("-s", "--swarm-only", help="Numbers of aircraft only run as a swarm, too many processes otherwise", type=int, nargs='*', default=[1000, 10000])
+    parser.add_argument("-i", "--interval", help="Seconds between broadcasts of an aircraft", type=float, default=1.0)
+    parser.add_argument("-G", "--groups", help="Broadcast slots per interval of the swarms", type=int, default=100)
+    parser.add_argument("-d", "--destination", help="Broadcast address", type=str, default='127.0.0.1')
+    parser.add_argument("-w", "--warmup", help="Seconds before measuring", type=float, default=3.0)
+    parser.add_argument("-D", "--duration", help="Seconds measured", type=float, default=5.0)
+    parser.add_argument("-R", "--report-dir", help="Directory of the swarm reports, a temporary directory when not set", type=str, default=None)
+    arguments = parser.parse_args()
+    if arguments.report_dir is None:
+        reports = tempfile.TemporaryDirectory()
+        arguments.report_dir = reports.name
+
+    print("model\t\taircraft\tRSS MB\t\tKB/aircraft\tCPU %\t\tCPU %/aircraft")
+    for count in sorted(set(arguments.counts + arguments.swarm_only)):
+        models = [('swarm', lambda: [launch('bench', count, arguments)])]
+        if count in arguments.counts:
+            models.append(('process', lambda: [launch('bench' + str(i) + '_', 1, arguments) for i in range(count)]))
+        for name, start in models:
+            memory, load = measure(start(), arguments)
+            print(name + "\t\t" + str(count) + "\t\t" + format(memory / 1e6, ".1f") + "\t\t" + format(memory / count / 1e3, ".1f") + "\t\t"
+                  + format(load * 100, ".1f") + "\t\t" + format(load * 100 / count, ".3f"))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of TcpPersistent.send: connect per message against pooled multiplexed connections
+"""
+__author__ = "Bruno Chianca Ferreira"
+__license__ = "MIT"
+__version__ = "0.1"
+__maintainer__ = "Bruno Chianca Ferreira"
+__email__ = "brunobcf@gmail.com"
+
+import os, sys, time, argparse, statistics
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import network_sockets
+
+def start_server(port, persistent):
+    server = None
+    def echo(payload, sender_ip, connection):
+        server.respond(b'ok', 1, connection)
+    server = network_sockets.TcpPersistent(echo, port=port, persistent=persistent)
+    server.daemon = True
+    server.start()
+    return server
+
+def sequential(server, requests):
+    latencies = []
+    for i in range(requests):
+        start = time.perf_counter()
+        server.send('127.0.0.1', b'x' * 64, i)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+def pipelined(server, requests, window):
+    start = time.perf_counter()
+    for i in range(0, requests, window):
+        futures = [server.send_async('127.0.0.1', b'x' * 64, i + j) for j in range(window)]
+        for future in futures:
+            future.result(4)
+    return time.perf_counter() - start
+
+def report(name, latencies):
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print(name + "\t" + format(len(latencies) / sum(latencies), ".0f") + "\t" + format(statistics.median(latencies) * 1e6, ".0f") + "\t" + format(p99 * 1e6, ".0f"))
+
+def main():
+    parser = argparse.ArgumentParser(description='Options as below')
+    parser.add_argument("-n", "--requests", help="Requests per mode", type=int, default=5000)
+    parser.add_argument("-w", "--window", help="Requests in flight in pipelined mode", type=int, default=32)
+    parser.add_argument("-p", "--port", help="First port to use", type=int, default=56100)
+    arguments = parser.parse_args()
+
+    legacy = start_server(arguments.port, False)
+    persistent = start_server(arguments.port + 1, True)
+    time.sleep(0.2)
+    print("mode\t\treq/s\tp50 us\tp99 us")
+    report("connect/msg", sequential(legacy, arguments.requests))
+    report("persistent", sequential(persistent, arguments.requests))
+    elapsed = pipelined(persistent, arguments.requests, arguments.window)
+    print("pipelined x" + str(arguments.window) + "\t" + format(arguments.requests / elapsed, ".0f"))
+
+if __name__ == '__main__':
+    main()
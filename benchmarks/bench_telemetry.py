@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+"""
+Cost of the telemetry instruments on a hot path, disabled (no-op instruments) and enabled
+"""
+__author__ = "Bruno Chianca Ferreira"
+__license__ = "MIT"
+__version__ = "0.1"
+__maintainer__ = "Bruno Chianca Ferreira"
+__email__ = "brunobcf@gmail.com"
+
+import os, sys, time, argparse
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import telemetry
+
+def per_call(function, calls):
+    start = time.perf_counter()
+    function(calls)
+    return (time.perf_counter() - start) / calls * 1e9
+
+def instruments(registry, calls):
+    counter = registry.counter("bench_counter")
+    histogram = registry.histogram("bench_seconds")
+    def baseline(calls):
+        for i in range(calls):
+            pass
+    def inc(calls):
+        for i in range(calls):
+            counter.inc()
+    def observe(calls):
+        for i in range(calls):
+            histogram.observe(0.00042)
+    def timed(calls):
+        for i in range(calls):
+            histogram.stop(histogram.start())
+    loop = per_call(baseline, calls)
+    return [per_call(function, calls) - loop for function in (inc, observe, timed)]
+
+def main():
+    parser = argparse.ArgumentParser(description='Options as below')
+    parser.add_argument("-c", "--calls", help="Calls per instrument", type=int, default=1000000)
+    arguments = parser.parse_args()
+
+    print("registry\tinc ns\t\tobserve ns\tstart/stop ns")
+    for name, registry in [("disabled", telemetry.Registry()), ("enabled", telemetry.REGISTRY)]:
+        registry.enabled = name == "enabled"
+        print(name + "\t" + "\t\t".join(format(cost, ".0f") for cost in instruments(registry, arguments.calls)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+"""
+Load test of the TcpPersistent server backends: threads (network_sockets) against asyncio (async_sockets)
+Clients open one connection per request, as TcpPersistent.send does, and wait for the response.
+"""
+__author__ = "Bruno Chianca Ferreira"
+__license__ = "MIT"
+__version__ = "0.1"
+__maintainer__ = "Bruno Chianca Ferreira"
+__email__ = "brunobcf@gmail.com"
+
+import os, sys, time, socket, struct, pickle, argparse, statistics
+from concurrent.futures import ThreadPoolExecutor
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import network_sockets
+import async_sockets
+
+def request(port, payload):
+    start = time.perf_counter()
+    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client.settimeout(10)
+    client.connect(('127.0.0.1', port))
+    client.sendall(struct.pack('!I', len(payload)) + payload)
+    length, = struct.unpack('!I', client.recv(4, socket.MSG_WAITALL))
+    client.recv(length, socket.MSG_WAITALL)
+    client.close()
+    return time.perf_counter() - start
+
+def load(backend, port, clients, requests):
+    server = None
+    def echo(payload, sender_ip, connection):
+        server.respond(b'ok', 1, connection)
+    server = backend.TcpPersistent(echo, port=port)
+    if backend is network_sockets:
+        server.daemon = True
+    server.start()
+    time.sleep(0.2)
+    payload = pickle.dumps([hex(1), b'x' * 64])
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        latencies = list(executor.map(lambda i: request(port, payload), range(requests)))
+    elapsed = time.perf_counter() - start
+    server.running = False
+    server.server.close()
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    return requests / elapsed, statistics.median(latencies) * 1000, p99 * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description='Options as below')
+    parser.add_argument("-c", "--clients", help="Concurrent clients", type=int, default=64)
+    parser.add_argument("-n", "--requests", help="Requests per backend", type=int, default=5000)
+    parser.add_argument("-p", "--port", help="First port to use", type=int, default=56000)
+    arguments = parser.parse_args()
+
+    print("backend\tconn/s\tp50 ms\tp99 ms")
+    for offset, (name, backend) in enumerate((("threads", network_sockets), ("asyncio", async_sockets))):
+        rate, p50, p99 = load(backend, arguments.port + offset, arguments.clients, arguments.requests)
+        print(name + "\t" + format(rate, ".0f") + "\t" + format(p50, ".2f") + "\t" + format(p99, ".2f"))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+
+"""
+Conflict detection over the aircraft positions received by a UTM server
+Closest point of approach and loss of separation are computed with NumPy, on candidate pairs pruned with a uniform grid.
+"""
+__author__ = "Bruno Chianca Ferreira"
+__license__ = "MIT"
+__version__ = "0.1"
+__maintainer__ = "Bruno Chianca Ferreira"
+__email__ = "brunobcf@gmail.com"
+
+import time
+import logging
+import threading
+import numpy as np
+
+# Offsets of the 3x3 block of grid cells around a cell
+NEIGHBOURS = [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+# Position broadcast by uas_client and uas_swarm while the GPS has no fix
+NO_FIX_POSITION = [100, 100, 100]
+
+
+def closest_approach(position, velocity, first, second):
+  """
+  Closest point of approach of aircraft pairs flying straight at constant velocity
+
+  Parameters
+  ----------
+  position (np.ndarray) - (n, 3) positions at a common time
+  velocity (np.ndarray) - (n, 3) velocities, position units per second
+  first (np.ndarray) - indexes of the first aircraft of each pair
+  second (np.ndarray) - indexes of the second aircraft of each pair
+
+  Returns
+  --------
+  time_to_cpa (np.ndarray) - seconds until the horizontal closest approach, 0 when already diverging
+  horizontal (np.ndarray) - current horizontal distance
+  vertical (np.ndarray) - current vertical distance
+  horizontal_cpa (np.ndarray) - horizontal distance at the closest approach
+  vertical_cpa (np.ndarray) - vertical distance at the closest approach
+
+  """
+  relative = position[second] - position[first]
+  closing = velocity[second] - velocity[first]
+  speed = np.einsum('ij,ij->i', closing[:, :2], closing[:, :2])
+  with np.errstate(divide='ignore', invalid='ignore'):
+    time_to_cpa = -np.einsum('ij,ij->i', relative[:, :2], closing[:, :2]) / speed
+  time_to_cpa = np.where(speed > 0, np.maximum(time_to_cpa, 0.0), 0.0)
+  at_cpa = relative + closing * time_to_cpa[:, None]
+  horizontal = np.hypot(relative[:, 0], relative[:, 1])
+  horizontal_cpa = np.hypot(at_cpa[:, 0], at_cpa[:, 1])
+  return time_to_cpa, horizontal, np.abs(relative[:, 2]), horizontal_cpa, np.abs(at_cpa[:, 2])
+
+
+def grid_pairs(position, reach, selected):
+  """
+  Pairs of aircraft in the same or adjacent reach x reach cells, with at least one aircraft in selected
+
+  Parameters
+  ----------
+  position (np.ndarray) - (n, 3) positions
+  reach (float) - Grid cell side, the largest horizontal distance a pair may need to be found at
+  selected (np.ndarray) - Indexes of the aircraft to find pairs for
+
+  Returns
+  --------
+  first, second (np.ndarray) - Pair indexes, first < second, each pair once
+
+  """
+  cells = np.floor(position[:, :2] / reach).astype(np.int64)
+  keys = (cells[:, 0] << 32) + cells[:, 1]
+  order = np.argsort(keys, kind='stable')
+  sorted_keys = keys[order]
+  firsts, seconds = [], []
+  for dx, dy in NEIGHBOURS:
+    wanted = ((cells[selected, 0] + dx) << 32) + cells[selected, 1] + dy
+    low = np.searchsorted(sorted_keys, wanted, 'left')
+    high = np.searchsorted(sorted_keys, wanted, 'right')
+    counts = high - low
+    total = int(counts.sum())
+    if total == 0:
+      continue
+    offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    firsts.append(np.repeat(selected, counts))
+    seconds.append(order[np.repeat(low, counts) + offsets])
+  if len(firsts) == 0:
+    return np.empty(0, np.int64), np.empty(0, np.int64)
+  first, second = np.concatenate(firsts), np.concatenate(seconds)
+  # Cells are disjoint, so a pair only shows up twice when both aircraft are selected: keep it once
+  is_selected = np.zeros(len(position), dtype=bool)
+  is_selected[selected] = True
+  keep = (first < second) | ~is_selected[second]
+  first, second = first[keep], second[keep]
+  return np.minimum(first, second), np.maximum(first, second)
+
+
+class ConflictDetector(threading.Thread):
+  """
+  Keeps position and velocity of every aircraft in arrays and checks separation every interval seconds
+
+  .. note::
+
+      Velocity vectors are estimated from consecutive fixes of each aircraft, unless given to update(), and their
+      horizontal speed is clamped to max_speed. A jump to or from NO_FIX_POSITION is not a move: the velocity is reset
+      to 0 instead, so one aircraft losing its fix does not blow up the grid cells of the whole fleet. Each tick extrapolates every aircraft to the current time and only pairs aircraft updated since the
+      previous tick, plus the pairs already in conflict or converging beyond the lookahead, so the cost follows
+      the update rate rather than the fleet size squared. Candidates are aircraft within
+      horizontal_separation + 2 * max speed * lookahead of each other, found on a grid of that cell size.
+
+  """
+  def __init__(self, horizontal_separation=50.0, vertical_separation=15.0, lookahead=30.0, interval=1.0, timeout=30.0, max_speed=50.0, capacity=1024):
+    """ConflictDetector
+
+    Args:
+
+    Kwargs:
+        horizontal_separation (float) - Minimum horizontal distance between aircraft, in position units
+        vertical_separation (float) - Minimum vertical distance between aircraft, in position units
+        lookahead (float) - How far ahead in seconds conflicts are predicted
+        interval (float) - Seconds between ticks when running as a thread
+        timeout (float) - Aircraft without updates for this many seconds are dropped, several broadcast intervals
+                          (UASClient broadcasts every 10 seconds by default)
+        max_speed (float) - Largest plausible horizontal speed, in position units per second
+        capacity (int) - Initial size of the arrays, they grow as needed
+
+    """
+    threading.Thread.__init__(self, daemon=True)
+    self.horizontal_separation = horizontal_separation
+    self.vertical_separation = vertical_separation
+    self.lookahead = lookahead
+    self.interval = interval
+    self.timeout = timeout
+    self.max_speed = max_speed
+    self.running = True
+    self.lock = threading.Lock()
+    self.ids = []
+    self.index = {}
+    self.position = np.zeros((capacity, 3))
+    self.velocity = np.zeros((capacity, 3))
+    self.created = np.zeros(capacity)
+    self.dirty = np.zeros(capacity, dtype=bool)
+    self.alerts = {}
+    self.tracked = set()
+    self.ticks = 0
+    self.pairs_checked = 0
+    self.new_alerts = 0
+    self.tick_time = 0.0
+    self.max_tick_time = 0.0
+
+  def _grow(self):
+    capacity = len(self.created) * 2
+    for name in ('position', 'velocity', 'created', 'dirty'):
+      old = getattr(self, name)
+      new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+      new[:len(old)] = old
+      setattr(self, name, new)
+
+  def update(self, aircraft_id, position, created, velocity=None):
+    """
+    Records a position report
+
+    Parameters
+    ----------
+    aircraft_id (str) - Aircraft id
+    position (list) - [x, y, z]
+    created (int) - Time the report was created, in microseconds
+    velocity (list) - [vx, vy, vz] per second, estimated from the previous report when not given
+
+    Returns
+    --------
+    updated (bool) - False when the report is not newer than the last one of the aircraft
+
+    """
+    created = int(created) / 1000000
+    position = np.array(position[:3], dtype=float)
+    with self.lock:
+      i = self.index.get(aircraft_id)
+      if i is None:
+        i = len(self.ids)
+        if i == len(self.created):
+          self._grow()
+        self.ids.append(aircraft_id)
+        self.index[aircraft_id] = i
+        self.velocity[i] = 0.0 if velocity is None else self._clamp(np.array(velocity[:3], dtype=float))
+      else:
+        if created <= self.created[i]:
+          return False
+        if velocity is not None:
+          self.velocity[i] = self._clamp(np.array(velocity[:3], dtype=float))
+        elif self._no_fix(position) or self._no_fix(self.position[i]):
+          self.velocity[i] = 0.0
+        else:
+          self.velocity[i] = self._clamp((position - self.position[i]) / (created - self.created[i]))
+      self.position[i] = position
+      self.created[i] = created
+      self.dirty[i] = True
+      return True
+
+  def _no_fix(self, position):
+    return position.tolist() == NO_FIX_POSITION
+
+  def _clamp(self, velocity):
+    """ Scales velocity down so its horizontal speed is at most max_speed """
+    speed = np.hypot(velocity[0], velocity[1])
+    if speed > self.max_speed:
+      velocity = velocity * (self.max_speed / speed)
+    return velocity
+
+  def remove(self, aircraft_id):
+    """ Drops an aircraft, moving the last one into its slot """
+    with self.lock:
+      self._remove(aircraft_id)
+
+  def _remove(self, aircraft_id):
+    i = self.index.pop(aircraft_id, None)
+    if i is None:
+      return
+    last = len(self.ids) - 1
+    if i != last:
+      moved = self.ids[last]
+      self.ids[i] = moved
+      self.index[moved] = i
+      for array in (self.position, self.velocity, self.created, self.dirty):
+        array[i] = array[last]
+    self.ids.pop()
+    self.dirty[last] = False
+
+  def tick(self, now=None):
+    """
+    Checks separation of the aircraft updated since the last tick
+
+    Parameters
+    ----------
+    now (float) - Current time in seconds, time.time() when not given
+
+    Returns
+    --------
+    alerts (dict) - (aircraft id, aircraft id) -> alert, every pair currently in conflict
+
+    """
+    start = time.perf_counter()
+    now = time.time() if now is None else now
+    with self.lock:
+      count = len(self.ids)
+      for expired in np.flatnonzero(self.created[:count] < now - self.timeout)[::-1]:
+        self._remove(self.ids[expired])
+      count = len(self.ids)
+      ids = list(self.ids)
+      position = self.position[:count].copy()
+      velocity = self.velocity[:count].copy()
+      created = self.created[:count].copy()
+      selected = np.flatnonzero(self.dirty[:count])
+      self.dirty[:count] = False
+      tracked = [(self.index[a], self.index[b]) for a, b in self.tracked if a in self.index and b in self.index]
+    position += velocity * (now - created)[:, None]
+
+    first, second = np.empty(0, np.int64), np.empty(0, np.int64)
+    if len(selected) > 0:
+      max_speed = np.sqrt(np.max(np.einsum('ij,ij->i', velocity[:, :2], velocity[:, :2])))
+      reach = self.horizontal_separation + 2 * max_speed * self.lookahead
+      first, second = grid_pairs(position, reach, selected)
+    if len(tracked) > 0:
+      # Pairs with an updated aircraft were already found on the grid
+      is_selected = np.zeros(count, dtype=bool)
+      is_selected[selected] = True
+      tracked = np.array(tracked, dtype=np.int64)
+      tracked = tracked[~is_selected[tracked[:, 0]] & ~is_selected[tracked[:, 1]]]
+      first, second = np.concatenate([first, tracked[:, 0]]), np.concatenate([second, tracked[:, 1]])
+    alerts, tracked = self._check(ids, position, velocity, first, second, now)
+
+    elapsed = time.perf_counter() - start
+    with self.lock:
+      for pair, alert in alerts.items():
+        if pair not in self.alerts:
+          self.new_alerts += 1
+          logging.warning("ConflictDetector>" + ("Loss of separation " if alert["loss"] else "Conflict ") + str(pair) + " in " + format(alert["time_to_cpa"], ".1f") + "s, " + format(alert["horizontal_cpa"], ".1f") + " at closest approach")
+      self.alerts = alerts
+      self.tracked = tracked
+      self.ticks += 1
+      self.pairs_checked += len(first)
+      self.tick_time += elapsed
+      if elapsed > self.max_tick_time:
+        self.max_tick_time = elapsed
+    return alerts
+
+  def _check(self, ids, position, velocity, first, second, now):
+    """ Evaluates the candidate pairs, returns the alerts and the pairs to check again on the next tick """
+    time_to_cpa, horizontal, vertical, horizontal_cpa, vertical_cpa = closest_approach(position, velocity, first, second)
+    loss = (horizontal < self.horizontal_separation) & (vertical < self.vertical_separation)
+    converging = horizontal_cpa < self.horizontal_separation
+    conflict = loss | (converging & (time_to_cpa <= self.lookahead) & (vertical_cpa < self.vertical_separation))
+    alerts = {}
+    for k in np.flatnonzero(conflict):
+      pair = self._pair(ids[first[k]], ids[second[k]])
+      alerts[pair] = {"loss" : bool(loss[k]),
+                      "time_to_cpa" : float(time_to_cpa[k]),
+                      "horizontal" : float(horizontal[k]),
+                      "vertical" : float(vertical[k]),
+                      "horizontal_cpa" : float(horizontal_cpa[k]),
+                      "vertical_cpa" : float(vertical_cpa[k]),
+                      "time" : now,
+      }
+    tracked = set(alerts.keys())
+    for k in np.flatnonzero(converging & ~conflict):
+      tracked.add(self._pair(ids[first[k]], ids[second[k]]))
+    return alerts, tracked
+
+  def _pair(self, first, second):
+    """ Alerts are keyed by the ids in order, array slots change when aircraft are dropped """
+    return (first, second) if first < second else (second, first)
+
+  def conflicts(self):
+    """ Pairs in conflict at the last tick """
+    with self.lock:
+      return dict(self.alerts)
+
+  def metrics(self):
+    """
+    Snapshot of the detector counters
+
+    Parameters
+    ----------
+
+    Returns
+    --------
+    metrics (dict) - counters, tick times in seconds
+
+    """
+    with self.lock:
+      return {"aircrafts": len(self.ids),
+              "ticks": self.ticks,
+              "pairs_checked": self.pairs_checked,
+              "conflicts": len(self.alerts),
+              "new_alerts": self.new_alerts,
+              "mean_tick_time": self.tick_time / self.ticks if self.ticks else 0.0,
+              "max_tick_time": self.max_tick_time,
+      }
+
+  def run(self):
+    """
+    Tick loop
+
+    Parameters
+    ----------
+
+    Returns
+    --------
+
+    """
+    deadline = time.monotonic()
+    while self.running:
+      deadline += self.interval
+      try:
+        self.tick()
+      except:
+        logging.error("ConflictDetector>run>Error checking separation")
+      late = time.monotonic() - deadline
+      if late > 0:
+        deadline += late
+      else:
+        time.sleep(-late)
+
+  def stop(self):
+    """ Stops the tick loop """
+    self.running = False
+    if self.is_alive():
+      self.join()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+"""
+Write-behind pipeline between the UAS endpoint and etcd
+Only the latest value per key is kept between flushes, and flushes go out as etcd transactions from a dedicated thread.
+"""
+__author__ = "Bruno Chianca Ferreira"
+__license__ = "MIT"
+__version__ = "0.1"
+__maintainer__ = "Bruno Chianca Ferreira"
+__email__ = "brunobcf@gmail.com"
+
+import time
+import logging
+import threading
+import telemetry
+
+
+class EtcdWriter(threading.Thread):
+  """
+  Coalesces puts per key and flushes them in batches
+
+  .. note::
+
+      put() only stores the value and returns, a value replaced before it was flushed is counted as coalesced.
+      The writer flushes every flush_interval seconds, or as soon as batch_size keys are pending.
+
+  """
+  def __init__(self, etcd, flush_interval=0.01, batch_size=128, encoder=None):
+    """EtcdWriter
+
+    Args:
+        etcd (etcd3.Etcd3Client) - etcd client, or any object with transaction/transactions.put (e.g. local_etcd.LocalEtcd)
+
+    Kwargs:
+        flush_interval (float) - Longest time in seconds a value waits before being flushed
+        batch_size (int) - Max puts per etcd transaction (etcd defaults to 128 operations per transaction)
+        encoder (function) - Turns a value into what is written when it is flushed, so coalesced values are never encoded.
+                             Values are written as given when not set
+
+    """
+    threading.Thread.__init__(self, daemon=True)
+    self.etcd = etcd
+    self.flush_interval = flush_interval
+    self.batch_size = batch_size
+    self.encoder = encoder
+    self.running = True
+    self.pending = {}
+    self.condition = threading.Condition()
+    self.submitted = 0
+    self.coalesced = 0
+    self.written = 0
+    self.failed = 0
+    self.flushes = 0
+    self.flush_time = 0.0
+    self.max_flush_time = 0.0
+    self.put_time = telemetry.histogram("etcd_put_seconds", "Round trip of an etcd put transaction")
+    self.put_failures = telemetry.counter("etcd_put_failed", "Keys whose etcd put transaction failed")
+    telemetry.gauge("etcd_queue_depth", "Keys waiting for the next etcd flush", self.queue_depth)
+
+  def put(self, key, value):
+    """
+    Queues a put, replacing any value of the same key not flushed yet
+
+    Parameters
+    ----------
+    key (str) - etcd key
+    value (str) - value
+
+    Returns
+    --------
+
+    """
+    with self.condition:
+      if key in self.pending:
+        self.coalesced += 1
+      self.pending[key] = value
+      self.submitted += 1
+      if len(self.pending) >= self.batch_size:
+        self.condition.notify()
+
+  def queue_depth(self):
+    """ Number of keys waiting to be flushed """
+    with self.condition:
+      return len(self.pending)
+
+  def metrics(self):
+    """
+    Snapshot of the pipeline counters
+
+    Parameters
+    ----------
+
+    Returns
+    --------
+    metrics (dict) - counters, flush times in seconds
+
+    """
+    with self.condition:
+      return {"submitted": self.submitted,
+              "coalesced": self.coalesced,
+              "written": self.written,
+              "failed": self.failed,
+              "flushes": self.flushes,
+              "queue_depth": len(self.pending),
+              "mean_flush_time": self.flush_time / self.flushes if self.flushes else 0.0,
+              "max_flush_time": self.max_flush_time,
+      }
+
+  def run(self):
+    """
+    Flush loop
+
+    Parameters
+    ----------
+
+    Returns
+    --------
+
+    """
+    while self.running:
+      with self.condition:
+        if len(self.pending) < self.batch_size:
+          self.condition.wait(self.flush_interval)
+        pending = self.pending
+        self.pending = {}
+      if len(pending) > 0:
+        self.flush(pending)
+
+  def flush(self, pending):
+    """
+    Writes pending values in transactions of at most batch_size puts
+
+    Parameters
+    ----------
+    pending (dict) - key -> value
+
+    Returns
+    --------
+
+    """
+    items = list(pending.items())
+    for i in range(0, len(items), self.batch_size):
+      batch = items[i:i + self.batch_size]
+      if self.encoder is not None:
+        batch = [(key, self.encoder(value)) for key, value in batch]
+      start = time.perf_counter()
+      try:
+        self.etcd.transaction(compare=[], success=[self.etcd.transactions.put(key, value) for key, value in batch], failure=[])
+        written, failed = len(batch), 0
+      except:
+        logging.error("EtcdWriter>flush>Failed to write " + str(len(batch)) + " keys to etcd")
+        written, failed = 0, len(batch)
+      elapsed = time.perf_counter() - start
+      self.put_time.observe(elapsed)
+      self.put_failures.inc(failed)
+      with self.condition:
+        self.written += written
+        self.failed += failed
+        self.flushes += 1
+        self.flush_time += elapsed
+        if elapsed > self.max_flush_time:
+          self.max_flush_time = elapsed
+
+  def stop(self):
+    """
+    Stops the writer after flushing what is pending
+
+    Parameters
+    ----------
+
+    Returns
+    --------
+
+    """
+    self.running = False
+    with self.condition:
+      self.condition.notify()
+    if self.is_alive():
+      self.join()
+    with self.condition:
+      pending = self.pending
+      self.pending = {}
+    if len(pending) > 0:
+      self.flush(pending)
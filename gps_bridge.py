@@ -1,46 +1,224 @@
-import traceback, socket, pickle, struct, logging
+import traceback, socket, pickle, struct, logging, threading, time
+import network_sockets
+import position_feed
+import telemetry
+
+NO_FIX = [-1, -1, -1]
 
 
 class GPSBridge:
+  """
+  Client of the GPS socket the emulator opens for each aircraft, /tmp/<tag>_gps.sock
+
+  .. note::
+
+      mode 'poll' keeps one connection open and sends a GET_POSITION request per get_position(), reconnecting
+      when the emulator closed it. mode 'connect' opens a connection per request, as before.
+      mode 'subscribe' sends a SUBSCRIBE request and caches the positions the emulator streams back, so
+      get_position() only reads the cache. If the emulator answers once and closes the connection, the
+      subscriber thread falls back to polling every poll_interval seconds to keep the cache fresh. Same when no
+      second position arrives within timeout seconds.
+      mode 'shm' reads the slot of the aircraft in a position_feed file written by the emulator, without syscalls.
 
-  def __init__(self, tag) -> None:
+  """
+
+  def __init__(self, tag, max_frame=65535, mode='poll', timeout=1.0, poll_interval=0.1, feed=position_feed.DEFAULT_PATH) -> None:
     self.position = []
     self.tag = tag
+    self.max_frame = max_frame
+    self.mode = mode
+    self.timeout = timeout
+    self.poll_interval = poll_interval
+    self.feed = feed
+    self.reader = None
+    self.path = "/tmp/" + self.tag + "_gps.sock"
+    self.connection = None
+    self.lock = threading.Lock()
+    self.running = True
+    self.fix = (NO_FIX, None)
+    self.streaming = False
+    self.reconnects = 0
+    self.updates = 0
+    self.available = True
+    self.poll_time = telemetry.histogram("gps_poll_seconds", "GPSBridge time to get a position")
+    self.no_fix = telemetry.counter("gps_no_fix", "GPSBridge polls without a position")
+    self.connects = telemetry.counter("gps_connects", "GPSBridge connections to the GPS socket")
     self._setup()
 
   def _setup(self):
-    pass
+    if self.mode == 'subscribe':
+      self.subscriber = threading.Thread(target=self.subscribe, daemon=True)
+      self.subscriber.start()
 
   def poll_gps(self):
-    pass
+    position = self._request_once() if self.mode == 'connect' else self._request()
+    self._store(position)
+    return position
 
   def get_position(self):
-    data = [self.tag, 'GET_POSITION']
+    """ Latest position [x, y, z], [-1, -1, -1] when the emulator can not be reached """
+    start = self.poll_time.start()
+    if self.mode == 'subscribe':
+      position = self.fix[0]
+    elif self.mode == 'shm':
+      fix = self._read_feed()
+      position = NO_FIX if fix is None else fix[0]
+    else:
+      position = self.poll_gps()
+    self.poll_time.stop(start)
+    if position == NO_FIX:
+      self.no_fix.inc()
+    return position
+
+  def get_fix(self):
+    """ Latest position and its age in seconds, None when there is no fix yet """
+    if self.mode == 'shm':
+      fix = self._read_feed()
+      if fix is None:
+        return NO_FIX, None
+      return fix[0], time.time() - fix[1]
+    if self.mode != 'subscribe':
+      self.poll_gps()
+    position, received = self.fix
+    if received is None:
+      return position, None
+    return position, time.monotonic() - received
+
+  def _read_feed(self):
+    if self.reader is None:
+      try:
+        self.reader = position_feed.PositionFeedReader(self.tag, self.feed)
+      except FileNotFoundError:
+        self._not_found()
+        return None
+      except:
+        logging.error("GPSBridge>Could not open position feed " + self.feed)
+        return None
+    return self.reader.read()
+
+  def _store(self, position):
+    if position != NO_FIX:
+      self.fix = (position, time.monotonic())
+      self.updates += 1
+
+  def _connect(self):
     gps = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-    gps.settimeout(1)
-    try: 
-      gps.connect("/tmp/" + self.tag +"_gps.sock")
+    gps.settimeout(self.timeout)
+    try:
+      gps.connect(self.path)
+    except:
+      gps.close()
+      raise
+    self.connects.inc()
+    if not self.available:
+      logging.info("GPS " + self.path + " available again")
+    self.available = True
+    return gps
+
+  def _not_found(self):
+    if self.available:
+      print("GPS " + (self.feed if self.mode == 'shm' else self.path) + " not found. Check tag or emulator")
+    self.available = False
+
+  def _send(self, gps, request):
+    payload = pickle.dumps([self.tag, request])
+    gps.sendall(struct.pack('!I', len(payload)) + payload)
+
+  def _request_once(self):
+    """ Previous behaviour, one connection per request """
+    try:
+      gps = self._connect()
     except FileNotFoundError:
-      print("GPS " + "/tmp/" + self.tag +"_gps.sock" +  " not found. Check tag or emulator")
-      payload = pickle.dumps([-1, -1, -1])
-      return payload
+      self._not_found()
+      return NO_FIX
     except:
-      print("/tmp/" + self.tag +"_gps.sock")
       traceback.print_exc()
-    payload = pickle.dumps(data)
-    length = len(payload)
+      return NO_FIX
     try:
-      gps.sendall(struct.pack('!I', length))
-      gps.sendall(payload)
-      lengthbuf = gps.recv(4)
-      length, = struct.unpack('!I', lengthbuf)
-      data = b''
-      while length:
-        newbuf = gps.recv(length)
-        if not newbuf: return None
-        data += newbuf
-        length -= len(newbuf)
+      self._send(gps, 'GET_POSITION')
+      return pickle.loads(network_sockets.recv_frame(gps, self.max_frame))
     except:
       logging.error("Could not send data.")
-    gps.close()
-    return data
\ No newline at end of file
+      return NO_FIX
+    finally:
+      gps.close()
+
+  def _request(self):
+    """ GET_POSITION on the persistent connection, reconnecting once when the emulator closed it """
+    with self.lock:
+      for attempt in range(2):
+        try:
+          if self.connection is None:
+            self.connection = self._connect()
+            self.reconnects += 1
+          self._send(self.connection, 'GET_POSITION')
+          data = network_sockets.recv_frame(self.connection, self.max_frame)
+          if data is None:
+            raise ConnectionError("GPS closed the connection")
+          return pickle.loads(data)
+        except FileNotFoundError:
+          self._not_found()
+          return NO_FIX
+        except:
+          self._close()
+          if attempt == 1:
+            logging.error("Could not send data.")
+      return NO_FIX
+
+  def _close(self):
+    if self.connection is not None:
+      try:
+        self.connection.close()
+      except:
+        pass
+      self.connection = None
+
+  def subscribe(self):
+    """ Subscriber thread, keeps self.fix up to date """
+    backoff = self.poll_interval
+    while self.running:
+      try:
+        gps = self._connect()
+      except FileNotFoundError:
+        self._not_found()
+        time.sleep(backoff)
+        backoff = min(backoff * 2, 1.0)
+        continue
+      except:
+        time.sleep(backoff)
+        backoff = min(backoff * 2, 1.0)
+        continue
+      backoff = self.poll_interval
+      self.reconnects += 1
+      frames = 0
+      try:
+        self._send(gps, 'SUBSCRIBE')
+        while self.running:
+          data = network_sockets.recv_frame(gps, self.max_frame)
+          if data is None:
+            break
+          self._store(pickle.loads(data))
+          frames += 1
+          if frames == 2:
+            # Streaming, updates may come slower than the request timeout
+            self.streaming = True
+            gps.settimeout(None)
+      except socket.timeout:
+        pass
+      except:
+        if self.running: logging.error("GPSBridge>subscribe>Subscription to " + self.path + " lost")
+      finally:
+        gps.close()
+      if frames <= 1 and self.running:
+        # The emulator does not stream, poll it from this thread instead
+        while self.running:
+          self._store(self._request())
+          time.sleep(self.poll_interval)
+
+  def stop(self):
+    self.running = False
+    with self.lock:
+      self._close()
+    if self.reader is not None:
+      self.reader.close()
+      self.reader = None
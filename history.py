@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+
+"""
+Append-only history of the aircraft updates saved by a UTM server
+Updates are buffered in typed columns and flushed as binary blocks to rotating segment files, so memory stays bounded
+whatever the session length and a crash loses at most one flush interval. export_csv() writes the usual report csv.
+"""
+__author__ = "Bruno Chianca Ferreira"
+__license__ = "MIT"
+__version__ = "0.1"
+__maintainer__ = "Bruno Chianca Ferreira"
+__email__ = "brunobcf@gmail.com"
+
+import os
+import sys
+import glob
+import struct
+import logging
+import threading
+from array import array
+
+MAGIC = b'UTMH'
+VERSION = 3
+# magic, version, rows, bytes of the string table
+BLOCK_HEADER = struct.Struct('!4sBII')
+# Length of each UTF-8 string of the string table, strings may hold any character
+STRING_LENGTH = struct.Struct('!H')
+CSV_HEADER = 'time;created;id;aircraft;position;vel;status\n'
+SWAP = sys.byteorder == 'big'
+
+# name, array typecode. aircraft and status are indexes in the string table of the block. Columns are stored little endian
+# kinds tells how the received values were written, so the csv shows them as received: [100, 100, 100] and 0 stay ints
+COLUMNS = [('time', 'q'), ('created', 'q'), ('id', 'Q'), ('aircraft', 'I'),
+           ('x', 'd'), ('y', 'd'), ('z', 'd'), ('vel', 'd'), ('status', 'I'), ('kinds', 'B')]
+# Bits of kinds: x, y, z and vel were ints, the position had no z
+INT_X, INT_Y, INT_Z, INT_VEL, NO_Z = 1, 2, 4, 8, 16
+
+
+class Block():
+  """
+  Rows buffered in memory, one array per column
+  """
+  def __init__(self):
+    self.columns = {name: array(typecode) for name, typecode in COLUMNS}
+    self.strings = {}
+    self.table = []
+
+  def __len__(self):
+    return len(self.columns['time'])
+
+  def code(self, value):
+    code = self.strings.get(value)
+    if code is None:
+      encoded = value.encode()
+      if len(encoded) > 0xFFFF:
+        raise ValueError("History string longer than 65535 bytes: " + value[:32] + "...")
+      code = self.strings[value] = len(self.strings)
+      self.table.append(STRING_LENGTH.pack(len(encoded)) + encoded)
+    return code
+
+  def append(self, now, created, msg_id, aircraft, position, velocity, status):
+    # Strings first, a rejected one must not leave a partial row
+    aircraft, status = self.code(aircraft), self.code(status)
+    columns = self.columns
+    columns['time'].append(now)
+    columns['created'].append(created)
+    columns['id'].append(msg_id)
+    columns['aircraft'].append(aircraft)
+    columns['x'].append(position[0])
+    columns['y'].append(position[1])
+    columns['z'].append(position[2] if len(position) > 2 else 0.0)
+    columns['vel'].append(velocity)
+    columns['status'].append(status)
+    kinds = 0 if len(position) > 2 else NO_Z
+    for bit, value in zip((INT_X, INT_Y, INT_Z, INT_VEL), (position[0], position[1], position[2] if len(position) > 2 else 0.0, velocity)):
+      if isinstance(value, int):
+        kinds |= bit
+    columns['kinds'].append(kinds)
+
+  def to_bytes(self):
+    strings = b''.join(self.table)
+    parts = [BLOCK_HEADER.pack(MAGIC, VERSION, len(self), len(strings)), strings]
+    for name, typecode in COLUMNS:
+      column = self.columns[name]
+      if SWAP:
+        column = array(typecode, column)
+        column.byteswap()
+      parts.append(column.tobytes())
+    return b''.join(parts)
+
+
+def read_strings(data, offset, end):
+  """ String table of a block, each string is its '!H' length followed by its UTF-8 bytes """
+  strings = []
+  while offset < end:
+    length, = STRING_LENGTH.unpack_from(data, offset)
+    offset += STRING_LENGTH.size
+    strings.append(data[offset:offset + length].decode())
+    offset += length
+  return strings
+
+
+def read_blocks(path):
+  """
+  Reads the blocks of a segment file, a block cut short by a crash ends the segment
+
+  Parameters
+  ----------
+  path (str) - Segment file
+
+  Returns
+  --------
+  blocks (generator) - (columns, strings) per block, columns as arrays by name and strings as a list
+
+  """
+  with open(path, 'rb') as segment:
+    data = segment.read()
+  offset = 0
+  while offset + BLOCK_HEADER.size <= len(data):
+    magic, version, rows, strings_size = BLOCK_HEADER.unpack_from(data, offset)
+    if magic != MAGIC or version != VERSION:
+      raise ValueError("Not a history block: " + path + " at " + str(offset))
+    offset += BLOCK_HEADER.size
+    size = strings_size + sum(rows * array(typecode).itemsize for name, typecode in COLUMNS)
+    if offset + size > len(data):
+      logging.error("history>read_blocks>Truncated block in " + path)
+      return
+    strings = read_strings(data, offset, offset + strings_size)
+    offset += strings_size
+    columns = {}
+    for name, typecode in COLUMNS:
+      column = array(typecode)
+      column.frombytes(data[offset:offset + rows * column.itemsize])
+      if SWAP:
+        column.byteswap()
+      offset += rows * column.itemsize
+      columns[name] = column
+    yield columns, strings
+
+
+def segments(prefix):
+  """ Segment files of a history, oldest first """
+  return sorted(glob.glob(glob.escape(prefix) + '.*.seg'))
+
+
+def export_csv(prefix, output):
+  """
+  Writes a history as the report csv, time;created;id;aircraft;position;vel;status
+  Positions and velocities are written as received, the lines match those of the previous in-memory data bank
+
+  Parameters
+  ----------
+  prefix (str) - History path prefix, as given to HistoryLog
+  output (file) - Open text file, or path, to write to
+
+  Returns
+  --------
+  rows (int) - Rows written
+
+  """
+  if isinstance(output, str):
+    with open(output, 'w') as report_file:
+      return export_csv(prefix, report_file)
+  output.write(CSV_HEADER)
+  rows = 0
+  for path in segments(prefix):
+    for columns, strings in read_blocks(path):
+      lines = []
+      for now, created, msg_id, aircraft, x, y, z, velocity, status, kinds in zip(*(columns[name] for name, typecode in COLUMNS)):
+        if kinds:
+          x, y, z, velocity = [int(value) if kinds & bit else value for bit, value in zip((INT_X, INT_Y, INT_Z, INT_VEL), (x, y, z, velocity))]
+        position = [x, y] if kinds & NO_Z else [x, y, z]
+        lines.append(str(now) + ";" + str(created) + ";" + hex(msg_id) + ";" + strings[aircraft] + ";" + str(position) + ";" + str(velocity) + ";" + strings[status] + "\n")
+      output.write(''.join(lines))
+      rows += len(lines)
+  return rows
+
+
+class HistoryLog(threading.Thread):
+  """
+  Buffers history rows and flushes them from a background thread
+
+  .. note::
+
+      A block is flushed every flush_interval seconds, or as soon as block_rows rows are buffered, and appended
+      to the current segment file. A new segment is started after segment_rows rows. When the flush falls behind,
+      append() waits once max_rows rows are buffered, so memory never grows beyond that.
+
+  """
+  def __init__(self, prefix, flush_interval=1.0, block_rows=8192, segment_rows=1000000, max_rows=65536, resume=False):
+    """HistoryLog
+
+    Args:
+        prefix (str) - Path prefix of the segment files, segments are <prefix>.<number>.seg
+
+    Kwargs:
+        flush_interval (float) - Longest time in seconds a row stays in memory
+        block_rows (int) - Rows that trigger a flush before flush_interval
+        segment_rows (int) - Rows per segment file before rotating
+        max_rows (int) - Rows buffered before append() waits for the flush
+        resume (bool) - Keep the segments already under prefix and add to them, they are deleted otherwise
+
+    """
+    threading.Thread.__init__(self, daemon=True)
+    self.prefix = prefix
+    self.flush_interval = flush_interval
+    self.block_rows = block_rows
+    self.segment_rows = segment_rows
+    self.max_rows = max_rows
+    self.running = True
+    self.condition = threading.Condition()
+    self.block = Block()
+    self.pending = []
+    self.segment = None
+    if not resume:
+      for path in segments(prefix):
+        os.remove(path)
+    self.segment_number = len(segments(prefix))
+    self.segment_size = 0
+    self.rows = 0
+    self.written = 0
+    self.flushes = 0
+    self.waits = 0
+
+  def append(self, now, created, msg_id, aircraft, position, velocity, status):
+    """
+    Adds an aircraft update to the history
+
+    Parameters
+    ----------
+    now (int) - Time the update was saved, in microseconds
+    created (int) - Time the data was created, in microseconds
+    msg_id (str) - Unique message id, hex
+    aircraft (str) - Aircraft id
+    position (list) - [x, y, z]
+    velocity (float) - Velocity
+    status (str) - Status
+
+    Returns
+    --------
+
+    """
+    msg_id = int(msg_id, 16) if isinstance(msg_id, str) else int(msg_id)
+    with self.condition:
+      while self.rows - self.written >= self.max_rows and self.running:
+        self.waits += 1
+        self.condition.notify_all()
+        self.condition.wait(self.flush_interval)
+      self.block.append(now, int(created), msg_id, aircraft, position, velocity, str(status))
+      self.rows += 1
+      if len(self.block) >= self.block_rows:
+        self.pending.append(self.block)
+        self.block = Block()
+        self.condition.notify_all()
+
+  def metrics(self):
+    """ Snapshot of the history counters """
+    with self.condition:
+      return {"rows": self.rows,
+              "written": self.written,
+              "buffered": self.rows - self.written,
+              "flushes": self.flushes,
+              "segments": self.segment_number,
+              "waits": self.waits,
+      }
+
+  def run(self):
+    """
+    Flush loop
+
+    Parameters
+    ----------
+
+    Returns
+    --------
+
+    """
+    while self.running:
+      with self.condition:
+        if len(self.pending) == 0:
+          self.condition.wait(self.flush_interval)
+        blocks = self._take()
+      self._write(blocks)
+
+  def _take(self):
+    """ Pending blocks and the current one, condition must be held """
+    blocks = self.pending
+    if len(self.block) > 0:
+      blocks.append(self.block)
+      self.block = Block()
+    self.pending = []
+    return blocks
+
+  def _write(self, blocks):
+    for block in blocks:
+      try:
+        if self.segment is None or self.segment_size >= self.segment_rows:
+          self._rotate()
+        self.segment.write(block.to_bytes())
+        self.segment.flush()
+        self.segment_size += len(block)
+      except:
+        logging.error("HistoryLog>_write>Error writing " + str(len(block)) + " rows to " + str(self.prefix))
+      with self.condition:
+        self.written += len(block)
+        self.flushes += 1
+        self.condition.notify_all()
+
+  def _rotate(self):
+    if self.segment is not None:
+      self.segment.close()
+    self.segment_number += 1
+    self.segment = open(self.prefix + '.' + format(self.segment_number, '06d') + '.seg', 'ab')
+    self.segment_size = 0
+
+  def stop(self):
+    """
+    Stops the flush loop, writing what is buffered
+
+    Parameters
+    ----------
+
+    Returns
+    --------
+
+    """
+    self.running = False
+    with self.condition:
+      self.condition.notify_all()
+    if self.is_alive():
+      self.join()
+    with self.condition:
+      blocks = self._take()
+    self._write(blocks)
+    if self.segment is not None:
+      self.segment.close()
+      self.segment = None
+
+  def export_csv(self, output):
+    """ Writes every row flushed so far as the report csv, see export_csv() """
+    return export_csv(self.prefix, output)
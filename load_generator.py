@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+
+"""
+Load generator for the UAS endpoint of UTMServer
+Sends synthetic aircraft tracks in the UASClient message format at a fixed rate, without the emulator or GPS sockets.
+"""
+__author__ = "Bruno Chianca Ferreira"
+__license__ = "MIT"
+__version__ = "0.1"
+__maintainer__ = "Bruno Chianca Ferreira"
+__email__ = "brunobcf@gmail.com"
+
+# Python stdlib
+import sys
+import socket
+import argparse
+import logging
+import random
+import zlib
+import time
+import tempfile
+import multiprocessing
+# Local
+import message_codec
+import tracing
+from uas_swarm import SwarmState
+from local_etcd import LocalEtcd
+
+
+class LoadGenerator():
+  """
+  Open loop sender of synthetic UAS broadcasts
+
+  .. note::
+
+      Messages are due at start + k / rate whatever the receiver does, a sender that falls behind sends the late
+      messages back to back (at most batch per wakeup) and the lag is reported, the rate is never lowered.
+      Aircraft take turns, so each one broadcasts every count / rate seconds and moves on a straight line between
+      broadcasts. A dropped message (loss) still moves its aircraft, as a lost broadcast would.
+
+  """
+  def __init__(self, destination='127.0.0.1', count=100, prefix='uas', wire='binary', loss=0.0, batch=64, port=44444, seed=None, trace=False):
+    """LoadGenerator
+
+    Args:
+
+    Kwargs:
+        destination (str) - Address of the tower, or a broadcast address
+        count (int) - Number of aircraft
+        prefix (str) - Aircraft tags are prefix + index
+        wire (str) - Wire format, 'binary' or the legacy 'pickle'
+        loss (float) - Fraction of the messages dropped before sending, 0 to 1
+        batch (int) - Max messages sent per wakeup
+        port (int) - UAS endpoint port
+        seed (object) - Seed of the tracks and of the losses
+        trace (bool) - Send the traced message format, stamped with the send time
+
+    """
+    self.destination = destination
+    self.port = port
+    self.loss = loss
+    self.batch = batch
+    self.trace = trace
+    self.random = random.Random(seed)
+    self.codec = message_codec.UasStructCodec() if wire == 'binary' else message_codec.PickleCodec()
+    self.state = SwarmState([prefix + str(i) for i in range(count)])
+    self.state.fly_straight(seed)
+    self.next = 0
+    # Not bound, the tower may listen on the same host and port
+    self.sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.sender.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+
+  def message(self, seconds):
+    """
+    Next message of the round robin, moving its aircraft seconds forward
+
+    Parameters
+    ----------
+    seconds (float) - Time since the previous broadcast of the aircraft
+
+    Returns
+    --------
+    message (bytes) - Encoded message
+
+    """
+    state, i = self.state, self.next
+    self.next = (self.next + 1) % len(state)
+    state.position[i] += state.heading[i] * seconds
+    created = str(int(time.time()*1000000))
+    unique_id = zlib.crc32((created[:-3] + state.tags[i] + str(self.random.randint(0,10000))).encode())
+    payload = [created, state.tags[i], state.position[i].tolist(), float(state.velocity[i]), message_codec.STATUS_NAMES[state.status[i]]]
+    state.broadcasts[i] += 1
+    if self.trace:
+      payload.append(tracing.now())
+    return message_codec.encode_message(self.codec, unique_id, payload)
+
+  def run(self, rate, duration):
+    """
+    Sends at rate messages per second for duration seconds
+
+    Parameters
+    ----------
+    rate (float) - Offered rate in messages per second
+    duration (float) - Seconds
+
+    Returns
+    --------
+    metrics (dict) - offered and achieved rate in messages per second, message counters, max lag behind the schedule in seconds
+
+    """
+    seconds = len(self.state) / rate
+    scheduled, sent, dropped, errors, max_lag = 0, 0, 0, 0, 0.0
+    start = time.monotonic()
+    while True:
+      elapsed = time.monotonic() - start
+      if elapsed >= duration:
+        break
+      due = min(int(elapsed * rate) + 1 - scheduled, self.batch)
+      if due <= 0:
+        time.sleep(min(scheduled / rate - elapsed, 0.001))
+        continue
+      max_lag = max(max_lag, elapsed - scheduled / rate)
+      for k in range(due):
+        scheduled += 1
+        message = self.message(seconds)
+        if self.loss > 0 and self.random.random() < self.loss:
+          dropped += 1
+          continue
+        try:
+          self.sender.sendto(message, (self.destination, self.port))
+          sent += 1
+        except OSError:
+          errors += 1
+    elapsed = time.monotonic() - start
+    return {"offered": rate,
+            "achieved": sent / elapsed,
+            "scheduled": scheduled,
+            "sent": sent,
+            "dropped": dropped,
+            "errors": errors,
+            "behind": int(elapsed * rate) - scheduled,
+            "max_lag": max_lag,
+    }
+
+  def stop(self):
+    self.sender.close()
+
+#######################Class END###############################################################################################
+
+def udp_errors():
+  """
+  UDP receive errors of the host, from /proc/net/snmp
+
+  Parameters
+  ----------
+
+  Returns
+  --------
+  errors (int) - Datagrams the kernel dropped on receive (e.g. full receive buffers), None when not available
+
+  """
+  try:
+    with open('/proc/net/snmp') as snmp:
+      lines = [line.split() for line in snmp if line.startswith('Udp:')]
+    counters = dict(zip(lines[0][1:], lines[1][1:]))
+    return int(counters['InErrors'])
+  except:
+    return None
+
+def run_tower(connection, tag, etcd_latency, backend, report_dir, trace=False, legacy_pickle=False, queue_size=0, rcvbuf=None):
+  """
+  Runs a tower against a local_etcd.LocalEtcd in a child process, answering metrics requests on connection until 'stop'
+  The process must be terminated after the last answer, the tower sockets are left open
+
+  Parameters
+  ----------
+  connection (multiprocessing.connection.Connection) - Pipe to the load generator
+  tag (str) - Tower tag
+  etcd_latency (float) - Emulated etcd round trip in seconds
+  backend (str) - Socket backend of the tower
+  report_dir (str) - Directory of the tower report, history and trace files
+  trace (bool) - Write the hop by hop traces of the tower
+  legacy_pickle (bool) - Accept pickled broadcasts, for the pickle wire format
+  queue_size (int) - Receive queue of the tower UAS endpoint, see UTMServer
+  rcvbuf (int) - SO_RCVBUF of the tower UAS endpoint in bytes
+
+  Returns
+  --------
+
+  """
+  # Imported here, the tower and its dependencies are only needed with --local-tower
+  from utm_server import UTMServer
+  tower = UTMServer(tag, None, backend=backend, conflict_interval=0, etcd=LocalEtcd(etcd_latency), trace=trace, legacy_pickle=legacy_pickle, report_dir=report_dir, queue_size=queue_size, rcvbuf=rcvbuf)
+  connection.send('ready')
+  while connection.recv() == 'metrics':
+    connection.send(tower.metrics(reset=True))
+  tower.stop()
+  connection.send(tower.metrics())
+
+def parse_args():
+  """
+  Method for parsing command line arguments
+
+  Parameters
+  ----------
+
+  Returns
+  --------
+  args - Arguments
+
+  """
+  parser = argparse.ArgumentParser(description='Some arguments are obligatory and must follow the correct order as indicated')
+  parser.add_argument("-d", "--destination", help="Address of the tower", type=str, default='127.0.0.1')
+  parser.add_argument("-n", "--count", help="Number of aircraft", type=int, default=100)
+  parser.add_argument("-t", "--tag", help="Tag prefix of the aircraft", type=str, default='uas')
+  parser.add_argument("-r", "--rates", help="Offered rates in messages per second, one step each", type=float, nargs='+', default=[100])
+  parser.add_argument("-D", "--duration", help="Seconds per rate", type=float, default=10.0)
+  parser.add_argument("-l", "--loss", help="Fraction of the messages dropped before sending", type=float, default=0.0)
+  parser.add_argument("-w", "--wire", help="Wire format of the messages", choices=['binary', 'pickle'], default='binary')
+  parser.add_argument("-b", "--batch", help="Max messages sent per wakeup", type=int, default=64)
+  parser.add_argument("-L", "--local-tower", help="Run a tower against a local etcd stand-in and report its counters per rate", action="store_true")
+  parser.add_argument("-e", "--etcd-latency", help="Emulated etcd round trip of the local tower in seconds", type=float, default=0.001)
+  parser.add_argument("-B", "--backend", help="Socket backend of the local tower", choices=['threads', 'asyncio'], default='threads')
+  parser.add_argument("-x", "--trace", help="Send traced messages, the local tower writes their traces to load_tower.trace.csv", action="store_true")
+  parser.add_argument("-R", "--report-dir", help="Directory of the local tower files, a temporary directory when not set", type=str, default=None)
+  parser.add_argument("-q", "--queue-size", help="Receive queue of the local tower, in batches, 0 to handle on the receive thread", type=int, default=0)
+  parser.add_argument("-u", "--rcvbuf", help="SO_RCVBUF of the local tower in bytes", type=int, default=None)
+  parser.add_argument("-s", "--settle", help="Seconds waited after each rate before reading the tower counters", type=float, default=1.0)
+  return parser.parse_args()
+
+def set_logging():
+  """
+  Method for setting the logging levels
+
+  Parameters
+  ----------
+
+  Returns
+  --------
+
+  """
+  logging.Formatter('%(asctime)s -> [%(levelname)s] %(message)s')
+  logger = logging.getLogger()
+  logger.setLevel(logging.INFO)
+  logging.basicConfig(level='INFO')
+
+###########################Runner ################################################################################################
+
+
+if __name__ == "__main__":
+  set_logging()
+  args = parse_args()
+  tower, connection = None, None
+  if args.local_tower:
+    if args.report_dir is None:
+      reports = tempfile.TemporaryDirectory()
+      args.report_dir = reports.name
+    connection, child = multiprocessing.Pipe()
+    tower = multiprocessing.Process(target=run_tower, args=(child, 'load_tower', args.etcd_latency, args.backend, args.report_dir, args.trace, args.wire == 'pickle', args.queue_size, args.rcvbuf), daemon=True)
+    tower.start()
+    # Only the child holds its end now, recv() raises EOFError if the tower dies instead of waiting forever
+    child.close()
+    connection.recv()
+  generator = LoadGenerator(args.destination, args.count, args.tag, args.wire, args.loss, args.batch, trace=args.trace)
+  columns = ["offered/s", "achieved/s", "sent", "dropped", "behind", "max lag ms"]
+  if tower is not None:
+    columns += ["tower/s", "udp errors", "p50 rx ms", "p99 rx ms", "p50 watch ms", "p99 watch ms"]
+  print("\t".join(columns))
+  try:
+    for rate in args.rates:
+      if tower is not None:
+        connection.send('metrics')
+        before = connection.recv()
+        errors = udp_errors()
+      step = generator.run(rate, args.duration)
+      row = [format(step["offered"], ".0f"), format(step["achieved"], ".1f"), str(step["sent"]), str(step["dropped"]), str(step["behind"]), format(step["max_lag"] * 1e3, ".2f")]
+      if tower is not None:
+        time.sleep(args.settle)
+        connection.send('metrics')
+        after = connection.recv()
+        lost = None if errors is None else udp_errors() - errors
+        row += [format((after["received"] - before["received"]) / args.duration, ".1f"), str(lost),
+                format(after["p50_receive_latency"] * 1e3, ".2f"), format(after["p99_receive_latency"] * 1e3, ".2f"),
+                format(after["p50_watch_latency"] * 1e3, ".2f"), format(after["p99_watch_latency"] * 1e3, ".2f")]
+      print("\t".join(row))
+      sys.stdout.flush()
+  except KeyboardInterrupt:
+    logging.info("LoadGenerator>Interrupted")
+  generator.stop()
+  if tower is not None:
+    connection.send('stop')
+    logging.info("LoadGenerator>tower: " + str(connection.recv()))
+    # The tower sockets keep their threads running
+    tower.terminate()
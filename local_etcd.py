@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+"""
+In-process stand-in for the parts of the etcd3 client used by UTMServer
+Used to run a tower and its write pipeline without an etcd cluster, in tests and load generation.
+"""
+__author__ = "Bruno Chianca Ferreira"
+__license__ = "MIT"
+__version__ = "0.1"
+__maintainer__ = "Bruno Chianca Ferreira"
+__email__ = "brunobcf@gmail.com"
+
+import time
+import queue
+import threading
+import itertools
+
+
+def _bytes(value):
+  if isinstance(value, str):
+    return value.encode()
+  return bytes(value)
+
+
+class KVMetadata():
+  """
+  Metadata returned with get(), like etcd3.client.KVMetadata
+  """
+  def __init__(self, key, create_revision, mod_revision, version):
+    self.key = key
+    self.create_revision = create_revision
+    self.mod_revision = mod_revision
+    self.version = version
+
+
+class PutEvent():
+  """
+  Watch event of a put, like etcd3.events.PutEvent
+  """
+  def __init__(self, key, value, create_revision, mod_revision, version):
+    self.key = key
+    self.value = value
+    self.create_revision = create_revision
+    self.mod_revision = mod_revision
+    self.version = version
+
+
+class ResponseHeader():
+  def __init__(self, revision):
+    self.revision = revision
+
+
+class WatchResponse():
+  """
+  Batch of events handed to watch callbacks
+  """
+  def __init__(self, events, revision):
+    self.events = events
+    self.header = ResponseHeader(revision)
+
+
+class Transactions():
+  """
+  Builds transaction operations, like etcd3 client.transactions
+  """
+  def put(self, key, value, lease=None, prev_kv=False):
+    return ('put', _bytes(key), _bytes(value))
+
+  def get(self, key, range_end=None):
+    return ('get', _bytes(key), None)
+
+
+class LocalEtcd():
+  """
+  Single process key/value store with revisions and range watches
+
+  .. note::
+
+      Each RPC (put, get, transaction) sleeps for latency seconds to emulate the etcd round trip.
+      Watch callbacks run on a dispatcher thread, as with the etcd3 client.
+
+  """
+  def __init__(self, latency=0.0):
+    """LocalEtcd
+
+    Args:
+
+    Kwargs:
+        latency (float) - Emulated round trip of each RPC in seconds
+
+    """
+    self.latency = latency
+    self.lock = threading.Lock()
+    self.store = {}
+    self.revision = 1
+    self.rpcs = 0
+    self.transactions = Transactions()
+    self.watches = {}
+    self.watch_ids = itertools.count(1)
+    self.dispatch = queue.Queue()
+    self.dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+    self.dispatcher.start()
+
+  def _rpc(self):
+    self.rpcs += 1
+    if self.latency > 0:
+      time.sleep(self.latency)
+
+  def _apply(self, puts):
+    """ Applies puts under one new revision and queues the watch events, lock must be held """
+    self.revision += 1
+    events = []
+    for key, value in puts:
+      create_revision, version = self.revision, 1
+      if key in self.store:
+        create_revision = self.store[key][1].create_revision
+        version = self.store[key][1].version + 1
+      metadata = KVMetadata(key, create_revision, self.revision, version)
+      self.store[key] = (value, metadata)
+      events.append(PutEvent(key, value, create_revision, self.revision, version))
+    for watch_id, (start, end, callback) in list(self.watches.items()):
+      matched = [event for event in events if (event.key == start if end is None else start <= event.key < end)]
+      if len(matched) > 0:
+        self.dispatch.put((callback, WatchResponse(matched, self.revision)))
+    return self.revision
+
+  def _dispatch(self):
+    while True:
+      callback, response = self.dispatch.get()
+      try:
+        callback(response)
+      except Exception:
+        pass
+
+  def put(self, key, value, lease=None, prev_kv=False):
+    self._rpc()
+    with self.lock:
+      return self._apply([(_bytes(key), _bytes(value))])
+
+  def get(self, key):
+    self._rpc()
+    with self.lock:
+      return self.store.get(_bytes(key), (None, None))
+
+  def get_range(self, range_start, range_end):
+    self._rpc()
+    start, end = _bytes(range_start), _bytes(range_end)
+    with self.lock:
+      items = [self.store[key] for key in sorted(self.store.keys()) if start <= key < end]
+    for value, metadata in items:
+      yield value, metadata
+
+  def transaction(self, compare, success, failure):
+    self._rpc()
+    with self.lock:
+      puts = [(op[1], op[2]) for op in success if op[0] == 'put']
+      self._apply(puts)
+      return True, []
+
+  def add_watch_callback(self, key, callback, range_end=None):
+    watch_id = next(self.watch_ids)
+    with self.lock:
+      self.watches[watch_id] = (_bytes(key), None if range_end is None else _bytes(range_end), callback)
+    return watch_id
+
+  def cancel_watch(self, watch_id):
+    with self.lock:
+      self.watches.pop(watch_id, None)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+"""
+In-process stand-in for the GPS socket the emulator opens for each aircraft, /tmp/<tag>_gps.sock
+Used to run GPSBridge and UAS clients without the emulator, in tests and benchmarks.
+"""
+__author__ = "Bruno Chianca Ferreira"
+__license__ = "MIT"
+__version__ = "0.1"
+__maintainer__ = "Bruno Chianca Ferreira"
+__email__ = "brunobcf@gmail.com"
+
+import os
+import time
+import socket
+import pickle
+import struct
+import threading
+import network_sockets
+from position_feed import PositionFeedWriter
+
+
+class LocalGPS():
+  """
+  Answers GET_POSITION and SUBSCRIBE requests with the position of a moving aircraft
+
+  .. note::
+
+      With keep_open the connection stays open for more requests, otherwise it is closed after each answer.
+      SUBSCRIBE streams a position every stream_interval seconds until the client disconnects.
+      With a feed, a thread also publishes the position to a shared-memory position feed at the same rate.
+
+  """
+  def __init__(self, tag, keep_open=True, stream_interval=0.1, speed=(10.0, 0.0, 0.0), subscribe=True, feed=None):
+    """LocalGPS
+
+    Args:
+        tag (str) - Aircraft tag, the socket is /tmp/<tag>_gps.sock
+
+    Kwargs:
+        keep_open (bool) - Serve several requests per connection
+        stream_interval (float) - Seconds between positions streamed to subscribers
+        speed (tuple) - Velocity of the aircraft per axis, per second
+        subscribe (bool) - Stream on SUBSCRIBE, otherwise answer it once like GET_POSITION (emulators without streaming)
+        feed (str) - Also publish the position every stream_interval seconds to this position_feed file
+
+    """
+    self.tag = tag
+    self.keep_open = keep_open
+    self.stream_interval = stream_interval
+    self.speed = speed
+    self.streams = subscribe
+    self.path = "/tmp/" + tag + "_gps.sock"
+    self.start_time = time.monotonic()
+    self.running = True
+    self.requests = 0
+    if os.path.exists(self.path):
+      os.remove(self.path)
+    self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.listener.bind(self.path)
+    self.listener.listen(100)
+    self.thread = threading.Thread(target=self.accept, daemon=True)
+    self.thread.start()
+    self.feed = None
+    if feed is not None:
+      self.feed = PositionFeedWriter(feed)
+      self.feed.write(self.tag, self.position())
+      threading.Thread(target=self.publish, daemon=True).start()
+
+  def position(self):
+    elapsed = time.monotonic() - self.start_time
+    return [100.0 + self.speed[0] * elapsed, 100.0 + self.speed[1] * elapsed, 30.0 + self.speed[2] * elapsed]
+
+  def publish(self):
+    while self.running:
+      self.feed.write(self.tag, self.position())
+      time.sleep(self.stream_interval)
+
+  def accept(self):
+    while self.running:
+      try:
+        connection, _ = self.listener.accept()
+      except OSError:
+        return
+      threading.Thread(target=self.serve, args=(connection,), daemon=True).start()
+
+  def _reply(self, connection, position):
+    payload = pickle.dumps(position)
+    connection.sendall(struct.pack('!I', len(payload)) + payload)
+
+  def serve(self, connection):
+    try:
+      while self.running:
+        data = network_sockets.recv_frame(connection)
+        if data is None:
+          break
+        tag, request = pickle.loads(data)
+        self.requests += 1
+        if request == 'SUBSCRIBE' and self.streams:
+          while self.running:
+            self._reply(connection, self.position())
+            time.sleep(self.stream_interval)
+        self._reply(connection, self.position())
+        if not self.keep_open:
+          break
+    except OSError:
+      pass
+    finally:
+      connection.close()
+
+  def stop(self):
+    self.running = False
+    self.listener.close()
+    if os.path.exists(self.path):
+      os.remove(self.path)
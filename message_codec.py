@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+"""
+Binary wire format for the UAS broadcast messages (ADS-B style) and the codecs pluggable in network_sockets
+"""
+__author__ = "Bruno Chianca Ferreira"
+__license__ = "MIT"
+__version__ = "0.1"
+__maintainer__ = "Bruno Chianca Ferreira"
+__email__ = "brunobcf@gmail.com"
+
+import struct, pickle
+from enum import IntEnum
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MAGIC = 0xAD
+VERSION = 1
+TRACED_VERSION = 2
+
+# magic, version, msg id (CRC32), created (us), aircraft tag, position x/y/z, velocity, status
+UAS_MESSAGE = struct.Struct('!BBIQ16s3dfB')
+# UAS_MESSAGE followed by the client send time (us), the trace context of tracing.py
+UAS_TRACED_MESSAGE = struct.Struct('!BBIQ16s3dfBQ')
+HEADER = bytes([MAGIC, VERSION])
+TRACED_HEADER = bytes([MAGIC, TRACED_VERSION])
+TAG_SIZE = 16
+
+class Status(IntEnum):
+    """
+    Valid aircraft statuses carried on the wire
+    """
+    UNKNOWN = 0
+    OK = 1
+    EMERGENCY = 2
+    LANDING = 3
+    GROUNDED = 4
+
+# Plain lookups, Enum attribute access is too slow for the hot path
+STATUS_CODES = {status.name: status.value for status in Status}
+STATUS_NAMES = tuple(status.name for status in Status)
+
+def encode(msg_id, payload):
+    """
+    Packs a UAS broadcast into a fixed width binary message
+
+    Parameters
+    ----------
+    msg_id (int) - Unique CRC32 id of the message
+    payload (list) - [created, tag, position, velocity, status] as built by UASClient, traced messages add the send time [..., sent]
+
+    Returns
+    --------
+    bytes_to_send (bytes) - Encoded message of UAS_MESSAGE.size bytes, UAS_TRACED_MESSAGE.size when traced
+
+    """
+    created, tag, position, velocity, status = payload[:5]
+    tag = tag.encode()
+    if len(tag) > TAG_SIZE:
+        raise ValueError("Aircraft tag longer than " + str(TAG_SIZE) + " bytes: " + str(tag))
+    if len(position) == 3:
+        x, y, z = position
+    else:
+        x, y, z = (list(position) + [0, 0, 0])[:3]
+    status = STATUS_CODES.get(status, 0)
+    if len(payload) > 5:
+        return UAS_TRACED_MESSAGE.pack(MAGIC, TRACED_VERSION, msg_id, int(created), tag, x, y, z, velocity, status, int(payload[5]))
+    return UAS_MESSAGE.pack(MAGIC, VERSION, msg_id, int(created), tag, x, y, z, velocity, status)
+
+def decode(payload, legacy=False):
+    """
+    Unpacks a UAS broadcast, the version byte selects the format
+
+    Parameters
+    ----------
+    payload (bytes) - Received datagram
+    legacy (bool) - Accept pickled messages from clients not using the binary format. Unpickling runs code chosen by
+                    the sender, only for trusted networks
+
+    Returns
+    --------
+    message (list) - [hex(msg_id), [created, tag, position, velocity, status]], same layout as the pickled message,
+                     traced messages add the send time [..., sent]
+
+    """
+    # Every malformed message raises ValueError, which the interfaces count as rejected (a bad tag raises UnicodeDecodeError, a ValueError)
+    if payload[:2] == HEADER:
+        if len(payload) != UAS_MESSAGE.size:
+            raise ValueError("Bad message length: " + str(len(payload)))
+        _, _, msg_id, created, tag, x, y, z, velocity, status = UAS_MESSAGE.unpack(payload)
+        if status >= len(STATUS_NAMES):
+            raise ValueError("Unknown status: " + str(status))
+        return [hex(msg_id), [created, tag.rstrip(b'\0').decode(), [x, y, z], velocity, STATUS_NAMES[status]]]
+    if payload[:2] == TRACED_HEADER:
+        if len(payload) != UAS_TRACED_MESSAGE.size:
+            raise ValueError("Bad message length: " + str(len(payload)))
+        _, _, msg_id, created, tag, x, y, z, velocity, status, sent = UAS_TRACED_MESSAGE.unpack(payload)
+        if status >= len(STATUS_NAMES):
+            raise ValueError("Unknown status: " + str(status))
+        return [hex(msg_id), [created, tag.rstrip(b'\0').decode(), [x, y, z], velocity, STATUS_NAMES[status], sent]]
+    if len(payload) > 1 and payload[0] == MAGIC:
+        raise ValueError("Unsupported message version: " + str(payload[1]))
+    if legacy:
+        try:
+            return pickle.loads(payload)
+        except Exception:
+            raise ValueError("Unknown message header: " + payload[:2].hex())
+    raise ValueError("Unknown message header: " + payload[:2].hex())
+
+class PickleCodec():
+    """
+    Codec for network_sockets using pickle, the historical format. Only for trusted networks
+    """
+    def encode(self, message):
+        return pickle.dumps(message)
+
+    def decode(self, payload):
+        return pickle.loads(payload)
+
+class MsgpackCodec():
+    """
+    Codec for network_sockets using msgpack, a compact self describing format that is safe to decode.
+    Requires the msgpack package.
+    """
+    def __init__(self):
+        if msgpack is None:
+            raise RuntimeError("MsgpackCodec requires the msgpack package")
+
+    def encode(self, message):
+        return msgpack.packb(message, use_bin_type=True)
+
+    def decode(self, payload):
+        return msgpack.unpackb(payload, raw=False, use_list=True)
+
+class UasStructCodec():
+    """
+    Codec for network_sockets using the fixed width UAS_MESSAGE struct. Messages are [hex(msg_id), [created, tag, position, velocity, status]]
+    Messages with an unknown header are rejected with a ValueError, pickled ones too unless legacy is set.
+    """
+    def __init__(self, legacy=False):
+        self.legacy = legacy
+
+    def encode(self, message):
+        return encode(int(message[0], 16), message[1])
+
+    def decode(self, payload):
+        return decode(payload, self.legacy)
+
+class LazyMessage():
+    """
+    Received message decoded on first access, so handlers that ignore some messages do not pay for decoding them
+
+    .. note::
+
+       Indexing and len() go to the decoded message, the raw bytes stay available as payload.
+
+    """
+    __slots__ = ('codec', 'payload', '_value')
+
+    def __init__(self, codec, payload):
+        self.codec = codec
+        self.payload = payload
+        self._value = None
+
+    @property
+    def value(self):
+        if self._value is None:
+            self._value = self.codec.decode(self.payload)
+        return self._value
+
+    def __getitem__(self, key):
+        return self.value[key]
+
+    def __len__(self):
+        return len(self.value)
+
+def encode_message(codec, msg_id, message):
+    """
+    Encodes [hex(msg_id), message] for the wire, pickle when no codec is configured
+
+    Parameters
+    ----------
+    codec (object) - Codec with encode/decode, or None
+    msg_id (int) - Unique id for the message
+    message (object) - Message to be sent
+
+    Returns
+    --------
+    bytes_to_send (bytes) - Encoded message
+
+    """
+    if codec is None:
+        return pickle.dumps([hex(msg_id), message])
+    return codec.encode([hex(msg_id), message])
+
+def decode_message(codec, payload, lazy=False):
+    """
+    Decodes a received payload once for the callbacks, raw bytes when no codec is configured
+
+    Parameters
+    ----------
+    codec (object) - Codec with encode/decode, or None
+    payload (bytes) - Received payload
+    lazy (bool) - Return a LazyMessage instead of decoding now
+
+    Returns
+    --------
+    message (object) - Decoded message, LazyMessage or the raw payload
+
+    """
+    if codec is None:
+        return payload
+    if lazy:
+        return LazyMessage(codec, payload)
+    return codec.decode(payload)
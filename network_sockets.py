@@ -9,11 +9,173 @@ __version__ = "0.3"
 __maintainer__ = "Bruno Chianca Ferreira"
 __email__ = "brunobcf@gmail.com"
 
-import socket, os, math, struct, sys, json, traceback, zlib, fcntl, threading, time, pickle, distutils
-from apscheduler.schedulers.background import BackgroundScheduler
+import socket, os, math, struct, sys, json, traceback, zlib, fcntl, threading, time, pickle, queue, itertools
+import message_codec
+import telemetry
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeout
+
+# Sent instead of a frame length to switch a TcpPersistent connection to multiplexed '!II' (length, request id) frames
+MULTIPLEX_HELLO = 0xFFFFFFFF
+
+# Largest frame accepted by the TCP readers unless configured otherwise
+MAX_FRAME = 16 * 1024 * 1024
+
+def recv_into_exactly(connection, view):
+    """ Fills the whole memoryview from the socket, False if the peer closed the connection first """
+    while len(view):
+        received = connection.recv_into(view, 0, socket.MSG_WAITALL)
+        if received == 0: return False
+        view = view[received:]
+    return True
+
+def recv_exactly(connection, length):
+    """ 
+    Reads exactly length bytes into one preallocated buffer, without intermediate copies. None if the peer closed the connection first
+    MSG_WAITALL does not wait on sockets with a timeout, so partial reads are common and each one only fills the rest of the buffer.
+    """
+    payload = bytearray(length)
+    if not recv_into_exactly(connection, memoryview(payload)): return None
+    return payload
+
+def recv_payload(connection, length, max_frame=MAX_FRAME):
+    """ Reads the payload of a frame whose length prefix was already consumed, refusing frames above max_frame """
+    if length > max_frame:
+        raise ValueError("Frame of " + str(length) + " bytes exceeds the " + str(max_frame) + " bytes limit")
+    return recv_exactly(connection, length)
+
+def recv_frame(connection, max_frame=MAX_FRAME):
+    """
+    Reads one '!I' length prefixed frame
+
+    Parameters
+    ----------
+    connection (socket) - Connected stream socket
+    max_frame (int) - Largest accepted payload in bytes, larger frames raise ValueError
+
+    Returns
+    --------
+    payload (bytearray) - Payload without the length prefix, None if the peer closed the connection
+
+    """
+    lengthbuf = recv_exactly(connection, 4)
+    if lengthbuf is None: return None
+    length, = struct.unpack('!I', lengthbuf)
+    return recv_payload(connection, length, max_frame)
+
+class MultiplexedReply():
+    """ Handed to the TcpPersistent callback as connection for requests received on a multiplexed connection """
+
+    def __init__(self, connection, request_id, send_lock):
+        self.connection = connection
+        self.request_id = request_id
+        self.send_lock = send_lock
+
+    def reply(self, bytes_to_send):
+        with self.send_lock:
+            self.connection.sendall(struct.pack('!II', len(bytes_to_send), self.request_id) + bytes_to_send)
+
+class PersistentConnection():
+    """
+    Multiplexed client connection to one TcpPersistent peer.
+    Requests carry an id in the frame so any number of them can be in flight on the socket,
+    a reader thread matches responses back to the futures returned by request().
+    """
+
+    def __init__(self, destination, port, timeout, on_close, max_frame=MAX_FRAME):
+        self.destination = destination
+        self.max_frame = max_frame
+        self.on_close = on_close
+        self.socket = socket.create_connection((destination, port), timeout)
+        self.socket.settimeout(None)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket.sendall(struct.pack('!I', MULTIPLEX_HELLO))
+        self.send_lock = threading.Lock()
+        self.pending_lock = threading.Lock()
+        self.pending = {}
+        self.request_ids = itertools.count(1)
+        self.open = True
+        self.reader = threading.Thread(target=self.read_responses, daemon=True)
+        self.reader.start()
+
+    def request(self, bytes_to_send):
+        future = Future()
+        with self.pending_lock:
+            if not self.open:
+                raise ConnectionError("Connection to " + str(self.destination) + " closed")
+            request_id = next(self.request_ids) & 0xFFFFFFFF
+            self.pending[request_id] = future
+        try:
+            with self.send_lock:
+                self.socket.sendall(struct.pack('!II', len(bytes_to_send), request_id) + bytes_to_send)
+        except OSError:
+            self.close()
+            raise
+        future.request_id = request_id
+        future.connection = self
+        return future
+
+    def cancel(self, future):
+        with self.pending_lock:
+            self.pending.pop(future.request_id, None)
+
+    def read_responses(self):
+        try:
+            while True:
+                header = recv_exactly(self.socket, 8)
+                if header is None: break
+                length, request_id = struct.unpack('!II', header)
+                response = recv_payload(self.socket, length, self.max_frame)
+                if response is None: break
+                with self.pending_lock:
+                    future = self.pending.pop(request_id, None)
+                if future is not None:
+                    future.set_result(response)
+        except (OSError, ValueError):
+            pass
+        self.close()
+
+    def close(self):
+        with self.pending_lock:
+            if not self.open:
+                return
+            self.open = False
+            pending = self.pending
+            self.pending = {}
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+        for future in pending.values():
+            future.set_exception(ConnectionError("Connection to " + str(self.destination) + " closed"))
+        self.on_close(self)
+
 
 class TcpPersistent(threading.Thread):
-    def __init__(self, callback, debug=False, port=55123, interface=''):
+    def __init__(self, callback, debug=False, port=55123, interface='', workers=None, backlog=1000, reject=True, persistent=False, max_frame=MAX_FRAME, codec=None, lazy_decode=False):
+        """TcpPersistent socket class
+
+        Args:
+           callback (function): This function will be called when data is received
+           debug (bool): When set to true, more information is printed in stdout
+           port (int): Integer with port number to be used both to send and received data
+
+        Kwargs:
+           interface (str): Interface to where socket will be bind, it not set bind to every interface
+           workers (int): Size of the pool serving one-shot connections, one thread per connection when not set.
+                          Multiplexed connections always get their own thread, they would hold a pool worker for their whole life.
+           backlog (int): Accepted connections waiting for a worker before the pool is full
+           reject (bool): Close new connections when the pool is full, otherwise stop accepting until there is room
+           persistent (bool): send() keeps one multiplexed connection per destination instead of connecting per message.
+                              The server side accepts both kinds of connections regardless of this flag.
+                              Requests on one multiplexed connection are served one at a time, in the order received.
+           max_frame (int): Largest frame accepted from peers, in bytes. Payloads are handed to the callback as bytearrays.
+           codec (object): message_codec codec used to encode sent messages and decode received ones once, callbacks then get the decoded message.
+                           When not set messages are pickled and callbacks get the raw payload.
+           lazy_decode (bool): Hand callbacks a message_codec.LazyMessage decoded on first access
+
+        """
         threading.Thread.__init__(self)
         self.callback = callback
         self.debug = debug
@@ -22,6 +184,7 @@ class TcpPersistent(threading.Thread):
         self.running = True
         self.threads = []
         self.max_packet = 65535 #max packet size to listen
+        self.max_frame = max_frame
         try:
             self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -31,12 +194,74 @@ class TcpPersistent(threading.Thread):
             traceback.print_exc()
             print("Error: unable to open socket on ports '%d' " % (self.port))
             exit(0)
+        self.codec = codec
+        self.lazy_decode = lazy_decode
+        self.reject = reject
+        self.persistent = persistent
+        self.pool = {}
+        self.pool_lock = threading.Lock()
+        self.metrics_lock = threading.Lock()
+        self.active_workers = 0
+        self.rejected = 0
+        self.served = 0
+        self.service_time = 0.0
+        self.max_service_time = 0.0
+        self.frames_received = telemetry.counter("tcp_received", "Frames received by TcpPersistent")
+        self.connections_rejected = telemetry.counter("tcp_rejected", "Connections rejected by a full TcpPersistent pool")
+        self.decode_time = telemetry.histogram("tcp_decode_seconds", "Decode time of a received frame")
+        self.callback_time = telemetry.histogram("tcp_callback_seconds", "Callback duration of a received frame")
+        self.connections = None
+        if workers is not None:
+            self.connections = queue.Queue(maxsize=backlog)
+            for i in range(workers):
+                worker = threading.Thread(target=self.connection_worker, daemon=True)
+                worker.start()
+                self.threads.append(worker)
+
+    def metrics(self):
+        """ Snapshot of the connection pool counters, service times in seconds """
+        with self.metrics_lock:
+            return {"active_workers": self.active_workers,
+                    "queued_connections": self.connections.qsize() if self.connections is not None else 0,
+                    "rejected_connections": self.rejected,
+                    "served_connections": self.served,
+                    "mean_service_time": self.service_time / self.served if self.served else 0.0,
+                    "max_service_time": self.max_service_time,
+            }
+
+    def connection_worker(self):
+        """ Pool worker, serves queued connections until a None sentinel """
+        while True:
+            job = self.connections.get()
+            if job is None:
+                return
+            with self.metrics_lock:
+                self.active_workers += 1
+            start = time.perf_counter()
+            try:
+                self.connection_thread(*job)
+            except:
+                traceback.print_exc()
+            elapsed = time.perf_counter() - start
+            with self.metrics_lock:
+                self.active_workers -= 1
+                self.served += 1
+                self.service_time += elapsed
+                if elapsed > self.max_service_time:
+                    self.max_service_time = elapsed
 
     def stop(self):
         self.running = False
         bye = pickle.dumps(["bye"])
         self.send('127.0.0.1', bye , 255)
         self.server.close()
+        with self.pool_lock:
+            pool = list(self.pool.values())
+        for connection in pool:
+            connection.close()
+        if self.connections is not None:
+            for worker in self.threads:
+                self.connections.put(None)
 
     def shutdown(self):
         self.stop()
@@ -48,7 +273,10 @@ class TcpPersistent(threading.Thread):
             pass
     def respond(self, bytes_to_send, msg_id, connection):
         try:
-            bytes_to_send = pickle.dumps([hex(msg_id), bytes_to_send])
+            bytes_to_send = message_codec.encode_message(self.codec, msg_id, bytes_to_send)
+            if isinstance(connection, MultiplexedReply):
+                connection.reply(bytes_to_send)
+                return
             length = len(bytes_to_send)
             connection.sendall(struct.pack('!I', length))
             connection.sendall(bytes_to_send)
@@ -56,11 +284,73 @@ class TcpPersistent(threading.Thread):
         except:
             traceback.print_exc()
 
+    def get_connection(self, destination, timeout):
+        """ Pooled multiplexed connection to destination, opened on first use """
+        with self.pool_lock:
+            connection = self.pool.get(destination)
+            if connection is None or not connection.open:
+                connection = PersistentConnection(destination, self.port, timeout, self.drop_connection, self.max_frame)
+                self.pool[destination] = connection
+            return connection
+
+    def drop_connection(self, connection):
+        with self.pool_lock:
+            if self.pool.get(connection.destination) is connection:
+                del self.pool[connection.destination]
+
+    def send_async(self, destination, bytes_to_send, msg_id, timeout=4):
+        """
+        Pipelined send on the pooled connection to destination, does not wait for the response
+
+        Parameters
+        ----------
+        destination (str) - IP address of final destination
+        bytes_to_send (bytes) - Message to be sent, encoded with msg_id as in send()
+        msg_id (int) - Unique id for the message
+        timeout (int) - Connect timeout in seconds
+
+        Returns
+        --------
+        future (concurrent.futures.Future) - Resolves to the raw (not decoded) response, or raises ConnectionError
+
+        """
+        bytes_to_send = message_codec.encode_message(self.codec, msg_id, bytes_to_send)
+        return self.get_connection(destination, timeout).request(bytes_to_send)
+
+    def send_persistent(self, destination, bytes_to_send, msg_id, timeout=4):
+        """ send() over the pooled connection, same return values as the connect per message path """
+        future = None
+        try:
+            future = self.send_async(destination, bytes_to_send, msg_id, timeout)
+            return self.decode(future.result(timeout))
+        except ConnectionRefusedError:
+            return self.timeout_response()
+        except FutureTimeout:
+            future.connection.cancel(future)
+            if self.debug: print("Timeout waiting for response from: " + str(destination))
+        except:
+            traceback.print_exc()
+            if self.debug: print("Could not send data to: " + str(destination))
+
+    def decode(self, payload):
+        """ Decodes a received payload with the configured codec, None stays None """
+        if payload is None:
+            return None
+        return message_codec.decode_message(self.codec, payload, self.lazy_decode)
+
+    def timeout_response(self):
+        """ Response returned by send() when the peer refuses the connection """
+        if self.codec is None:
+            return pickle.dumps(['TIMEOUT'])
+        return ['TIMEOUT']
+
     def send(self, destination, bytes_to_send, msg_id, timeout=4):
         """ Send a message over a TCP link"""
+        if self.persistent:
+            return self.send_persistent(destination, bytes_to_send, msg_id, timeout)
         try:
             #print(bytes_to_send)
-            bytes_to_send = pickle.dumps([hex(msg_id), bytes_to_send])
+            bytes_to_send = message_codec.encode_message(self.codec, msg_id, bytes_to_send)
             sender_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             sender_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             sender_socket.settimeout(timeout)
@@ -69,23 +359,15 @@ class TcpPersistent(threading.Thread):
             sender_socket.sendall(struct.pack('!I', length))
             sender_socket.sendall(bytes_to_send)
             #sender_socket.send(bytes_to_send)
-            lengthbuf = sender_socket.recv(4)
-            length, = struct.unpack('!I', lengthbuf)
-            response = b''
-            while length:
-                newbuf = sender_socket.recv(length)
-                if not newbuf: return None
-                response += newbuf
-                length -= len(newbuf)
+            response = recv_frame(sender_socket, self.max_frame)
             #response = sender_socket.recv(self.max_packet)
             sender_socket.close()
             if response == None:
                 print("envianto Resposta nula")
-            return(response)
+            return(self.decode(response))
         except ConnectionRefusedError:
-            bytes_to_send = pickle.dumps(['TIMEOUT'])
             #bytes_to_send = pickle.dumps([hex(0), bytes_to_send])
-            return(bytes_to_send)
+            return(self.timeout_response())
             if self.debug: print("Could not send data to: " + str(destination))
         except:
             traceback.print_exc()
@@ -101,8 +383,20 @@ class TcpPersistent(threading.Thread):
                     sender_ip = str(address[0])
                     #self.callback(payload, sender_ip, connection)
                     #connection.close()
-                    connection_td = threading.Thread(target=self.connection_thread, args=(self.callback, connection, sender_ip))
-                    connection_td.start()
+                    if self.connections is None:
+                        connection_td = threading.Thread(target=self.connection_thread, args=(self.callback, connection, sender_ip))
+                        connection_td.start()
+                    elif self.reject:
+                        try:
+                            self.connections.put_nowait((self.callback, connection, sender_ip))
+                        except queue.Full:
+                            connection.close()
+                            with self.metrics_lock:
+                                self.rejected += 1
+                            self.connections_rejected.inc()
+                            if self.debug: print("Connection pool full, rejected " + sender_ip)
+                    else:
+                        self.connections.put((self.callback, connection, sender_ip))
                     #self.threads.append(connection_td)
                     continue
                 except socket.timeout:
@@ -116,26 +410,67 @@ class TcpPersistent(threading.Thread):
     def connection_thread(self, callback, connection, sender_ip):
 
         try:
-            lengthbuf = connection.recv(4)
+            lengthbuf = recv_exactly(connection, 4)
+            if lengthbuf is None: return None
             length, = struct.unpack('!I', lengthbuf)
-            payload = b''
-            while length:
-                newbuf = connection.recv(length)
-                if not newbuf: return None
-                payload += newbuf
-                length -= len(newbuf)
+            if length == MULTIPLEX_HELLO:
+                if self.connections is None:
+                    self.multiplexed_connection(callback, connection, sender_ip)
+                else:
+                    # Hand the connection to its own thread so the pool worker goes back to the one-shot connections
+                    multiplexed_td = threading.Thread(target=self.multiplexed_connection, args=(callback, connection, sender_ip), daemon=True)
+                    multiplexed_td.start()
+                return
+            payload = recv_payload(connection, length, self.max_frame)
+            if payload is None: return None
+            self.frames_received.inc()
             #payload = connection.recv(self.max_packet)
-            pickle.loads(payload)
+            start = self.decode_time.start()
+            if self.codec is None:
+                pickle.loads(payload)
+            payload = self.decode(payload)
+            start = self.decode_time.stop(start)
         except:
             traceback.print_exc()
             return
         callback(payload, sender_ip, connection)
+        self.callback_time.stop(start)
         #print(connection)
         #connection.sendall(response)
         #connection.close()
 
+    def multiplexed_connection(self, callback, connection, sender_ip):
+        """ 
+        Serves '!II' framed requests until the peer closes, responses are matched by request id
+        Requests are read and handed to the callback one at a time, a slow callback delays the next requests of the connection.
+        """
+        send_lock = threading.Lock()
+        try:
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            while self.running:
+                header = recv_exactly(connection, 8)
+                if header is None: break
+                length, request_id = struct.unpack('!II', header)
+                payload = recv_payload(connection, length, self.max_frame)
+                if payload is None: break
+                self.frames_received.inc()
+                try:
+                    start = self.decode_time.start()
+                    if self.codec is None:
+                        pickle.loads(payload)
+                    payload = self.decode(payload)
+                    start = self.decode_time.stop(start)
+                except:
+                    traceback.print_exc()
+                    continue
+                callback(payload, sender_ip, MultiplexedReply(connection, request_id, send_lock))
+                self.callback_time.stop(start)
+        except (OSError, ValueError):
+            if self.debug: traceback.print_exc()
+        connection.close()
+
 class TcpInterface(threading.Thread):
-    def __init__(self, callback, debug=False, port=55123, interface=''):
+    def __init__(self, callback, debug=False, port=55123, interface='', max_frame=MAX_FRAME, codec=None, lazy_decode=False):
         threading.Thread.__init__(self)
         self.callback = callback
         self.debug = debug
@@ -143,6 +478,9 @@ class TcpInterface(threading.Thread):
         self.interface = interface
         self.running = True
         self.max_packet = 65535 #max packet size to listen
+        self.max_frame = max_frame
+        self.codec = codec
+        self.lazy_decode = lazy_decode
         try:
             self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -161,7 +499,7 @@ class TcpInterface(threading.Thread):
     def send(self, destination, bytes_to_send, msg_id):
         """ Send a message over a TCP link"""
         try:
-            bytes_to_send = pickle.dumps([hex(msg_id), bytes_to_send])
+            bytes_to_send = message_codec.encode_message(self.codec, msg_id, bytes_to_send)
             sender_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             sender_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             sender_socket.settimeout(5)
@@ -186,17 +524,13 @@ class TcpInterface(threading.Thread):
                     connection, address = self.server.accept()
                     sender_ip = str(address[0])
                     try:
-                        lengthbuf = connection.recv(4)
-                        length, = struct.unpack('!I', lengthbuf)
-                        payload = b''
-                        while length:
-                            newbuf = connection.recv(length)
-                            if not newbuf: return None
-                            payload += newbuf
-                            length -= len(newbuf)
+                        payload = recv_frame(connection, self.max_frame)
                         #payload = connection.recv(self.max_packet) 
+                        if payload is not None:
+                            payload = message_codec.decode_message(self.codec, payload, self.lazy_decode)
+                            self.callback(payload, sender_ip, connection)
                     finally:
-                        pass
+                        connection.close()
                 except:
                     pass
         except:
@@ -211,7 +545,7 @@ class UdpInterface(threading.Thread):
        Each instance will be a separate thread with a open socket, thread runs in infinit loop and self.running must be set to False to end the thread.
 
     """
-    def __init__(self, callback, debug=False, port=55123, interface=''):
+    def __init__(self, callback, debug=False, port=55123, interface='', shared_socket=False, rcvbuf=None, queue_size=0, batch_size=64, codec=None, lazy_decode=False, stamped=False):
         """UdpInterface socket class
 
         Args:
@@ -221,6 +555,14 @@ class UdpInterface(threading.Thread):
 
         Kwargs:
            interface (str): Interface to where socket will be bind, it not set bind to every interface
+           shared_socket (bool): Send through the bound receive socket instead of a dedicated sender socket
+           rcvbuf (int): SO_RCVBUF size in bytes, kernel default when not set
+           queue_size (int): When set, received batches are queued (up to queue_size batches) and the callback runs on a separate thread
+           batch_size (int): Max datagrams drained per wakeup in queued mode
+           codec (object): message_codec codec used to encode sent messages and decode received ones once, callbacks then get the decoded message.
+                           When not set messages are pickled and callbacks get the raw payload.
+           lazy_decode (bool): Hand callbacks a message_codec.LazyMessage decoded on first access
+           stamped (bool): Call back with the receive time of the datagram (time.time()) as a fourth argument, for traces
 
         """
         threading.Thread.__init__(self)
@@ -230,6 +572,8 @@ class UdpInterface(threading.Thread):
         self.interface = interface
         self.running = True
         self.max_packet = 65535 #max packet size to listen
+        self.codec = codec
+        self.lazy_decode = lazy_decode
         try:
             self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -238,6 +582,47 @@ class UdpInterface(threading.Thread):
         except OSError:
             print("Error: unable to open socket on ports '%d' " % (self.port))
             exit(0)
+        if rcvbuf is not None:
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        self.batch_size = batch_size
+        self.received = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.max_queue_depth = 0
+        self.stamped = stamped
+        self.packets_received = telemetry.counter("udp_received", "Datagrams received by UdpInterface")
+        self.packets_sent = telemetry.counter("udp_sent", "Datagrams sent by UdpInterface")
+        self.packets_dropped = telemetry.counter("udp_dropped", "Datagrams dropped by a full UdpInterface queue")
+        self.packets_rejected = telemetry.counter("udp_rejected", "Datagrams the codec could not decode, dropped")
+        self.decode_time = telemetry.histogram("udp_decode_seconds", "Decode time of a received datagram")
+        self.callback_time = telemetry.histogram("udp_callback_seconds", "Callback duration of a received datagram")
+        self.queue = None
+        if queue_size > 0:
+            self.queue = queue.Queue(maxsize=queue_size)
+            self.worker = threading.Thread(target=self.callback_worker, daemon=True)
+        self.shared_socket = shared_socket
+        self.sender_lock = threading.Lock()
+        if self.shared_socket:
+            self.sender = self.server
+        else:
+            self.sender = self._open_sender()
+
+    def _open_sender(self):
+        """ 
+        Opens the long lived socket used to send datagrams
+
+        Parameters
+        ----------
+
+        Returns
+        --------
+        sender_socket (socket) - Unbound UDP socket with broadcast enabled
+
+        """
+        sender_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sender_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        return sender_socket
 
     def stop(self):
         """ 
@@ -252,8 +637,16 @@ class UdpInterface(threading.Thread):
         """
         self.running = False
         bye = pickle.dumps('bye'.encode())
-        self.send('127.0.0.1', bye, 255)
+        self.send_bytes('127.0.0.1', message_codec.encode_message(None, 255, bye))
         self.server.close()
+        if not self.shared_socket:
+            self.sender.close()
+        if self.queue is not None:
+            try:
+                self.queue.put_nowait(None)
+            except queue.Full:
+                # The worker also ends once running is unset and the queue is drained
+                pass
 
     def shutdown(self):
         """ 
@@ -271,18 +664,19 @@ class UdpInterface(threading.Thread):
     def __del__(self):
         try:
             self.server.close()
+            self.sender.close()
         except:
             pass
 
     def send(self, destination, msg_to_send, msg_id):
         """ 
         Send a message over a UDP link. 
-        The message is pickled and sent over a UDP socket
+        The message is encoded with the configured codec (pickled by default) and sent over a UDP socket
 
         Parameters
         ----------
         destination (str) - IP address of final destination
-        msg_to_send (str) - Unpickled message to be sent
+        msg_to_send (str) - Unencoded message to be sent
         msg_id (binary) - Unique id for the message CRC32
 
         Returns
@@ -290,17 +684,78 @@ class UdpInterface(threading.Thread):
 
         """
         try:
-            bytes_to_send = pickle.dumps([hex(msg_id), msg_to_send])
-            sender_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            sender_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            sender_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-            sender_socket.sendto(bytes_to_send,(destination, self.port) )
-            #TODO: Keep socket open?
-            sender_socket.close()
+            bytes_to_send = message_codec.encode_message(self.codec, msg_id, msg_to_send)
+        except:
+            #traceback.print_exc()
+            if self.debug: print("Could not send data to: " + str(destination))
+            return
+        self.send_bytes(destination, bytes_to_send)
+
+    def send_bytes(self, destination, bytes_to_send):
+        """ 
+        Send an already encoded message over a UDP link. 
+
+        Parameters
+        ----------
+        destination (str) - IP address of final destination
+        bytes_to_send (bytes) - Encoded message to be sent
+
+        Returns
+        --------
+
+        """
+        try:
+            self.sender.sendto(bytes_to_send,(destination, self.port) )
+            self.packets_sent.inc()
         except:
             #traceback.print_exc()
             if self.debug: print("Could not send data to: " + str(destination))
 
+    def send_many(self, destination, messages):
+        """ 
+        Send a burst of already encoded messages over a UDP link. 
+        The burst holds the sender socket once, so concurrent bursts are not interleaved.
+
+        Parameters
+        ----------
+        destination (str) - IP address of final destination
+        messages (list) - Encoded messages (bytes) to be sent
+
+        Returns
+        --------
+        sent (int) - Number of datagrams handed to the kernel
+
+        """
+        sent = 0
+        address = (destination, self.port)
+        sendto = self.sender.sendto
+        with self.sender_lock:
+            for bytes_to_send in messages:
+                try:
+                    sendto(bytes_to_send, address)
+                    sent += 1
+                except:
+                    #traceback.print_exc()
+                    if self.debug: print("Could not send data to: " + str(destination))
+        self.packets_sent.inc(sent)
+        return sent
+
+    def queue_depth(self):
+        """ 
+        Number of received batches waiting for the callback
+
+        Parameters
+        ----------
+
+        Returns
+        --------
+        depth (int) - Current queue depth, 0 when not running in queued mode
+
+        """
+        if self.queue is None:
+            return 0
+        return self.queue.qsize()
+
     def run(self):
         """ 
         Opens a UDP socket
@@ -313,15 +768,131 @@ class UdpInterface(threading.Thread):
         --------
 
         """
+        if self.queue is not None:
+            self.run_batched()
+            return
         try:
             while self.running:
                 try:
                     payload, address = self.server.recvfrom(self.max_packet)
+                    received_at = time.time()
+                    self.packets_received.inc()
                     sender_ip = str(address[0])
                     if self.debug: print(payload)
-                    self.callback(payload, sender_ip, None)
+                    start = self.decode_time.start()
+                    try:
+                        payload = message_codec.decode_message(self.codec, payload, self.lazy_decode)
+                    except ValueError:
+                        self.reject(payload)
+                        continue
+                    start = self.decode_time.stop(start)
+                    if self.stamped:
+                        self.callback(payload, sender_ip, None, received_at)
+                    else:
+                        self.callback(payload, sender_ip, None)
+                    self.callback_time.stop(start)
                 except:
                     traceback.print_exc()
                     print("Error receiving UDP data.")
         except StopIteration:
-            traceback.print_exc()
\ No newline at end of file
+            traceback.print_exc()
+
+    def run_batched(self):
+        """ 
+        Receive loop of the queued mode.
+        Each wakeup drains up to batch_size datagrams, without blocking after the first one, and queues them as one batch.
+        When the queue is full the batch is dropped and counted.
+
+        Parameters
+        ----------
+
+        Returns
+        --------
+
+        """
+        self.worker.start()
+        recvfrom = self.server.recvfrom
+        while self.running:
+            batch = []
+            try:
+                # Each datagram gets its own bytes object, it stays queued until the callback is done with it
+                payload, address = recvfrom(self.max_packet)
+                batch.append((payload, str(address[0]), time.time()))
+                while len(batch) < self.batch_size:
+                    payload, address = recvfrom(self.max_packet, socket.MSG_DONTWAIT)
+                    batch.append((payload, str(address[0]), time.time()))
+            except BlockingIOError:
+                pass
+            except:
+                if self.running:
+                    traceback.print_exc()
+                    print("Error receiving UDP data.")
+            if len(batch) == 0:
+                continue
+            self.received += len(batch)
+            self.packets_received.inc(len(batch))
+            try:
+                self.queue.put_nowait(batch)
+            except queue.Full:
+                self.dropped += len(batch)
+                self.packets_dropped.inc(len(batch))
+                if self.debug: print("UDP queue full, dropped " + str(len(batch)) + " datagrams")
+            depth = self.queue.qsize()
+            if depth > self.max_queue_depth:
+                self.max_queue_depth = depth
+
+    def reject(self, payload):
+        """ 
+        Drops a datagram the codec rejected (unknown header, or pickle without legacy decoding) and counts it
+
+        Parameters
+        ----------
+        payload (bytes) - Received datagram
+
+        Returns
+        --------
+
+        """
+        self.rejected += 1
+        self.packets_rejected.inc()
+        if self.debug: print("Rejected UDP datagram: " + payload[:2].hex())
+
+    def callback_worker(self):
+        """ 
+        Hands queued batches to the callback, one datagram at a time
+        Ends on the None sentinel, or when the queue is empty after stop()
+
+        Parameters
+        ----------
+
+        Returns
+        --------
+
+        """
+        while True:
+            try:
+                batch = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                if not self.running:
+                    return
+                continue
+            if batch is None:
+                return
+            for payload, sender_ip, received_at in batch:
+                try:
+                    if self.debug: print(payload)
+                    start = self.decode_time.start()
+                    try:
+                        payload = message_codec.decode_message(self.codec, payload, self.lazy_decode)
+                    except ValueError:
+                        self.reject(payload)
+                        continue
+                    start = self.decode_time.stop(start)
+                    if self.stamped:
+                        self.callback(payload, sender_ip, None, received_at)
+                    else:
+                        self.callback(payload, sender_ip, None)
+                    self.callback_time.stop(start)
+                except:
+                    traceback.print_exc()
+                    print("Error handling UDP data.")
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+"""
+Shared-memory position feed between the emulator and the GPSBridge of each aircraft
+One memory-mapped file holds a slot per aircraft, each protected by a sequence lock, so a poll is a plain memory read.
+"""
+__author__ = "Bruno Chianca Ferreira"
+__license__ = "MIT"
+__version__ = "0.1"
+__maintainer__ = "Bruno Chianca Ferreira"
+__email__ = "brunobcf@gmail.com"
+
+import os
+import mmap
+import time
+import struct
+
+MAGIC = b'GPSF'
+VERSION = 1
+DEFAULT_PATH = ('/dev/shm' if os.path.isdir('/dev/shm') else '/tmp') + '/uas_gps.feed'
+# magic, version, number of slots. Native byte order, the feed never leaves the host
+HEADER = struct.Struct('=4sB3xI')
+# sequence, aircraft tag, position x/y/z, time of the fix (time.time()), padded to 64 bytes
+SLOT = struct.Struct('=Q16s4d8x')
+SEQUENCE = struct.Struct('=Q')
+FIX = struct.Struct('=4d')
+TAG = struct.Struct('=16s')
+TAG_SIZE = 16
+# Reads given up on a slot left odd, e.g. by a writer that died mid-write
+MAX_RETRIES = 100000
+
+
+def _offset(slot):
+  return HEADER.size + slot * SLOT.size
+
+
+class PositionFeedWriter():
+  """
+  Single writer of a position feed, e.g. the emulator
+
+  .. note::
+
+      A write makes the slot sequence odd, copies the fix, then makes it even again. Slots are given to
+      aircraft in order of their first write. Only one process may write a feed.
+      An existing feed is reused in place and only ever grown, never truncated: readers still mapping it from a
+      previous writer would get SIGBUS on the pages cut off. Its slots are cleared under their sequence lock.
+
+  """
+  def __init__(self, path=DEFAULT_PATH, slots=1024):
+    """PositionFeedWriter
+
+    Args:
+
+    Kwargs:
+        path (str) - Feed file, created or reused
+        slots (int) - Max aircraft in the feed
+
+    """
+    self.path = path
+    self.slots = slots
+    self.tags = {}
+    self.file = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o644), 'r+b')
+    if os.fstat(self.file.fileno()).st_size < _offset(slots):
+      os.ftruncate(self.file.fileno(), _offset(slots))
+    self.memory = mmap.mmap(self.file.fileno(), _offset(slots))
+    for slot in range(slots):
+      self._clear(_offset(slot))
+    HEADER.pack_into(self.memory, 0, MAGIC, VERSION, slots)
+
+  def _clear(self, offset):
+    """ Empties a slot left by a previous writer, readers see its tag change and look for their slot again """
+    sequence, = SEQUENCE.unpack_from(self.memory, offset)
+    if sequence == 0:
+      return
+    # A writer that died mid-write left the sequence odd
+    sequence += sequence & 1
+    SEQUENCE.pack_into(self.memory, offset, sequence + 1)
+    self.memory[offset + SEQUENCE.size:offset + SLOT.size] = bytes(SLOT.size - SEQUENCE.size)
+    SEQUENCE.pack_into(self.memory, offset, sequence + 2)
+
+  def slot(self, tag):
+    """ Slot of an aircraft, allocated on first use """
+    slot = self.tags.get(tag)
+    if slot is None:
+      if len(self.tags) == self.slots:
+        raise ValueError("Position feed full, " + str(self.slots) + " slots")
+      encoded = tag.encode()
+      if len(encoded) > TAG_SIZE:
+        raise ValueError("Aircraft tag longer than " + str(TAG_SIZE) + " bytes: " + tag)
+      slot = self.tags[tag] = len(self.tags)
+      offset = _offset(slot)
+      sequence, = SEQUENCE.unpack_from(self.memory, offset)
+      SEQUENCE.pack_into(self.memory, offset, sequence + 1)
+      TAG.pack_into(self.memory, offset + SEQUENCE.size, encoded)
+      SEQUENCE.pack_into(self.memory, offset, sequence + 2)
+    return slot
+
+  def write(self, tag, position, stamp=None):
+    """
+    Publishes the position of an aircraft
+
+    Parameters
+    ----------
+    tag (str) - Aircraft tag
+    position (list) - [x, y, z]
+    stamp (float) - Time of the fix, time.time() when not given
+
+    Returns
+    --------
+
+    """
+    offset = _offset(self.slot(tag))
+    sequence, = SEQUENCE.unpack_from(self.memory, offset)
+    SEQUENCE.pack_into(self.memory, offset, sequence + 1)
+    FIX.pack_into(self.memory, offset + SEQUENCE.size + TAG_SIZE, position[0], position[1], position[2], time.time() if stamp is None else stamp)
+    SEQUENCE.pack_into(self.memory, offset, sequence + 2)
+
+  def close(self):
+    self.memory.close()
+    self.file.close()
+
+
+class PositionFeedReader():
+  """
+  Reader of one aircraft slot of a position feed
+
+  .. note::
+
+      read() retries while the slot sequence is odd or changed during the copy, so it never returns a torn fix.
+      This relies on stores reaching memory in program order, as on x86.
+
+  """
+  def __init__(self, tag, path=DEFAULT_PATH):
+    """PositionFeedReader
+
+    Args:
+        tag (str) - Aircraft tag
+
+    Kwargs:
+        path (str) - Feed file
+
+    """
+    self.tag = tag
+    self.encoded = tag.encode().ljust(TAG_SIZE, b'\0')
+    self.path = path
+    self.file = open(path, 'rb')
+    self.memory = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, self.slots = HEADER.unpack_from(self.memory, 0)
+    if magic != MAGIC or version != VERSION:
+      raise ValueError("Not a position feed: " + path)
+    self.offset = None
+    self.retries = 0
+
+  def find(self):
+    """ Looks for the slot of the aircraft, False while the writer has not published it """
+    # A new writer may have changed the number of slots, the file only grows past this mapping
+    _, _, slots = HEADER.unpack_from(self.memory, 0)
+    self.slots = min(slots, (len(self.memory) - HEADER.size) // SLOT.size)
+    for slot in range(self.slots):
+      offset = _offset(slot)
+      sequence, tag = struct.unpack_from('=Q16s', self.memory, offset)
+      if tag == self.encoded:
+        self.offset = offset
+        return True
+      if sequence == 0:
+        return False
+    return False
+
+  def read(self):
+    """
+    Latest fix of the aircraft
+
+    Parameters
+    ----------
+
+    Returns
+    --------
+    fix (tuple) - (position [x, y, z], time of the fix), None when the aircraft is not in the feed yet or the slot stays locked
+
+    """
+    if self.offset is None and not self.find():
+      return None
+    memory, offset = self.memory, self.offset
+    for attempt in range(MAX_RETRIES):
+      before, tag, x, y, z, stamp = SLOT.unpack_from(memory, offset)
+      if before & 1 == 0 and SEQUENCE.unpack_from(memory, offset)[0] == before:
+        if tag != self.encoded:
+          # The feed was recreated by a new writer, slots may have moved
+          self.offset = None
+          return None
+        if stamp == 0.0:
+          return None
+        return [x, y, z], stamp
+      self.retries += 1
+    return None
+
+  def close(self):
+    self.memory.close()
+    self.file.close()
@@ -24,12 +24,143 @@ for libname in libnames:
 
 import os, math, struct, sys, json, traceback, time, argparse, statistics, shutil, warnings
 import uuid
+import concurrent.futures
 import matplotlib.pyplot as plt
 import numpy as np
 pd = pandas
 warnings.filterwarnings("ignore")
 import numpy_indexed as npi
 
+# Columns written by UASClient and UTMServer in every tower*/uas* csv
+CSV_COLUMNS = ["time", "created", "id", "aircraft", "position", "vel", "status"]
+CSV_DTYPES = {"time": "int64", "created": "int64", "id": str, "aircraft": "category", "position": str, "vel": str, "status": "category"}
+
+# Hop by hop traces written by UTMServer --trace in <tower>.trace.csv, wall clock stamps in us
+TRACE_STAGES = ["send", "receive", "decode", "put", "watch", "history"]
+# Intervals of the per stage breakdown, (stage, from stamp, to stamp)
+TRACE_INTERVALS = [("client", "created", "send"), ("network", "send", "receive"), ("decode", "receive", "decode"),
+                   ("write queue", "decode", "put"), ("etcd", "put", "watch"), ("history", "watch", "history")]
+
+# Consolidated per-run summary kept in the --plot folder
+RUNS_INDEX = "runs_index.csv"
+RUNS_COLUMNS = ["rep", "run", "delay", "mtime", "mean_latency", "median_latency", "stdev_latency"]
+REPORT_METRICS = {"Mean latency": "mean_latency", "Median latency": "median_latency", "Latency std dev": "stdev_latency"}
+
+def parse_run(path):
+    """ Reads the latency summary of one archived report.txt """
+    metrics = {}
+    with open(path, "r") as report_file:
+        for line in report_file:
+            name = line.split(":")[0]
+            if name in REPORT_METRICS:
+                metrics[REPORT_METRICS[name]] = float(line.split(":")[1].strip().split(" ")[0])
+    return metrics
+
+# Percentiles reported per tower and per aircraft in --stream mode
+STREAM_PERCENTILES = [0.5, 0.9, 0.99, 0.999]
+
+class RunningStats ():
+    """ Mergeable running count/mean/variance (Welford, Chan et al. for merging) """
+
+    def __init__ (self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, values):
+        count = len(values)
+        if count == 0:
+            return
+        mean = float(np.mean(values))
+        m2 = float(np.sum(np.square(values - mean)))
+        self.combine(count, mean, m2)
+
+    def merge(self, other):
+        self.combine(other.count, other.mean, other.m2)
+
+    def combine(self, count, mean, m2):
+        if count == 0:
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta * delta * self.count * count / total
+        self.count = total
+
+    def stdev(self):
+        if self.count < 2:
+            return float("nan")
+        return math.sqrt(self.m2 / (self.count - 1))
+
+class QuantileSketch ():
+    """ Mergeable log-bucketed quantile sketch with bounded relative error (DDSketch style) """
+
+    def __init__ (self, relative_accuracy=0.005, min_value=1e-3):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.min_value = min_value
+        self.positive = {}
+        self.negative = {}
+        self.zero = 0
+        self.count = 0
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        positive = values[values > self.min_value]
+        negative = -values[values < -self.min_value]
+        self.zero += len(values) - len(positive) - len(negative)
+        self.count += len(values)
+        for store, _values in ((self.positive, positive), (self.negative, negative)):
+            if len(_values) == 0:
+                continue
+            keys, counts = np.unique(np.ceil(np.log(_values) / self.log_gamma).astype(np.int64), return_counts=True)
+            for key, count in zip(keys.tolist(), counts.tolist()):
+                store[key] = store.get(key, 0) + count
+
+    def merge(self, other):
+        for store, _store in ((self.positive, other.positive), (self.negative, other.negative)):
+            for key, count in _store.items():
+                store[key] = store.get(key, 0) + count
+        self.zero += other.zero
+        self.count += other.count
+
+    def value(self, key):
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def quantile(self, q):
+        if self.count == 0:
+            return float("nan")
+        rank = q * (self.count - 1)
+        seen = 0
+        for key in sorted(self.negative.keys(), reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                return -self.value(key)
+        seen += self.zero
+        if seen > rank:
+            return 0.0
+        for key in sorted(self.positive.keys()):
+            seen += self.positive[key]
+            if seen > rank:
+                return self.value(key)
+        return self.value(max(self.positive.keys()))
+
+def stream_latency_file(path, chunksize):
+    """ Latency stats and sketches of one tower csv read chunk by chunk, overall and per aircraft """
+    overall = (RunningStats(), QuantileSketch())
+    aircrafts = {}
+    chunks = pd.read_csv(path, sep=";", usecols=["time", "created", "aircraft"], dtype={"time": "int64", "created": "int64", "aircraft": str}, chunksize=chunksize)
+    for chunk in chunks:
+        latency = ((chunk["time"] - chunk["created"]) / 1000).to_numpy()
+        overall[0].add(latency)
+        overall[1].add(latency)
+        for aircraft, index in chunk.groupby("aircraft", sort=False).indices.items():
+            if aircraft not in aircrafts:
+                aircrafts[aircraft] = (RunningStats(), QuantileSketch())
+            aircrafts[aircraft][0].add(latency[index])
+            aircrafts[aircraft][1].add(latency[index])
+    return overall, aircrafts
+
 class Report ():
 
     def __init__ (self,folder, files):
@@ -41,6 +172,10 @@ class Report ():
         #print(self.files)
         self.tower_files = {}
         self.aircraft_files = {}
+        self.tower_paths = {}
+        self.trace_paths = {}
+        self.towers = None
+        self.aircrafts = None
         if arguments.plot:
             rep = self.pre_overall(arguments.plot)
             #self.folder = arguments.plot
@@ -49,6 +184,7 @@ class Report ():
             sys.exit(1)
         self.open_files(files)
         self.latency()
+        self.trace_breakdown()
         self.delivery()
         self.report_file.flush()
         self.report_file.close()
@@ -116,55 +252,54 @@ class Report ():
         plt.close()
         #plt.show()
 
+    def aggregate_runs(self, folder, _reports):
+        """ Returns one row of metrics per archived run, parsing only runs missing from the index """
+        index_file = folder + RUNS_INDEX
+        try:
+            runs = pd.read_csv(index_file, dtype={"rep": str, "run": str})
+        except (FileNotFoundError, pd.errors.EmptyDataError):
+            runs = pd.DataFrame(columns=RUNS_COLUMNS)
+        known = {}
+        for row in runs[["rep", "run", "mtime"]].itertuples(index=False):
+            known[(row.rep, row.run)] = row.mtime
+        pending = []
+        for rep, folders in _reports.items():
+            for report in folders:
+                path = folder + rep + "/" + report + "/report.txt"
+                try:
+                    mtime = os.stat(path).st_mtime_ns
+                except FileNotFoundError:
+                    continue
+                if known.get((rep, report)) != mtime:
+                    pending.append((rep, report, path, mtime))
+        if len(pending) > 0:
+            print("Parsing " + str(len(pending)) + " new runs")
+            with concurrent.futures.ProcessPoolExecutor(max_workers=arguments.jobs) as executor:
+                parsed = list(executor.map(parse_run, [run[2] for run in pending], chunksize=16))
+            rows = []
+            for (rep, report, path, mtime), metrics in zip(pending, parsed):
+                row = {"rep": rep, "run": report, "delay": float(report.split("-")[1]), "mtime": mtime}
+                row.update(metrics)
+                rows.append(row)
+            stale = set((run[0], run[1]) for run in pending)
+            keep = [(rep, run) not in stale for rep, run in zip(runs["rep"], runs["run"])]
+            runs = pd.concat([runs[keep], pd.DataFrame(rows, columns=RUNS_COLUMNS)], ignore_index=True)
+            runs.to_csv(index_file, index=False)
+        return runs
+
     def overall(self, _reports):
         markers = ["o","x","^","<",">","1","2","3","4",".",",","v"]
         mark = 0
         self.data = []
         self.legendlabels = []
+        runs = self.aggregate_runs(arguments.plot, _reports)
         for rep, folders in _reports.items():
-            #folders = []
-            reports = {}
-            delays = []
-            latency = []
-            stdev = []
-            
-            #print(arguments.plot+ str(rep))
-            #self.overall(self.folder + rep)
-        #for (dirpath, dirnames, filenames) in os.walk(folder):
-        #    folders.extend(dirnames)
-        #    break
-        #print(folders)
-            for report in folders:
-                delay = float(report.split("-")[1])
-                #print(delay)
-                #print(float(report.split("-")[1]))
-                if delay not in reports:
-                    reports[delay] = []
-                    reports[delay].append(report)
-                else:
-                    reports[delay].append(report)
-        #print(reports)
+            _runs = runs[(runs["rep"] == rep) & runs["run"].isin(folders)]
+            summary = _runs.groupby("delay", sort=True)["median_latency"].agg(["mean", "std"])
+            delays = list(summary.index)
+            latency = list(summary["mean"])
+            stdev = list(summary["std"])
             self.legendlabels.append(rep)
-            for delay, reports in sorted(reports.items()):
-                #print(delay)
-                if delay not in delays:
-                    delays.append(delay)
-                #print(delay)
-                #print(reports)
-                _latency = []
-                for report in reports:
-                    #print(self.folder + rep + "/"+ report + "/report.txt")
-                    #sys.exit(1)
-                    self.report_file = open(arguments.plot + rep + "/"+ report + "/report.txt","r")
-                    info = self.report_file.readlines()
-                    for line in info:
-                        if line.split(":")[0] == "Median latency":
-                            l = float(line.split(":")[1].split(" ")[0])
-                            #print(l)
-                            _latency.append(l)
-                    #sys.exit(1)
-                latency.append(statistics.mean(_latency))
-                stdev.append(statistics.stdev(_latency))
             #print(latency)
             #print(stdev)
             self.data.append(self.ax.scatter(delays,latency,s=70,color='k',marker=markers[mark]))
@@ -174,71 +309,135 @@ class Report ():
             self.ax.set_ylim([0, 300])
 
 
+    def percentiles(self, sketch):
+        return " ".join("p" + format(q * 100, "g") + ": " + str(sketch.quantile(q)) + " ms" for q in STREAM_PERCENTILES)
+
+    def stream_latency(self):
+        """ Latency statistics in bounded memory, one tower file per worker and merged sketches """
+        overall = (RunningStats(), QuantileSketch())
+        aircrafts = {}
+        towers = list(self.tower_files.keys())
+        paths = [self.tower_paths[tower] for tower in towers]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=arguments.jobs) as executor:
+            results = list(executor.map(stream_latency_file, paths, [arguments.chunksize] * len(paths)))
+        for tower, (_overall, _aircrafts) in zip(towers, results):
+            overall[0].merge(_overall[0])
+            overall[1].merge(_overall[1])
+            for aircraft, (stats, sketch) in _aircrafts.items():
+                if aircraft not in aircrafts:
+                    aircrafts[aircraft] = (RunningStats(), QuantileSketch())
+                aircrafts[aircraft][0].merge(stats)
+                aircrafts[aircraft][1].merge(sketch)
+        self.report_file.write("Mean latency:\t" + str(overall[0].mean) + " ms" + '\n')
+        self.report_file.write("Median latency:\t" + str(overall[1].quantile(0.5)) + " ms"+ '\n')
+        self.report_file.write("Latency std dev:" + str(overall[0].stdev()) + " ms" + '\n')
+        self.report_file.write("Latency percentiles:\t" + self.percentiles(overall[1]) + '\n')
+        for tower, (_overall, _aircrafts) in zip(towers, results):
+            self.report_file.write("Tower: " + str(tower) + " latency " + self.percentiles(_overall[1]) + '\n')
+        for aircraft, (stats, sketch) in sorted(aircrafts.items()):
+            self.report_file.write("Aircraft: " + str(aircraft) + " latency " + self.percentiles(sketch) + '\n')
+
     def latency(self):
-        latency = []
-        for key,value in self.tower_files.items():
-            for line in value:
-                line = line.split(";")
-                latency.append((int(line[0]) - int(line[1])) / 1000)
-                #print(str(latency / 1000) + "ms")
-        #print("Mean latency:\t" + str(statistics.mean(latency)) + " ms")
-        self.report_file.write("Mean latency:\t" + str(statistics.mean(latency)) + " ms" + '\n')
-        self.report_file.write("Median latency:\t" + str(statistics.median(latency)) + " ms"+ '\n')
-        self.report_file.write("Latency std dev:" + str(statistics.stdev(latency)) + " ms" + '\n')
-        #print("Median latency:\t" + str(statistics.median(latency)) + " ms")
-        #print("Latency std dev:" + str(statistics.stdev(latency)) + " ms")
+        if arguments.stream:
+            self.stream_latency()
+            return
+        towers = self.towers
+        latency = (towers["time"] - towers["created"]) / 1000
+        #print("Mean latency:\t" + str(latency.mean()) + " ms")
+        self.report_file.write("Mean latency:\t" + str(float(latency.mean())) + " ms" + '\n')
+        self.report_file.write("Median latency:\t" + str(float(latency.median())) + " ms"+ '\n')
+        self.report_file.write("Latency std dev:" + str(float(latency.std(ddof=1))) + " ms" + '\n')
+        #print("Median latency:\t" + str(latency.median()) + " ms")
+        #print("Latency std dev:" + str(latency.std()) + " ms")
+
+    def trace_breakdown(self):
+        """ Latency per stage of the traced updates, where the time between created and the remote history goes """
+        if len(self.trace_paths) == 0:
+            return
+        frames = [pd.read_csv(path, sep=";", usecols=["created"] + TRACE_STAGES, dtype="int64") for path in self.trace_paths.values()]
+        traces = pd.concat(frames, ignore_index=True)
+        # Updates whose trace misses a stage, e.g. untraced clients
+        traces = traces[(traces[TRACE_STAGES] > 0).all(axis=1)]
+        self.report_file.write("Traced updates: " + str(len(traces)) + '\n')
+        if len(traces) == 0:
+            return
+        total = (traces["history"] - traces["created"]) / 1000
+        for stage, start, end in TRACE_INTERVALS:
+            latency = (traces[end] - traces[start]) / 1000
+            self.report_file.write("Stage " + stage + " (" + start + " -> " + end + "):\tmean " + str(float(latency.mean())) + " ms median " + str(float(latency.median()))
+                                   + " ms p99 " + str(float(latency.quantile(0.99))) + " ms, " + format(latency.mean() / total.mean() * 100, ".1f") + " % of the total" + '\n')
+        self.report_file.write("Stage total (created -> history):\tmean " + str(float(total.mean())) + " ms median " + str(float(total.median()))
+                               + " ms p99 " + str(float(total.quantile(0.99))) + " ms" + '\n')
+
+    def index_deliveries(self):
+        """ Number of distinct towers that received each message id """
+        towers = self.towers[["id", "tower"]].drop_duplicates()
+        return towers.groupby("id", sort=False, observed=True)["tower"].size()
 
     def delivery(self):
-        messages = {}
-        delivered  = {}
-        sent = {}
-        for key,value in self.aircraft_files.items():
-            sent[key] = len(value)
-            delivered[key] = 0
-            #print("Aircraft: " + str(key) + " sent " + str(sent[key]) + " messages")
-            self.report_file.write("Aircraft: " + str(key) + " sent " + str(sent[key]) + " messages"+ '\n')
-            for line in value:
-                line = line.split(";")
-                message_id = line[2]
-                messages[message_id] = []
-                for _key,_value in self.tower_files.items():
-                    for _line in _value:
-                        _line = _line.split(";")
-                        _message_id = _line[2]
-                        if _message_id == message_id:
-                            if len(messages[message_id]) == 0:
-                                #print(messages[message_id])
-                                delivered[key] +=1
-                            messages[message_id].append(_key)
-                            break
-            #print("Aircraft: " + str(key) + " delivered " + str(delivered[key]) + " messages")
-            #print("Delivery rate: " + str( (delivered[key] / sent[key]) * 100 ) + " %")
-            self.report_file.write("Aircraft: " + str(key) + " delivered " + str(delivered[key]) + " messages"+ '\n')
-            self.report_file.write("Delivery rate: " + str( (delivered[key] / sent[key]) * 100 ) + " %" + '\n')
-        
-        #print(messages)
+        index = self.index_deliveries()
+        aircrafts = self.aircrafts[["aircraft_file", "id"]]
+        reached = aircrafts["id"].map(index).fillna(0).astype("int64")
+        sent = aircrafts.groupby("aircraft_file", sort=False, observed=True).size()
+        delivered = (reached > 0).groupby(aircrafts["aircraft_file"], sort=False, observed=True).sum()
+        for key in self.aircraft_files.keys():
+            _sent = int(sent.get(key, 0))
+            _delivered = int(delivered.get(key, 0))
+            #print("Aircraft: " + str(key) + " sent " + str(_sent) + " messages")
+            self.report_file.write("Aircraft: " + str(key) + " sent " + str(_sent) + " messages"+ '\n')
+            #print("Aircraft: " + str(key) + " delivered " + str(_delivered) + " messages")
+            #print("Delivery rate: " + str( (_delivered / _sent) * 100 ) + " %")
+            self.report_file.write("Aircraft: " + str(key) + " delivered " + str(_delivered) + " messages"+ '\n')
+            self.report_file.write("Delivery rate: " + str( (_delivered / _sent) * 100 ) + " %" + '\n')
+
+        # One entry per distinct message id, as the id is the message key
+        reached = reached.groupby(aircrafts["id"], sort=False).last()
+        counts = reached.value_counts()
         reach = {}
         for i in range(0,self.number_of_towers+1):
-            reach[i] = 0
-        for message, delivery in messages.items():
-            reach[len(delivery)] +=1
+            reach[i] = int(counts.get(i, 0))
 
         self.report_file.write(str(reach)+ '\n')
         #print(reach)
 
+    def read_frame(self, file, columns=CSV_COLUMNS):
+        """ Loads a tower/uas CSV into a typed columnar frame """
+        frame = pd.read_csv(self.folder + file, sep=";", dtype=CSV_DTYPES, usecols=columns, header=0)
+        return frame
+
+    def concat_frames(self, frames, column):
+        """ Stacks per-file frames adding the file name as a categorical column """
+        if len(frames) == 0:
+            frame = pd.DataFrame({name: pd.Series(dtype=dtype) for name, dtype in CSV_DTYPES.items()})
+            frame[column] = pd.Categorical([])
+            return frame
+        frame = pd.concat(frames, names=[column, None]).reset_index(level=0)
+        frame[column] = pd.Categorical(frame[column], categories=list(frames.keys()))
+        if "aircraft" in frame:
+            frame["aircraft"] = frame["aircraft"].astype("category")
+        return frame.reset_index(drop=True)
+
     def open_files(self, files):
         print(files)
         for file in files:
-            if file[:5] == "tower":
-                tf = open(self.folder + file).readlines()
-                tf.pop(0)
-                self.tower_files[file.split(".")[0]] = tf
+            # History segments and other tower outputs share the folder
+            if not file.endswith(".csv"):
+                continue
+            if file.endswith(".trace.csv"):
+                self.trace_paths[file.split(".")[0]] = self.folder + file
+            elif file[:5] == "tower":
+                self.tower_paths[file.split(".")[0]] = self.folder + file
+                if arguments.stream:
+                    # Latency is streamed from disk, only ids are kept for delivery
+                    self.tower_files[file.split(".")[0]] = self.read_frame(file, ["id"])
+                else:
+                    self.tower_files[file.split(".")[0]] = self.read_frame(file)
                 #towers.append(self.folder + file)
             elif file[:3] == "uas":
-                tf = open(self.folder + file).readlines()
-                tf.pop(0)
-                self.aircraft_files[file.split(".")[0]] = tf
+                self.aircraft_files[file.split(".")[0]] = self.read_frame(file)
         #print(aircraft_files.keys())
+        self.towers = self.concat_frames(self.tower_files, "tower")
+        self.aircrafts = self.concat_frames(self.aircraft_files, "aircraft_file")
         self.number_of_towers = len(self.tower_files.keys())
         self.number_of_aircrafts = len(self.aircraft_files.keys())
         self.report_file.write("Number of towers: " + str(self.number_of_towers)+ '\n')
@@ -256,6 +455,9 @@ if __name__ == '__main__':  #for main run the main function. This is only run wh
     parser = argparse.ArgumentParser(description='Options as below')
     parser.add_argument("-d", "--delay", help="Delay between messages", type=float)
     parser.add_argument("-p", "--plot", help="Delay between messages", type=str)
+    parser.add_argument("-j", "--jobs", help="Worker processes used to parse archived runs", type=int, default=os.cpu_count())
+    parser.add_argument("-s", "--stream", help="Compute latency in bounded memory with streaming percentiles", action="store_true")
+    parser.add_argument("-c", "--chunksize", help="Rows per chunk read in --stream mode", type=int, default=1000000)
     arguments = parser.parse_args()
 
     for (dirpath, dirnames, filenames) in os.walk(folder):
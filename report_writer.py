@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+"""
+Background writer for the report csv files of the UAS clients and UTM servers
+Producers only queue records, formatting and file I/O happen on the writer thread so they stay off the timing path.
+"""
+__author__ = "Bruno Chianca Ferreira"
+__license__ = "MIT"
+__version__ = "0.1"
+__maintainer__ = "Bruno Chianca Ferreira"
+__email__ = "brunobcf@gmail.com"
+
+import os
+import time
+import logging
+import threading
+from collections import deque
+
+CSV_HEADER = 'time;created;id;aircraft;position;vel;status\n'
+
+
+def format_csv(record):
+  """
+  Formats a report record as a csv line
+
+  Parameters
+  ----------
+  record (tuple) - (time, created, id, aircraft, position, vel, status)
+
+  Returns
+  --------
+  line (str) - time;created;id;aircraft;position;vel;status
+
+  """
+  return ';'.join([str(field) for field in record]) + '\n'
+
+
+class ReportWriter(threading.Thread):
+  """
+  Writes queued records to a file in batches
+
+  .. note::
+
+      write() appends to a deque, which is thread safe without a lock, and only wakes the writer once flush_rows
+      records are queued. The writer drains the queue every flush_interval seconds otherwise. Each batch is
+      written and flushed to the OS, and fsync'ed when fsync is set.
+      When the writer falls behind and max_rows records are queued, write() drops the record ('drop') or waits
+      for the next batch to be written ('wait'), so memory never grows beyond that. Records written after stop()
+      are dropped and counted apart.
+
+  """
+  def __init__(self, path, header=CSV_HEADER, formatter=format_csv, flush_interval=1.0, flush_rows=1024, fsync=False, max_rows=65536, overflow='drop'):
+    """ReportWriter
+
+    Args:
+        path (str) - File to write, truncated when opened
+
+    Kwargs:
+        header (str) - Written first, None for no header
+        formatter (function) - Turns a record into a line
+        flush_interval (float) - Longest time in seconds a record waits in the queue
+        flush_rows (int) - Queued records that wake the writer before flush_interval
+        fsync (bool) - fsync the file after each batch
+        max_rows (int) - Queued records before overflow applies
+        overflow (str) - 'drop' the record, or 'wait' for the writer, when max_rows records are queued
+
+    """
+    threading.Thread.__init__(self, daemon=True)
+    self.path = path
+    self.formatter = formatter
+    self.flush_interval = flush_interval
+    self.flush_rows = flush_rows
+    self.fsync = fsync
+    self.max_rows = max_rows
+    self.overflow = overflow
+    self.running = True
+    self.queue = deque()
+    self.wakeup = threading.Event()
+    self.drained = threading.Event()
+    self.report_file = open(path, 'w')
+    if header is not None:
+      self.report_file.write(header)
+    self.written = 0
+    self.dropped = 0
+    self.late = 0
+    self.waits = 0
+    self.batches = 0
+    self.max_backlog = 0
+    self.write_time = 0.0
+    self.max_write_time = 0.0
+
+  def write(self, record):
+    """
+    Queues a record
+
+    Parameters
+    ----------
+    record (tuple) - Record handed to the formatter
+
+    Returns
+    --------
+
+    """
+    if not self.running:
+      self.late += 1
+      return
+    if len(self.queue) >= self.max_rows:
+      if self.overflow == 'drop':
+        self.dropped += 1
+        return
+      self.waits += 1
+      while len(self.queue) >= self.max_rows and self.running:
+        self.drained.clear()
+        self.wakeup.set()
+        self.drained.wait(self.flush_interval)
+      if not self.running:
+        self.late += 1
+        return
+    self.queue.append(record)
+    if len(self.queue) >= self.flush_rows:
+      self.wakeup.set()
+
+  def write_now(self, record):
+    """
+    Formats and writes a record on the calling thread, without the queue. Used to compare with the background writer
+
+    Parameters
+    ----------
+    record (tuple) - Record handed to the formatter
+
+    Returns
+    --------
+
+    """
+    self.report_file.write(self.formatter(record))
+    if self.fsync:
+      self.report_file.flush()
+      os.fsync(self.report_file.fileno())
+    self.written += 1
+
+  def metrics(self):
+    """ Snapshot of the writer counters, write times in seconds. dropped by a full queue, late after stop() """
+    return {"written": self.written,
+            "dropped": self.dropped,
+            "late": self.late,
+            "waits": self.waits,
+            "backlog": len(self.queue),
+            "max_backlog": self.max_backlog,
+            "batches": self.batches,
+            "mean_write_time": self.write_time / self.batches if self.batches else 0.0,
+            "max_write_time": self.max_write_time,
+    }
+
+  def run(self):
+    """
+    Write loop
+
+    Parameters
+    ----------
+
+    Returns
+    --------
+
+    """
+    while self.running:
+      self.wakeup.wait(self.flush_interval)
+      self.wakeup.clear()
+      self.drain()
+
+  def drain(self):
+    """
+    Formats and writes every queued record
+
+    Parameters
+    ----------
+
+    Returns
+    --------
+
+    """
+    backlog = len(self.queue)
+    if backlog == 0:
+      return
+    if backlog > self.max_backlog:
+      self.max_backlog = backlog
+    start = time.perf_counter()
+    lines = []
+    try:
+      while True:
+        lines.append(self.formatter(self.queue.popleft()))
+    except IndexError:
+      pass
+    try:
+      self.report_file.write(''.join(lines))
+      self.report_file.flush()
+      if self.fsync:
+        os.fsync(self.report_file.fileno())
+    except:
+      logging.error("ReportWriter>drain>Error writing " + str(len(lines)) + " records to " + self.path)
+    elapsed = time.perf_counter() - start
+    self.written += len(lines)
+    self.batches += 1
+    self.drained.set()
+    self.write_time += elapsed
+    if elapsed > self.max_write_time:
+      self.max_write_time = elapsed
+
+  def stop(self):
+    """
+    Stops the writer, writes what is queued and closes the file
+
+    Parameters
+    ----------
+
+    Returns
+    --------
+
+    """
+    self.running = False
+    self.wakeup.set()
+    if self.is_alive():
+      self.join()
+    self.drain()
+    if self.fsync:
+      os.fsync(self.report_file.fileno())
+    self.report_file.close()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+"""
+Periodic scheduler on the monotonic clock, for the broadcast loops of the UAS clients
+"""
+__author__ = "Bruno Chianca Ferreira"
+__license__ = "MIT"
+__version__ = "0.1"
+__maintainer__ = "Bruno Chianca Ferreira"
+__email__ = "brunobcf@gmail.com"
+
+import time
+import logging
+import threading
+from collections import deque
+
+SKIP = 'skip'
+CATCH_UP = 'catch-up'
+
+
+class PeriodicScheduler(threading.Thread):
+  """
+  Calls a function every interval seconds, on deadlines start + k * interval so errors do not accumulate
+
+  .. note::
+
+      The thread sleeps until spin seconds before the deadline and busy waits the rest, trading some CPU for
+      lower lateness. When a call overruns past later deadlines, policy 'skip' drops the missed ticks and
+      resumes on the next deadline, 'catch-up' runs them back to back, at most max_catch_up of them.
+      The lateness of each call (start - deadline) is recorded.
+
+  """
+  def __init__(self, function, interval, args=(), policy=SKIP, spin=0.0005, max_catch_up=10, history=10000, name=None):
+    """PeriodicScheduler
+
+    Args:
+        function (function) - Called every interval seconds
+        interval (float) - Period in seconds, fractions allowed
+
+    Kwargs:
+        args (tuple) - Arguments of function
+        policy (str) - 'skip' or 'catch-up', what to do with deadlines missed by an overrun
+        spin (float) - Seconds busy waited before each deadline, 0 to only sleep
+        max_catch_up (int) - Missed ticks run at most with 'catch-up', older ones are skipped
+        history (int) - Last lateness values kept for percentiles
+        name (str) - Thread name
+
+    """
+    threading.Thread.__init__(self, daemon=True, name=name)
+    if interval <= 0:
+      raise ValueError("Interval must be positive: " + str(interval))
+    if policy not in (SKIP, CATCH_UP):
+      raise ValueError("Unknown overrun policy: " + str(policy))
+    self.function = function
+    self.interval = interval
+    self.args = args
+    self.policy = policy
+    self.spin = spin
+    self.max_catch_up = max_catch_up
+    self.running = True
+    self.wakeup = threading.Event()
+    self.lateness = deque(maxlen=history)
+    self.ticks = 0
+    self.skipped = 0
+    self.errors = 0
+    self.total_lateness = 0.0
+    self.max_lateness = 0.0
+    self.first_tick = None
+    self.last_tick = None
+
+  def run(self):
+    """
+    Scheduling loop
+
+    Parameters
+    ----------
+
+    Returns
+    --------
+
+    """
+    start = time.monotonic()
+    tick = 1
+    while self.running:
+      deadline = start + tick * self.interval
+      now = time.monotonic()
+      if deadline - now > self.spin:
+        if self.wakeup.wait(deadline - now - self.spin):
+          break
+      while time.monotonic() < deadline:
+        pass
+      if not self.running:
+        break
+      began = time.monotonic()
+      self._record(began, began - deadline)
+      try:
+        self.function(*self.args)
+      except:
+        self.errors += 1
+        logging.exception("PeriodicScheduler>" + str(self.name) + ">Error in scheduled function")
+      tick += 1
+      missed = int((time.monotonic() - start) / self.interval) - tick + 1
+      if missed > 0:
+        if self.policy == SKIP:
+          self.skipped += missed
+          tick += missed
+        elif missed > self.max_catch_up:
+          self.skipped += missed - self.max_catch_up
+          tick += missed - self.max_catch_up
+
+  def _record(self, began, lateness):
+    self.lateness.append(lateness)
+    self.ticks += 1
+    self.total_lateness += lateness
+    if lateness > self.max_lateness:
+      self.max_lateness = lateness
+    if self.first_tick is None:
+      self.first_tick = began
+    self.last_tick = began
+
+  def metrics(self):
+    """
+    Snapshot of the scheduling counters
+
+    Parameters
+    ----------
+
+    Returns
+    --------
+    metrics (dict) - counters, achieved rate in Hz and lateness in seconds, percentiles over the last history ticks
+
+    """
+    lateness = sorted(self.lateness)
+    def percentile(p):
+      return lateness[min(len(lateness) - 1, int(p * len(lateness)))] if lateness else 0.0
+    rate = 0.0
+    if self.ticks > 1 and self.last_tick > self.first_tick:
+      rate = (self.ticks - 1) / (self.last_tick - self.first_tick)
+    return {"ticks": self.ticks,
+            "skipped": self.skipped,
+            "errors": self.errors,
+            "rate": rate,
+            "mean_lateness": self.total_lateness / self.ticks if self.ticks else 0.0,
+            "p50_lateness": percentile(0.5),
+            "p99_lateness": percentile(0.99),
+            "max_lateness": self.max_lateness,
+    }
+
+  def stop(self):
+    """ Stops the loop, waiting for a running call to end unless called from it """
+    self.running = False
+    self.wakeup.set()
+    if self.is_alive() and threading.current_thread() is not self:
+      self.join()
@@ -0,0 +1,423 @@
+#!/usr/bin/env python3
+
+"""
+Process wide metrics registry: counters, gauges and latency histograms, exposed over HTTP or in a snapshot file
+Disabled until enable() is called. Instruments requested while disabled are a shared no-op instrument, so an
+instrumented hot path costs a call that does nothing.
+"""
+__author__ = "Bruno Chianca Ferreira"
+__license__ = "MIT"
+__version__ = "0.1"
+__maintainer__ = "Bruno Chianca Ferreira"
+__email__ = "brunobcf@gmail.com"
+
+import os
+import json
+import time
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from scheduler import PeriodicScheduler
+
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+class Counter():
+  """
+  Monotonic count, e.g. packets received
+  """
+  __slots__ = ('name', 'help', 'value')
+  enabled = True
+  kind = 'counter'
+
+  def __init__(self, name, help=''):
+    self.name = name
+    self.help = help
+    self.value = 0
+
+  def inc(self, amount=1):
+    self.value += amount
+
+  def snapshot(self):
+    return self.value
+
+
+class Gauge():
+  """
+  Value that goes up and down, set by the code or read from function at snapshot time (e.g. a queue depth)
+  """
+  __slots__ = ('name', 'help', 'value', 'function')
+  enabled = True
+  kind = 'gauge'
+
+  def __init__(self, name, help='', function=None):
+    self.name = name
+    self.help = help
+    self.value = 0
+    self.function = function
+
+  def set(self, value):
+    self.value = value
+
+  def inc(self, amount=1):
+    self.value += amount
+
+  def dec(self, amount=1):
+    self.value -= amount
+
+  def snapshot(self):
+    if self.function is not None:
+      try:
+        return self.function()
+      except:
+        logging.error("Gauge>snapshot>Could not read " + self.name)
+        return None
+    return self.value
+
+
+class Histogram():
+  """
+  Latency histogram with log-linear buckets, as HdrHistogram
+
+  .. note::
+
+      Values are counted in units of resolution seconds. Below 2**precision units each unit has its bucket,
+      above, each power of two is split in 2**(precision - 1) buckets, so any recorded value is known within
+      1 / 2**(precision - 1) of its value (1.6% with the default precision of 7) for a fixed, small array of counts.
+      Values above max_value go to the last bucket, the exact max is kept apart.
+
+  """
+  enabled = True
+  kind = 'summary'
+
+  def __init__(self, name, help='', resolution=1e-6, max_value=3600.0, precision=7):
+    """Histogram
+
+    Args:
+        name (str) - Metric name
+
+    Kwargs:
+        help (str) - Description
+        resolution (float) - Smallest value told apart, in seconds
+        max_value (float) - Largest value told apart, in seconds
+        precision (int) - Bits of each bucket group, see the class note
+
+    """
+    self.name = name
+    self.help = help
+    self.resolution = resolution
+    self.scale = 1.0 / resolution
+    self.precision = precision
+    self.linear = 1 << precision
+    self.half = precision - 1
+    self.counts = [0] * (self._index(int(max_value * self.scale)) + 1)
+    self.last = len(self.counts) - 1
+    self.count = 0
+    self.sum = 0.0
+    self.max = 0.0
+
+  def _index(self, units):
+    if units < self.linear:
+      return units
+    shift = units.bit_length() - self.precision
+    return (shift << self.half) + (units >> shift)
+
+  def _bounds(self, index):
+    """ Lowest and highest units of a bucket """
+    if index < self.linear:
+      return index, index
+    shift = (index >> self.half) - 1
+    low = (index - (shift << self.half)) << shift
+    return low, low + (1 << shift) - 1
+
+  def observe(self, value):
+    """ Records a value in seconds """
+    units = int(value * self.scale)
+    if units < self.linear:
+      index = units if units > 0 else 0
+    else:
+      shift = units.bit_length() - self.precision
+      index = (shift << self.half) + (units >> shift)
+      if index > self.last:
+        index = self.last
+    self.counts[index] += 1
+    self.count += 1
+    self.sum += value
+    if value > self.max:
+      self.max = value
+
+  def start(self):
+    """ Start of a timed section, to hand to stop() """
+    return time.perf_counter()
+
+  def stop(self, start):
+    """ Records the time since start, returns the current perf_counter() so the next section can start from it """
+    now = time.perf_counter()
+    self.observe(now - start)
+    return now
+
+  def quantile(self, q):
+    """ Value at quantile q in seconds, middle of its bucket """
+    if self.count == 0:
+      return 0.0
+    rank = q * (self.count - 1)
+    seen = 0
+    for index, count in enumerate(self.counts):
+      seen += count
+      if seen > rank:
+        low, high = self._bounds(index)
+        return min((low + high) / 2 * self.resolution, self.max)
+    return self.max
+
+  def snapshot(self):
+    snapshot = {"count": self.count,
+                "sum": self.sum,
+                "mean": self.sum / self.count if self.count else 0.0,
+                "max": self.max,
+    }
+    for q in QUANTILES:
+      snapshot["p" + format(q * 100, "g").replace(".", "")] = self.quantile(q)
+    return snapshot
+
+
+class NullInstrument():
+  """
+  Instrument handed out while the registry is disabled, every method does nothing
+  """
+  __slots__ = ()
+  enabled = False
+
+  def inc(self, amount=1):
+    pass
+
+  def dec(self, amount=1):
+    pass
+
+  def set(self, value):
+    pass
+
+  def observe(self, value):
+    pass
+
+  def start(self):
+    return 0.0
+
+  def stop(self, start):
+    return 0.0
+
+NULL = NullInstrument()
+
+
+class Registry():
+  """
+  Instruments of a process by name, the same name gives the same instrument
+
+  .. note::
+
+      Instruments are not locked, updates from several threads rely on the GIL and may in rare cases lose an
+      increment, which is fine for monitoring. Components request their instruments when they are created, so
+      enable() must run before, e.g. first thing in main.
+
+  """
+  def __init__(self):
+    self.enabled = False
+    self.lock = threading.Lock()
+    self.instruments = {}
+
+  def _get(self, kind, name, *args, **kwargs):
+    if not self.enabled:
+      return NULL
+    with self.lock:
+      instrument = self.instruments.get(name)
+      if instrument is None:
+        instrument = self.instruments[name] = kind(name, *args, **kwargs)
+      elif not isinstance(instrument, kind):
+        raise ValueError("Metric " + name + " is already a " + instrument.kind)
+      return instrument
+
+  def counter(self, name, help=''):
+    return self._get(Counter, name, help)
+
+  def gauge(self, name, help='', function=None):
+    """ Gauge, a function given again replaces the previous one, the latest component owns the gauge """
+    gauge = self._get(Gauge, name, help)
+    if function is not None and gauge.enabled:
+      gauge.function = function
+    return gauge
+
+  def histogram(self, name, help='', **kwargs):
+    return self._get(Histogram, name, help, **kwargs)
+
+  def snapshot(self):
+    """
+    Current value of every instrument
+
+    Parameters
+    ----------
+
+    Returns
+    --------
+    snapshot (dict) - name -> value, histograms give a dict of count, sum, mean, max and quantiles in seconds
+
+    """
+    with self.lock:
+      instruments = list(self.instruments.values())
+    return {instrument.name: instrument.snapshot() for instrument in instruments}
+
+  def render(self):
+    """
+    Text exposition of every instrument, in the Prometheus text format
+
+    Parameters
+    ----------
+
+    Returns
+    --------
+    text (str) - One line per value
+
+    """
+    with self.lock:
+      instruments = sorted(self.instruments.values(), key=lambda instrument: instrument.name)
+    lines = []
+    for instrument in instruments:
+      if instrument.help:
+        lines.append("# HELP " + instrument.name + " " + instrument.help)
+      lines.append("# TYPE " + instrument.name + " " + instrument.kind)
+      value = instrument.snapshot()
+      if isinstance(instrument, Histogram):
+        for q in QUANTILES:
+          lines.append(instrument.name + '{quantile="' + format(q, "g") + '"} ' + repr(instrument.quantile(q)))
+        lines.append(instrument.name + "_sum " + repr(value["sum"]))
+        lines.append(instrument.name + "_count " + str(value["count"]))
+      else:
+        lines.append(instrument.name + " " + ("NaN" if value is None else repr(value)))
+    return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+
+def enable():
+  """ Enables the process registry, instruments requested from now on record """
+  REGISTRY.enabled = True
+
+def counter(name, help=''):
+  return REGISTRY.counter(name, help)
+
+def gauge(name, help='', function=None):
+  return REGISTRY.gauge(name, help, function)
+
+def histogram(name, help='', **kwargs):
+  return REGISTRY.histogram(name, help, **kwargs)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+  registry = REGISTRY
+
+  def do_GET(self):
+    if self.path == '/metrics':
+      body, content_type = self.registry.render().encode(), 'text/plain; version=0.0.4'
+    elif self.path == '/metrics.json':
+      body, content_type = json.dumps(self.registry.snapshot()).encode(), 'application/json'
+    else:
+      self.send_error(404)
+      return
+    self.send_response(200)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+
+class MetricsServer(threading.Thread):
+  """
+  HTTP endpoint of a registry, /metrics in text and /metrics.json
+  """
+  def __init__(self, port, interface='127.0.0.1', registry=REGISTRY):
+    """MetricsServer
+
+    Args:
+        port (int) - TCP port
+
+    Kwargs:
+        interface (str) - Address to bind, local only by default
+        registry (Registry) - Registry served
+
+    """
+    threading.Thread.__init__(self, daemon=True, name="metrics_server")
+    handler = type('Handler', (MetricsHandler,), {'registry': registry})
+    self.server = ThreadingHTTPServer((interface, port), handler)
+    self.server.daemon_threads = True
+
+  def run(self):
+    self.server.serve_forever()
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+
+class SnapshotWriter():
+  """
+  Writes the snapshot of a registry to a JSON file every interval seconds
+  The file is replaced atomically, readers never see a partial snapshot.
+  """
+  def __init__(self, path, interval=1.0, registry=REGISTRY):
+    """SnapshotWriter
+
+    Args:
+        path (str) - Snapshot file
+
+    Kwargs:
+        interval (float) - Seconds between snapshots
+        registry (Registry) - Registry written
+
+    """
+    self.path = path
+    self.registry = registry
+    self.scheduler = PeriodicScheduler(self.write, interval, spin=0.0, name="metrics_snapshot")
+
+  def start(self):
+    self.scheduler.start()
+
+  def write(self):
+    try:
+      with open(self.path + '.tmp', 'w') as snapshot:
+        json.dump({"time": time.time(), "metrics": self.registry.snapshot()}, snapshot)
+      os.replace(self.path + '.tmp', self.path)
+    except:
+      logging.error("SnapshotWriter>write>Could not write metrics to " + self.path)
+
+  def stop(self):
+    self.scheduler.stop()
+    self.write()
+
+
+def serve(port=None, path=None, interval=1.0):
+  """
+  Enables the registry and starts the configured exporters, nothing when neither port nor path is set
+
+  Parameters
+  ----------
+  port (int) - Port of the HTTP endpoint
+  path (str) - Snapshot file
+  interval (float) - Seconds between snapshots
+
+  Returns
+  --------
+  exporters (list) - Started MetricsServer/SnapshotWriter, to stop at the end of the session
+
+  """
+  exporters = []
+  if port is None and path is None:
+    return exporters
+  enable()
+  if port is not None:
+    exporters.append(MetricsServer(port))
+  if path is not None:
+    exporters.append(SnapshotWriter(path, interval))
+  for exporter in exporters:
+    exporter.start()
+  return exporters
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+"""
+Malformed UAS broadcasts must be rejected with ValueError, the UDP interfaces count those and drop them quietly
+"""
+__author__ = "Bruno Chianca Ferreira"
+__license__ = "MIT"
+__version__ = "0.1"
+__maintainer__ = "Bruno Chianca Ferreira"
+__email__ = "brunobcf@gmail.com"
+
+import os, sys, unittest
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import message_codec
+
+MESSAGE = [1792308081141350, 'uas1', [1.0, 2.0, 3.0], 4.0, 'OK']
+
+
+class DecodeTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        self.assertEqual(message_codec.decode(message_codec.encode(5, MESSAGE)), [hex(5), MESSAGE])
+        traced = MESSAGE + [1792308081141425]
+        self.assertEqual(message_codec.decode(message_codec.encode(5, traced)), [hex(5), traced])
+
+    def test_truncated(self):
+        for payload in (message_codec.HEADER, message_codec.encode(5, MESSAGE)[:-1], message_codec.encode(5, MESSAGE + [1])[:-1]):
+            with self.assertRaises(ValueError):
+                message_codec.decode(payload)
+
+    def test_unknown_status(self):
+        payload = bytearray(message_codec.encode(5, MESSAGE))
+        payload[message_codec.UAS_MESSAGE.size - 1] = 200
+        with self.assertRaises(ValueError):
+            message_codec.decode(bytes(payload))
+
+    def test_pickle_needs_legacy(self):
+        payload = message_codec.PickleCodec().encode([hex(5), MESSAGE])
+        with self.assertRaises(ValueError):
+            message_codec.decode(payload)
+        self.assertEqual(message_codec.decode(payload, legacy=True), [hex(5), MESSAGE])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+"""
+Per-hop trace of a UAS update, from the client send to the history of the towers watching it
+A trace is a list of wall clock timestamps in microseconds, one per stage of STAGES, 0 for stages not stamped yet.
+Wall clock so stamps of different hosts compare, their clocks must be synchronised (e.g. NTP/PTP).
+"""
+__author__ = "Bruno Chianca Ferreira"
+__license__ = "MIT"
+__version__ = "0.1"
+__maintainer__ = "Bruno Chianca Ferreira"
+__email__ = "brunobcf@gmail.com"
+
+import time
+
+# send: client hands the broadcast to the socket, on the wire in the traced message format
+# receive: tower socket returns the datagram
+# decode: tower handler gets the decoded message, stamped on handler entry
+# put: tower etcd writer serialises the update into a transaction, the etcd round trip is in the next stage
+# watch: a tower gets the update from its etcd watch
+# history: that tower appended the update to its history
+STAGES = ('send', 'receive', 'decode', 'put', 'watch', 'history')
+SEND, RECEIVE, DECODE, PUT, WATCH, HISTORY = range(len(STAGES))
+
+TRACE_HEADER = 'id;aircraft;created;' + ';'.join(STAGES) + '\n'
+
+
+def now():
+  """ Current wall clock time in microseconds """
+  return int(time.time()*1000000)
+
+
+def start(sent, received, decoded):
+  """
+  Trace of an update received by a tower, stamped up to decode
+
+  Parameters
+  ----------
+  sent (int) - Client send stamp carried by the message, microseconds
+  received (float) - Socket receive time, time.time()
+  decoded (int) - Handler entry stamp, now() taken before any processing of the message
+
+  Returns
+  --------
+  trace (list) - Timestamps per stage
+
+  """
+  trace = [0] * len(STAGES)
+  trace[SEND] = int(sent)
+  trace[RECEIVE] = int(received*1000000)
+  trace[DECODE] = decoded
+  return trace
+
+
+def format_csv(record):
+  """
+  Formats a trace record as a csv line
+
+  Parameters
+  ----------
+  record (tuple) - (id, aircraft, created, trace)
+
+  Returns
+  --------
+  line (str) - id;aircraft;created;send;receive;decode;put;watch;history
+
+  """
+  unique_id, aircraft, created, trace = record
+  return str(unique_id) + ';' + str(aircraft) + ';' + str(created) + ';' + ';'.join([str(stamp) for stamp in trace]) + '\n'
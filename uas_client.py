@@ -12,7 +12,6 @@ __email__ = "brunobcf@gmail.com"
 
 # Python stdlib
 import sys
-import pickle
 import argparse
 import logging
 import random
@@ -24,7 +23,13 @@ import tzlocal
 from apscheduler.schedulers.background import BackgroundScheduler
 # Local
 import network_sockets
+import async_sockets
+import message_codec
+import telemetry
+import tracing
 from gps_bridge import GPSBridge
+from report_writer import ReportWriter
+from scheduler import PeriodicScheduler
 
 
 class UASClient():
@@ -36,14 +41,23 @@ class UASClient():
       The position is pooled to a fake GPS that is actually a UNIX Socket created by the mobile ad hoc computing emulator
 
   """
-  def __init__(self, tag):
+  def __init__(self, tag, wire='binary', backend='threads', report='async', fsync=False, gps_mode='poll', interval=10.0, scheduler='periodic', policy='skip', trace=False):
     """UTM Client
 
     Args:
         tag (str) - A unique identifier for the aircraft
 
     Kwargs:
-        
+        wire (str) - Wire format of the broadcasts, 'binary' or the legacy 'pickle'
+        backend (str) - Socket backend, 'threads' (network_sockets) or 'asyncio' (async_sockets)
+        report (str) - 'async' to write the report from a background ReportWriter, 'sync' to write it on the broadcast thread
+        fsync (bool) - fsync the report after each batch written by the ReportWriter
+        gps_mode (str) - GPSBridge mode: 'poll' over one persistent connection, 'connect' per poll, 'subscribe' to cached updates
+                         or 'shm' to read the shared-memory position feed
+        interval (float) - Seconds between broadcasts, fractions allowed (e.g. 0.1 for 10 Hz)
+        scheduler (str) - 'periodic' for the monotonic PeriodicScheduler, 'apscheduler' for the previous APScheduler job
+        policy (str) - PeriodicScheduler overrun policy, 'skip' or 'catch-up'
+        trace (bool) - Add the send time to each broadcast, for the hop by hop traces of tracing.py
 
     """
     self.start = int(time.time())
@@ -51,9 +65,21 @@ class UASClient():
     time.sleep(breque) #waiting for routing to get stable
 
     self.tag = tag
+    self.wire = wire
+    self.backend = backend
+    self.report = report
+    self.fsync = fsync
+    self.gps_mode = gps_mode
+    self.interval = interval
+    self.scheduler_type = scheduler
+    self.policy = policy
+    self.trace = trace
     self.surface_position = []
     self.velocity = 0
     self.status = ""
+    self.broadcasts = telemetry.counter("uas_broadcasts", "Broadcasts sent by the UAS")
+    self.broadcast_errors = telemetry.counter("uas_broadcast_errors", "Broadcasts that could not be sent")
+    self.broadcast_time = telemetry.histogram("uas_broadcast_seconds", "Duration of a broadcast, GPS poll included")
 
     self._setup()
 
@@ -69,23 +95,51 @@ class UASClient():
     --------
 
     """
-    self.interval = 10
     self.timer = 120
     self.skip = False
     #print("uas_client> Current working directory: {0}".format(os.getcwd()))
-    self.report_file = open("/home/bruno/Documents/bruno-onera-enac-doctorate/software/utm/reports/" + self.tag + ".csv","w")
-    self.report_file.write('time;created;id;aircraft;position;vel;status\n')
-    self.scheduler = BackgroundScheduler(timezone=str(tzlocal.get_localzone()))
-    #logging.getLogger('apscheduler').setLevel(logging.ERROR)
-    logging.getLogger('apscheduler.executors.default').propagate = False
-    self.scheduler.start()
-    self.scheduler.add_job(self.adsb_broadcaster, 'interval', seconds = self.interval, id="adsb_broadcaster", args=[])
-    self.uas_interface = network_sockets.UdpInterface(self.uas_packet_handler, debug=False, port=44444, interface='')
+    self.report_writer = ReportWriter("/home/bruno/Documents/bruno-onera-enac-doctorate/software/utm/reports/" + self.tag + ".csv", fsync=self.fsync)
+    if self.report == 'async':
+      self.report_writer.start()
+    if self.scheduler_type == 'apscheduler':
+      self.scheduler = BackgroundScheduler(timezone=str(tzlocal.get_localzone()))
+      #logging.getLogger('apscheduler').setLevel(logging.ERROR)
+      logging.getLogger('apscheduler.executors.default').propagate = False
+      self.scheduler.start()
+      self.scheduler.add_job(self.adsb_broadcaster, 'interval', seconds = self.interval, id="adsb_broadcaster", args=[])
+    else:
+      self.scheduler = PeriodicScheduler(self.adsb_broadcaster, self.interval, policy=self.policy, name="adsb_broadcaster")
+    sockets = async_sockets if self.backend == 'asyncio' else network_sockets
+    codec = message_codec.UasStructCodec() if self.wire == 'binary' else message_codec.PickleCodec()
+    self.uas_interface = sockets.UdpInterface(self.uas_packet_handler, debug=False, port=44444, interface='', codec=codec, lazy_decode=True)
     self.uas_interface.start()
     self.set_status("OK")
     self.set_position([0,0,0])
     self.set_velocity = 0
-    self.gps = GPSBridge(self.tag)
+    self.gps = GPSBridge(self.tag, mode=self.gps_mode)
+    if self.scheduler_type != 'apscheduler':
+      self.scheduler.start()
+
+  def stop(self):
+    """ 
+    Stops broadcasting and closes the sockets, writing the report if the session did not end yet
+
+    Parameters
+    ----------
+
+    Returns
+    --------
+
+    """
+    if self.scheduler_type == 'apscheduler':
+      self.scheduler.shutdown(wait=False)
+    else:
+      self.scheduler.stop()
+    if not self.skip:
+      self.skip = True
+      self.report_writer.stop()
+    self.gps.stop()
+    self.uas_interface.stop()
 
   def set_position(self, pos):
     """ 
@@ -187,8 +241,8 @@ class UASClient():
     --------
 
     """
+    start = self.broadcast_time.start()
     position = self.gps.get_position()
-    position = pickle.loads(position)
 
     if position == [-1, -1, -1]:
       self.set_position([100,100,100])
@@ -202,10 +256,9 @@ class UASClient():
     velocity = self.get_velocity()
     status = self.get_status()
 
-    data = str(created) + ";" + str(hex(unique_id)) + ";" + str(identification) + ";" + str(position) + ";" + str(velocity) + ";" + str(status)
-
     self.broadcast(unique_id, [created, identification, position, velocity, status])
-    self.save_to_file(data)
+    self.save_to_file([created, hex(unique_id), identification, position, velocity, status])
+    self.broadcast_time.stop(start)
 
   def uas_packet_handler(self, payload, sender_ip, connection):
     """ 
@@ -213,7 +266,7 @@ class UASClient():
 
     Parameters
     ----------
-    payload (bin) - Pickled payload
+    payload (LazyMessage) - Received broadcast, decoded on first access
     sender_ip (str) - Sender's IP address 
     connection (socket) - Connection open socket
 
@@ -229,19 +282,25 @@ class UASClient():
 
     Parameters
     ----------
-    data (list) - List of CSV strings
+    data (list) - [created, id, aircraft, position, vel, status]
 
     Returns
     --------
     
     """   
     if not self.skip:
-      self.report_file.write(str(int(time.time()*1000000)) + ';' + data + '\n')
+      record = [int(time.time()*1000000)] + data
+      if self.report == 'async':
+        self.report_writer.write(record)
+      else:
+        self.report_writer.write_now(record)
     if int(time.time()) > self.start + self.timer:
       if not self.skip:
         logging.info("UTMClient>save_to_file>Emulation session ended. Saving to file")
-        self.report_file.flush()
-        self.report_file.close()
+        self.report_writer.stop()
+        logging.info("UTMClient>report writer: " + str(self.report_writer.metrics()))
+        if self.scheduler_type != 'apscheduler':
+          logging.info("UTMClient>scheduler: " + str(self.scheduler.metrics()))
         self.skip = True
 
   def broadcast(self, id, payload):
@@ -258,8 +317,12 @@ class UASClient():
 
     """
     try: 
+      if self.trace:
+        payload = payload + [tracing.now()]
       self.uas_interface.send('12.0.0.255', payload, id)
+      self.broadcasts.inc()
     except:
+      self.broadcast_errors.inc()
       logging.error("UTMClient>broadcast>Failed to broadcast data")
 
   def _create_id(self):
@@ -306,6 +369,17 @@ def parse_args():
   """
   parser = argparse.ArgumentParser(description='Some arguments are obligatory and must follow the correct order as indicated')
   parser.add_argument("-t", "--tag", help="Tag name", type=str)
+  parser.add_argument("-w", "--wire", help="Wire format of the broadcasts", choices=['binary', 'pickle'], default='binary')
+  parser.add_argument("-b", "--backend", help="Socket backend", choices=['threads', 'asyncio'], default='threads')
+  parser.add_argument("-r", "--report", help="Write the report from a background writer or on the broadcast thread", choices=['async', 'sync'], default='async')
+  parser.add_argument("-f", "--fsync", help="fsync the report after each batch", action="store_true")
+  parser.add_argument("-i", "--interval", help="Seconds between broadcasts, e.g. 0.1 for 10 Hz", type=float, default=10.0)
+  parser.add_argument("-S", "--scheduler", help="Broadcast scheduler", choices=['periodic', 'apscheduler'], default='periodic')
+  parser.add_argument("-p", "--policy", help="What the periodic scheduler does with ticks missed by an overrun", choices=['skip', 'catch-up'], default='skip')
+  parser.add_argument("-m", "--metrics-port", help="Serve metrics over HTTP on this local port", type=int, default=None)
+  parser.add_argument("-M", "--metrics-file", help="Write a metrics snapshot to this file every second", type=str, default=None)
+  parser.add_argument("-x", "--trace", help="Send the traced message format, with the send time for hop by hop traces", action="store_true")
+  parser.add_argument("-g", "--gps-mode", help="How the GPS socket is read", choices=['poll', 'connect', 'subscribe', 'shm'], default='poll')
   return parser.parse_args()
 
 def set_logging():
@@ -334,8 +408,15 @@ if __name__ == "__main__":
   if args.tag == None:
     logging.error("UTMClient>Missing tag name")
     sys.exit(1)
+  telemetry.serve(args.metrics_port, args.metrics_file)
+  client = None
   try:
-    UASClient(args.tag)
+    client = UASClient(args.tag, args.wire, args.backend, args.report, args.fsync, args.gps_mode, args.interval, args.scheduler, args.policy, args.trace)
+    # Every thread of the asyncio backend is a daemon, the main thread keeps the process alive
+    while True:
+      time.sleep(1)
   except KeyboardInterrupt:
     logging.info("UTMClient>Exiting UTM Client")
+    if client is not None:
+      client.stop()
   
\ No newline at end of file
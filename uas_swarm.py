@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+
+"""
+UAS swarm
+Emulates many UAS broadcasting to the UTM system from one process, sharing one scheduler, one socket and one report
+"""
+__author__ = "Bruno Chianca Ferreira"
+__license__ = "MIT"
+__version__ = "0.1"
+__maintainer__ = "Bruno Chianca Ferreira"
+__email__ = "brunobcf@gmail.com"
+
+# Python stdlib
+import os
+import sys
+import argparse
+import logging
+import random
+import zlib
+import time
+import numpy as np
+# Local
+import network_sockets
+import message_codec
+from gps_bridge import GPSBridge, NO_FIX
+from report_writer import ReportWriter
+from scheduler import PeriodicScheduler
+
+REPORT_DIR = "/home/bruno/Documents/bruno-onera-enac-doctorate/software/utm/reports/"
+
+class SwarmState():
+  """
+  State of every aircraft of a swarm, one array per attribute
+
+  .. note::
+
+      Positions are (n, 3) floats and statuses are message_codec.Status codes, so an aircraft costs a few
+      dozen bytes instead of a UASClient with its own threads and sockets.
+
+  """
+  def __init__(self, tags):
+    self.tags = list(tags)
+    self.position = np.zeros((len(self.tags), 3))
+    self.heading = np.zeros((len(self.tags), 3))
+    self.velocity = np.zeros(len(self.tags), dtype=np.float32)
+    self.status = np.full(len(self.tags), message_codec.Status.OK, dtype=np.uint8)
+    self.broadcasts = np.zeros(len(self.tags), dtype=np.int64)
+
+  def __len__(self):
+    return len(self.tags)
+
+  def fly_straight(self, seed=None, extent=10000.0, speed=15.0):
+    """
+    Gives every aircraft a random start and a constant velocity, for synthetic tracks
+
+    Parameters
+    ----------
+    seed (object) - Seed of the random generator, same seed same tracks
+    extent (float) - Start positions are within [0, extent] on x and y
+    speed (float) - Max speed on x and y in m/s
+
+    Returns
+    --------
+
+    """
+    generator = random.Random(seed)
+    for i in range(len(self.tags)):
+      self.position[i] = [generator.uniform(0, extent), generator.uniform(0, extent), generator.uniform(30, 120)]
+      self.heading[i] = [generator.uniform(-speed, speed), generator.uniform(-speed, speed), 0.0]
+    self.velocity[:] = np.hypot(self.heading[:, 0], self.heading[:, 1])
+
+
+class UASSwarm():
+  """
+  Runs n aircraft in one process
+
+  .. note::
+
+      One PeriodicScheduler ticks groups times per interval and each tick broadcasts one group of aircraft,
+      so broadcasts are staggered over the interval instead of going out as one burst. Positions come from
+      a GPSBridge per aircraft (gps_mode 'poll', 'subscribe' or 'shm'), or from a straight line
+      flight computed in process ('synthetic'), which needs no emulator.
+
+  """
+  def __init__(self, prefix, count, interval=1.0, groups=100, gps_mode='synthetic', wire='binary', destination='12.0.0.255', timer=120, warmup=0.0, report_dir=REPORT_DIR):
+    """UAS swarm
+
+    Args:
+        prefix (str) - Aircraft tags are prefix + index, the report is prefix.csv
+        count (int) - Number of aircraft
+
+    Kwargs:
+        interval (float) - Seconds between two broadcasts of an aircraft
+        groups (int) - Broadcast slots per interval, aircraft are spread over them
+        gps_mode (str) - 'synthetic', or a GPSBridge mode
+        wire (str) - Wire format of the broadcasts, 'binary' or the legacy 'pickle'
+        destination (str) - Broadcast address
+        timer (int) - For how long the session should run in seconds
+        warmup (float) - Seconds to wait before the first broadcast, e.g. for routing to get stable
+        report_dir (str) - Directory of the report
+
+    """
+    self.prefix = prefix
+    self.interval = interval
+    self.groups = max(1, min(groups, count))
+    self.gps_mode = gps_mode
+    self.wire = wire
+    self.destination = destination
+    self.timer = timer
+    self.report_dir = report_dir
+    self.state = SwarmState([prefix + str(i) for i in range(count)])
+    self.tick = 0
+    self.sent = 0
+    time.sleep(warmup)
+    self.start = time.time()
+    self._setup()
+
+  def _setup(self):
+    """
+    Runs initial setup
+
+    Parameters
+    ----------
+
+    Returns
+    --------
+
+    """
+    self.report_writer = ReportWriter(os.path.join(self.report_dir, self.prefix + ".csv"))
+    self.report_writer.start()
+    self.codec = message_codec.UasStructCodec() if self.wire == 'binary' else message_codec.PickleCodec()
+    self.uas_interface = network_sockets.UdpInterface(None, debug=False, port=44444, interface='', codec=self.codec)
+    self.gps = []
+    if self.gps_mode == 'synthetic':
+      self.state.fly_straight(self.prefix)
+    else:
+      self.gps = [GPSBridge(tag, mode=self.gps_mode) for tag in self.state.tags]
+    self.scheduler = PeriodicScheduler(self.broadcast_group, self.interval / self.groups, name="swarm_broadcaster")
+    self.scheduler.start()
+
+  def broadcast_group(self):
+    """
+    Broadcasts the aircraft of the next group
+    Scheduler callback, aircraft i is in group i % groups
+
+    Parameters
+    ----------
+
+    Returns
+    --------
+
+    """
+    group = self.tick % self.groups
+    self.tick += 1
+    state = self.state
+    members = range(group, len(state), self.groups)
+    if self.gps_mode == 'synthetic':
+      state.position[group::self.groups] += state.heading[group::self.groups] * self.interval
+    messages = []
+    for i in members:
+      if self.gps_mode != 'synthetic':
+        position = self.gps[i].get_position()
+        state.position[i] = [100, 100, 100] if position == NO_FIX else position[:3]
+      created = str(int(time.time()*1000000))
+      unique_id = zlib.crc32((created[:-3] + state.tags[i] + str(random.randint(0,10000))).encode())
+      position = state.position[i].tolist()
+      velocity = float(state.velocity[i])
+      status = message_codec.STATUS_NAMES[state.status[i]]
+      payload = [created, state.tags[i], position, velocity, status]
+      messages.append(message_codec.encode_message(self.codec, unique_id, payload))
+      state.broadcasts[i] += 1
+      self.report_writer.write([int(time.time()*1000000), created, hex(unique_id), state.tags[i], position, velocity, status])
+    self.sent += self.uas_interface.send_many(self.destination, messages)
+    if time.time() > self.start + self.timer:
+      self.stop()
+
+  def stop(self):
+    """
+    Ends the session, writing the report
+
+    Parameters
+    ----------
+
+    Returns
+    --------
+
+    """
+    if not self.scheduler.running:
+      return
+    self.scheduler.stop()
+    logging.info("UASSwarm>Emulation session ended. Saving to file")
+    self.report_writer.stop()
+    for gps in self.gps:
+      gps.stop()
+    logging.info("UASSwarm>sent " + str(self.sent) + ", scheduler: " + str(self.scheduler.metrics()))
+
+#######################Class END###############################################################################################
+
+def parse_args():
+  """
+  Method for parsing command line arguments
+
+  Parameters
+  ----------
+
+  Returns
+  --------
+  args - Arguments
+
+  """
+  parser = argparse.ArgumentParser(description='Some arguments are obligatory and must follow the correct order as indicated')
+  parser.add_argument("-t", "--tag", help="Tag prefix of the aircraft", type=str, default='uas')
+  parser.add_argument("-n", "--count", help="Number of aircraft", type=int, default=100)
+  parser.add_argument("-i", "--interval", help="Seconds between broadcasts of an aircraft", type=float, default=1.0)
+  parser.add_argument("-G", "--groups", help="Broadcast slots per interval", type=int, default=100)
+  parser.add_argument("-g", "--gps-mode", help="Where positions come from", choices=['synthetic', 'poll', 'subscribe', 'shm'], default='synthetic')
+  parser.add_argument("-w", "--wire", help="Wire format of the broadcasts", choices=['binary', 'pickle'], default='binary')
+  parser.add_argument("-d", "--destination", help="Broadcast address", type=str, default='12.0.0.255')
+  parser.add_argument("-T", "--timer", help="Session length in seconds", type=int, default=120)
+  parser.add_argument("-R", "--report-dir", help="Directory of the report", type=str, default=REPORT_DIR)
+  parser.add_argument("-W", "--warmup", help="Seconds to wait before broadcasting", type=float, default=30.0)
+  return parser.parse_args()
+
+def set_logging():
+  """
+  Method for setting the logging levels
+
+  Parameters
+  ----------
+
+  Returns
+  --------
+
+  """
+  logging.Formatter('%(asctime)s -> [%(levelname)s] %(message)s')
+  logger = logging.getLogger()
+  logger.setLevel(logging.INFO)
+  logging.basicConfig(level='INFO')
+
+###########################Runner ################################################################################################
+
+
+if __name__ == "__main__":
+  set_logging()
+  logging.info("Starting swarm")
+  args = parse_args()
+  swarm = None
+  try:
+    swarm = UASSwarm(args.tag, args.count, args.interval, args.groups, args.gps_mode, args.wire, args.destination, args.timer, args.warmup, args.report_dir)
+    while swarm.scheduler.running:
+      time.sleep(0.5)
+  except KeyboardInterrupt:
+    logging.info("UASSwarm>Exiting UAS swarm")
+    if swarm is not None:
+      swarm.stop()
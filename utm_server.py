@@ -10,6 +10,7 @@ __maintainer__ = "Bruno Chianca Ferreira"
 __email__ = "brunobcf@gmail.com"
 
 # Python stdlib
+import os
 from os import execl
 import sys
 import pickle
@@ -19,10 +20,20 @@ import argparse
 import threading
 import logging
 from collections import deque
-#etcd
-import etcd3
 #local
 import network_sockets
+import async_sockets
+import message_codec
+import telemetry
+import tracing
+from etcd_writer import EtcdWriter
+from airspace import AirspaceState
+from conflicts import ConflictDetector
+from history import HistoryLog
+from report_writer import ReportWriter
+from local_etcd import LocalEtcd
+
+REPORT_DIR = "/home/bruno/Documents/bruno-onera-enac-doctorate/software/utm/reports/"
 
 class UTMServer():
   """
@@ -33,25 +44,90 @@ class UTMServer():
       Each instance will be a separate thread with a open socket, thread runs in infinit loop and self.running must be set to False to end the thread.
 
   """
-  def __init__(self, tag, timer):
+  def __init__(self, tag, timer, backend='threads', flush_interval=0.01, batch_size=128, read_after_watch=False, cell_size=100.0, conflict_interval=1.0, history='segments', etcd=None, latency_history=100000, trace=False, legacy_pickle=False, report_dir=REPORT_DIR, queue_size=0, rcvbuf=None):
     """UTMServer UAS endpoint
 
     Args:
         tag (str) - A unique identifier for the UTM server
-        timer (int) - For how long the session should run in seconds
+        timer (int) - For how long the session should run in seconds, None to return once set up and end the session with stop()
 
     Kwargs:
-        
+        backend (str) - Socket backend, 'threads' (network_sockets) or 'asyncio' (async_sockets)
+        flush_interval (float) - Longest time in seconds an aircraft update waits before being written to etcd
+        batch_size (int) - Max aircraft updates per etcd transaction
+        read_after_watch (bool) - Read each watched key again from etcd instead of using the event value (previous behaviour, for comparison)
+        cell_size (float) - Grid cell size of the airspace state spatial index
+        conflict_interval (float) - Seconds between conflict detection ticks, 0 disables conflict detection
+        history (str) - 'segments' to keep the history in binary segments exported to csv at the end,
+                        'csv' to write the csv as the session runs with a ReportWriter
+        etcd (object) - etcd client, e.g. a local_etcd.LocalEtcd, etcd3.client() when not set
+        latency_history (int) - Last latencies kept for the percentiles of metrics()
+        trace (bool) - Carry the trace of traced broadcasts through etcd and write the traces seen on the watch to <tag>.trace.csv
+        legacy_pickle (bool) - Also accept pickled broadcasts from old clients, only on trusted networks: unpickling runs code chosen by the sender
+        report_dir (str) - Directory of the report, history and trace files
+        queue_size (int) - Threads backend: receive UAS broadcasts in batches and queue up to queue_size of them for the handler thread,
+                           so the socket is drained while the handler runs. 0 handles each datagram on the receive thread
+        rcvbuf (int) - SO_RCVBUF of the UAS endpoint in bytes, kernel default when not set
 
     """
     self.tag = tag
+    self.backend = backend
+    self.flush_interval = flush_interval
+    self.batch_size = batch_size
+    self.read_after_watch = read_after_watch
+    self.history_mode = history
+    self.trace = trace
+    self.legacy_pickle = legacy_pickle
+    self.report_dir = report_dir
+    self.queue_size = queue_size
+    self.rcvbuf = rcvbuf
+    self.revisions = {}
+    # The watch thread and the resync thread both call process_update
+    self.revisions_lock = threading.Lock()
+    self.running = True
+    self.resyncing = False
+    self.resync_lock = threading.Lock()
+    self.etcd = etcd
+    self.received = 0
+    self.watched = 0
+    self.receive_latency = deque(maxlen=latency_history)
+    self.watch_latency = deque(maxlen=latency_history)
+    self.watch_events = telemetry.counter("tower_watch_events", "etcd watch events processed by the tower")
+    self.get_time = telemetry.histogram("etcd_get_seconds", "Round trip of an etcd get")
     self.start = int(time.time())
     self.timer = timer
-    self.cache = deque([], maxlen=1000)
+    self.airspace = AirspaceState(cell_size)
+    self.conflicts = None
+    if conflict_interval > 0:
+      self.conflicts = ConflictDetector(interval=conflict_interval)
     self._setup()
+    if self.timer is None:
+      return
     while int(time.time()) < (self.start + self.timer):
       time.sleep(0.001)
+    self.stop()
+
+  def stop(self):
+    """ 
+    Ends the session, writing the history
+
+    Parameters
+    ----------
+
+    Returns
+    --------
+
+    """
     print("Session ended")
+    self.running = False
+    logging.info("UTMServer>tower: " + str(self.metrics()))
+    logging.info("UTMServer>airspace: " + str(self.airspace.metrics()))
+    if self.conflicts is not None:
+      self.conflicts.stop()
+      logging.info("UTMServer>conflicts: " + str(self.conflicts.metrics()))
+    if self.etcd_writer is not None:
+      self.etcd_writer.stop()
+      logging.info("UTMServer>etcd writer: " + str(self.etcd_writer.metrics()))
     self.save_to_file()
 
   def _setup(self):
@@ -65,71 +141,202 @@ class UTMServer():
     --------
 
     """
-    self.data_bank = []
-    self.report_file = open("/home/bruno/Documents/bruno-onera-enac-doctorate/software/utm/reports/" + self.tag + ".csv","w")
-    self.report_file.write('time;created;id;aircraft;position;vel;status\n')
-    self.utm_interface = network_sockets.TcpPersistent(self.utm_packet_handler, debug=False, port=55555, interface='')
-    self.uas_interface = network_sockets.UdpInterface(self.uas_packet_handler, debug=False, port=44444, interface='')
+    if self.history_mode == 'csv':
+      # Waits when full, as the HistoryLog of the segments mode
+      self.history = ReportWriter(os.path.join(self.report_dir, self.tag + ".csv"), overflow='wait')
+    else:
+      self.report_file = open(os.path.join(self.report_dir, self.tag + ".csv"), "w")
+      self.history = HistoryLog(os.path.join(self.report_dir, self.tag + ".history"))
+    self.history.start()
+    if self.trace:
+      self.trace_writer = ReportWriter(os.path.join(self.report_dir, self.tag + ".trace.csv"), header=tracing.TRACE_HEADER, formatter=tracing.format_csv)
+      self.trace_writer.start()
+    sockets = async_sockets if self.backend == 'asyncio' else network_sockets
+    self.utm_interface = sockets.TcpPersistent(self.utm_packet_handler, debug=False, port=55555, interface='', codec=message_codec.PickleCodec(), lazy_decode=True)
+    codec = message_codec.UasStructCodec(legacy=self.legacy_pickle)
+    if self.backend == 'asyncio':
+      # The event loop reads the socket as datagrams arrive, there is no receive queue
+      self.uas_interface = sockets.UdpInterface(self.uas_packet_handler, debug=False, port=44444, interface='', rcvbuf=self.rcvbuf, codec=codec, stamped=True)
+    else:
+      self.uas_interface = sockets.UdpInterface(self.uas_packet_handler, debug=False, port=44444, interface='', rcvbuf=self.rcvbuf, queue_size=self.queue_size, codec=codec, stamped=True)
     self.utm_interface.start()
     self.uas_interface.start()
+    if self.conflicts is not None:
+      self.conflicts.start()
+    self.etcd_writer = None
     try:
-      self.etcd = etcd3.client()
-      self.etcd.add_watch_callback('uas', self.etcd_callback, range_end='uas999')
+      if self.etcd is None:
+        # Only needed without an injected client, e.g. not for a local_etcd.LocalEtcd
+        import etcd3
+        self.etcd = etcd3.client()
+      self.etcd_writer = EtcdWriter(self.etcd, flush_interval=self.flush_interval, batch_size=self.batch_size, encoder=self.encode_update)
+      self.etcd_writer.start()
+      self.watch_id = self.etcd.add_watch_callback('uas', self.etcd_callback, range_end='uas999')
     except:
       logging.info("Running UTM server without etcd")
 
   def etcd_callback(self, _event):
     """ 
     Callback function called everytime etcd senses data change in configure key
+    The new value and revision come with the event, etcd is only read again after a compaction gap
+
+    Parameters
+    ----------
+    _event (list) - ETCD event list, or the exception raised by the watch (e.g. RevisionCompactedError)
+
+    Returns
+    --------
+
+    """
+    if isinstance(_event, Exception):
+      logging.error("UTMServer>etcd_callback>Watch error, resynchronising: " + str(_event))
+      self.start_resync()
+      return
+    for event in _event.events:
+      try:
+        self.watch_events.inc()
+        if self.read_after_watch:
+          start = self.get_time.start()
+          aircraft_data, metadata = self.etcd.get(event.key)
+          self.get_time.stop(start)
+          self.process_update(event.key.decode(), aircraft_data, metadata.mod_revision)
+        elif event.value:
+          self.process_update(event.key.decode(), event.value, event.mod_revision)
+      except:
+        logging.error("UTMServer>etcd_callback>Error getting data from ETCD")
+
+  def start_resync(self):
+    """ 
+    Runs resync_from_etcd on its own thread, unless a resync is already running.
+    The watch callback must return first: add_watch_callback waits for the watch creation, which the watch thread handles.
 
     Parameters
     ----------
-    _event (list) - ETCD event list
+
+    Returns
+    --------
+
+    """
+    with self.resync_lock:
+      if self.resyncing:
+        return
+      self.resyncing = True
+    threading.Thread(target=self.resync_from_etcd, daemon=True, name="etcd_resync").start()
+
+  def resync_from_etcd(self, backoff=0.1, max_backoff=5.0):
+    """ 
+    Watches again and reads every aircraft key once, processing values newer than the last revision seen.
+    Used when the watch missed events, e.g. after a compaction. Both steps are retried until they succeed or the session ends.
+
+    Parameters
+    ----------
+    backoff (float) - Seconds before the first retry, doubled on each failure
+    max_backoff (float) - Longest wait between retries
 
     Returns
     --------
 
     """
     try:
-      for event in _event.events:
-        aircraft_data, _ = self.etcd.get(event.key)
-        aircraft_data.decode()
+      try:
+        self.etcd.cancel_watch(self.watch_id)
+      except:
+        logging.error("UTMServer>resync_from_etcd>Could not cancel the previous watch")
+      delay = backoff
+      while self.running:
+        try:
+          self.watch_id = self.etcd.add_watch_callback('uas', self.etcd_callback, range_end='uas999')
+          break
+        except:
+          logging.error("UTMServer>resync_from_etcd>Could not watch ETCD again, retrying in " + str(delay) + " s")
+          time.sleep(delay)
+          delay = min(delay * 2, max_backoff)
+      delay = backoff
+      while self.running:
+        try:
+          start = self.get_time.start()
+          items = list(self.etcd.get_range('uas', 'uas999'))
+          self.get_time.stop(start)
+          for aircraft_data, metadata in items:
+            self.process_update(metadata.key.decode(), aircraft_data, metadata.mod_revision)
+          return
+        except:
+          logging.error("UTMServer>resync_from_etcd>Error getting data from ETCD, retrying in " + str(delay) + " s")
+          time.sleep(delay)
+          delay = min(delay * 2, max_backoff)
+    finally:
+      with self.resync_lock:
+        self.resyncing = False
+
+  def process_update(self, aircraft_id, aircraft_data, revision):
+    """ 
+    Saves a replicated aircraft update, unless an update with the same or a later revision was already seen
 
-        data = json.loads(aircraft_data)
+    Parameters
+    ----------
+    aircraft_id (str) - Aircraft id (etcd key)
+    aircraft_data (bytes) - JSON value written by a tower
+    revision (int) - etcd mod_revision of the value
 
-        unique_id = data['msg-id']
-        aircraft_id = event.key.decode()
-        position = data['position']
-        velocity = data['velocity']
-        status = data['status']
-        created = data['created']
+    Returns
+    --------
 
-        data = str(int(time.time()*1000000)) + ";" + str(created) + ";" + str(unique_id) + ";" + str(aircraft_id) + ";" + str(position)+ ";" + str(velocity)+ ";" + str(status)
+    """
+    with self.revisions_lock:
+      if revision <= self.revisions.get(aircraft_id, 0):
+        return
+      self.revisions[aircraft_id] = revision
+    watched = tracing.now()
 
-        self.save_historic(data)
-    except:
-      logging.error("UTMServer>etcd_callback>Error getting data from ETCD")
+    data = json.loads(aircraft_data)
+
+    unique_id = data['msg-id']
+    position = data['position']
+    velocity = data['velocity']
+    status = data['status']
+    created = data['created']
 
-  def save_historic(self, data):
+    self.watched += 1
+    self.watch_latency.append(time.time() - int(created) / 1000000)
+
+    self.airspace.update(aircraft_id, position, velocity, status, created, revision)
+    if self.conflicts is not None:
+      self.conflicts.update(aircraft_id, position, created)
+
+    self.save_historic(int(time.time()*1000000), created, unique_id, aircraft_id, position, velocity, status)
+
+    trace = data.get('trace')
+    if self.trace and trace is not None:
+      trace[tracing.WATCH] = watched
+      trace[tracing.HISTORY] = tracing.now()
+      self.trace_writer.write((unique_id, aircraft_id, created, trace))
+
+  def save_historic(self, current_time, created, unique_id, aircraft_id, position, velocity, status):
     """ 
     Save updated aircraft data in historic database
+    Rows are buffered in columns and flushed to the history segments in the background
 
     Parameters
     ----------
-    data (list) - aircraft data
-      current_time - Current time when saving
-      created_time - Time data was created
-      unique_id - Unique message id on creation
-      aircraft_id - Aircraft id
-      position - Current aircraft position
-      velocity - Current aircraft velocity
-      status - Current aircraft status
+    current_time (int) - Current time when saving
+    created (int) - Time data was created
+    unique_id (str) - Unique message id on creation
+    aircraft_id (str) - Aircraft id
+    position (list) - Current aircraft position
+    velocity (float) - Current aircraft velocity
+    status (str) - Current aircraft status
 
     Returns
     --------
 
     """    
-    self.data_bank.append(data)
+    try:
+      if self.history_mode == 'csv':
+        self.history.write((current_time, created, unique_id, aircraft_id, position, velocity, status))
+      else:
+        self.history.append(current_time, created, unique_id, aircraft_id, position, velocity, status)
+    except:
+      logging.error("UTMServer>save_historic>Invalid aircraft data: " + str(aircraft_id))
 
 
   def callback_thread(self, event):
@@ -149,13 +356,12 @@ class UTMServer():
     velocity = data['velocity']
     status = data['status']
     created = data['created']
-    data = str(int(time.time()*1000000)) + ";" + str(created) + ";" + str(unique_id) + ";" + str(aircraft_id) + ";" + str(position)+ ";" + str(velocity)+ ";" + str(status)
-    self.data_bank.append(data)
+    self.save_historic(int(time.time()*1000000), created, unique_id, aircraft_id, position, velocity, status)
 
 
   def save_to_file(self):
     """ 
-    Save databank to file
+    Save the history to file, in the report csv format
 
     Parameters
     ----------
@@ -164,9 +370,14 @@ class UTMServer():
     --------
     
     """
+    self.history.stop()
+    logging.info("UTMServer>history: " + str(self.history.metrics()))
+    if self.trace:
+      self.trace_writer.stop()
+    if self.history_mode == 'csv':
+      return
     try: 
-      for data in self.data_bank:
-        self.report_file.write(data + '\n')
+      self.history.export_csv(self.report_file)
     except:
       logging.error("UTMServer>save_to_file>Error saving databack to file")
 
@@ -181,7 +392,7 @@ class UTMServer():
 
     Parameters
     ----------
-    payload (bin) - Pickled payload
+    payload (LazyMessage) - Pickled payload, unpickled on first access
     sender_ip (str) - Sender's IP address 
     connection (socket) - Connection open socket
 
@@ -191,26 +402,25 @@ class UTMServer():
     """
     pass
 
-  def uas_packet_handler(self, payload, sender_ip, connection):
+  def uas_packet_handler(self, payload, sender_ip, connection, received_at):
     """ 
     UAS packet handler
     Called when data arrives on UAS endpoint
 
     Parameters
     ----------
-    payload (bin) - Pickled payload
+    payload (list) - Message decoded by the interface codec, [msg-id, [created, aircraft, position, velocity, status]]
     sender_ip (str) - Sender's IP address 
     connection (socket) - Connection open socket
+    received_at (float) - Receive time of the datagram, time.time()
 
     Returns
     --------
 
     """
-    try:
-      payload = pickle.loads(payload)
-    except:
-      logging.error("UTMServer>utm_packet_handler>Received invalid UDP packet")
-
+    if self.trace:
+      # Stamped before the airspace and conflict updates, which belong to the put stage
+      decoded = tracing.now()
     unique_id = payload[0]
 
     created = payload[1][0]
@@ -219,32 +429,90 @@ class UTMServer():
     velocity = payload[1][3]
     status = payload[1][4]
 
-    data = json.dumps({"created" : created,
-                       "msg-id" : unique_id,
-                       "position" : position,
-                       "velocity" : velocity,
-                       "status" : status,
-    })
+    self.received += 1
+    self.receive_latency.append(time.time() - int(created) / 1000000)
+
+    self.airspace.update(aircraft_id, position, velocity, status, created)
+    if self.conflicts is not None:
+      self.conflicts.update(aircraft_id, position, created)
+
+    data = {"created" : created,
+            "msg-id" : unique_id,
+            "position" : position,
+            "velocity" : velocity,
+            "status" : status,
+    }
+    if self.trace and len(payload[1]) > 5:
+      data["trace"] = tracing.start(payload[1][5], received_at, decoded)
 
     self.write_to_etcd(aircraft_id, data)
 
+  def encode_update(self, data):
+    """ 
+    Serialises an update when the etcd writer flushes it, stamping its trace
+
+    Parameters
+    ----------
+    data (dict) - Update built by uas_packet_handler
+
+    Returns
+    --------
+    value (str) - JSON value written to etcd
+
+    """
+    trace = data.get("trace")
+    if trace is not None:
+      trace[tracing.PUT] = tracing.now()
+    return json.dumps(data)
+
   def write_to_etcd(self, aircraft_id, data):
     """ 
     Write data to ETCD
+    Queued on the write-behind pipeline, only the latest data per aircraft within a flush window is written
 
     Parameters
     ----------
     aircraft_id (str) - unique aircraft ID
-    data (list) - data
+    data (dict) - Update, serialised by encode_update when flushed
 
     Returns
     --------
     
     """
-    try:
-      self.etcd.put(aircraft_id, data)
-    except:
-      pass
+    if self.etcd_writer is not None:
+      self.etcd_writer.put(aircraft_id, data)
+
+  def metrics(self, reset=False):
+    """ 
+    Snapshot of the tower counters
+    Receive latency is tower receive time minus created, watch latency is watch event time minus created
+
+    Parameters
+    ----------
+    reset (bool) - Start new latency windows after the snapshot, e.g. between the steps of a load test
+
+    Returns
+    --------
+    metrics (dict) - counters, latency percentiles in seconds over the last latency_history updates, etcd writer counters
+
+    """
+    receive_latency = sorted(self.receive_latency)
+    watch_latency = sorted(self.watch_latency)
+    if reset:
+      self.receive_latency.clear()
+      self.watch_latency.clear()
+    def percentile(latency, p):
+      return latency[min(len(latency) - 1, int(p * len(latency)))] if latency else 0.0
+    return {"received": self.received,
+            "watched": self.watched,
+            "p50_receive_latency": percentile(receive_latency, 0.5),
+            "p99_receive_latency": percentile(receive_latency, 0.99),
+            "max_receive_latency": receive_latency[-1] if receive_latency else 0.0,
+            "p50_watch_latency": percentile(watch_latency, 0.5),
+            "p99_watch_latency": percentile(watch_latency, 0.99),
+            "max_watch_latency": watch_latency[-1] if watch_latency else 0.0,
+            "etcd_writer": self.etcd_writer.metrics() if self.etcd_writer is not None else None,
+    }
 
 #######################Class END###############################################################################################
 
@@ -262,6 +530,22 @@ def parse_args():
   """
   parser = argparse.ArgumentParser(description='Some arguments are obligatory and must follow the correct order as indicated')
   parser.add_argument("-t", "--tag", help="Tag name", type=str)
+  parser.add_argument("-b", "--backend", help="Socket backend", choices=['threads', 'asyncio'], default='threads')
+  parser.add_argument("-f", "--flush-interval", help="Max seconds an update waits before being written to etcd", type=float, default=0.01)
+  parser.add_argument("-s", "--batch-size", help="Max updates per etcd transaction", type=int, default=128)
+  parser.add_argument("-r", "--read-after-watch", help="Read watched keys again from etcd (previous behaviour)", action="store_true")
+  parser.add_argument("-c", "--cell-size", help="Grid cell size of the airspace spatial index", type=float, default=100.0)
+  parser.add_argument("-H", "--history", help="Keep the history in binary segments or write the csv as the session runs", choices=['segments', 'csv'], default='segments')
+  parser.add_argument("-d", "--conflict-interval", help="Seconds between conflict detection ticks, 0 to disable", type=float, default=1.0)
+  parser.add_argument("-T", "--timer", help="Session length in seconds", type=int, default=120)
+  parser.add_argument("-m", "--metrics-port", help="Serve metrics over HTTP on this local port", type=int, default=None)
+  parser.add_argument("-M", "--metrics-file", help="Write a metrics snapshot to this file every second", type=str, default=None)
+  parser.add_argument("-x", "--trace", help="Trace traced broadcasts hop by hop into <tag>.trace.csv", action="store_true")
+  parser.add_argument("-P", "--legacy-pickle", help="Also accept pickled broadcasts from old clients, trusted networks only", action="store_true")
+  parser.add_argument("-R", "--report-dir", help="Directory of the report, history and trace files", type=str, default=REPORT_DIR)
+  parser.add_argument("-q", "--queue-size", help="Batches of UAS broadcasts queued for the handler thread, 0 to handle them on the receive thread (threads backend)", type=int, default=0)
+  parser.add_argument("-u", "--rcvbuf", help="SO_RCVBUF of the UAS endpoint in bytes", type=int, default=None)
+  parser.add_argument("-l", "--local-etcd", help="Use an in-process etcd stand-in with this RPC latency in seconds instead of etcd", type=float, default=None)
   return parser.parse_args()
 
 def set_logging():
@@ -287,10 +571,14 @@ if __name__ == '__main__':
   set_logging()
   logging.info("Starting UTM server")
   args = parse_args()
+  exporters = telemetry.serve(args.metrics_port, args.metrics_file)
   try:
-    UTMServer(args.tag, 120)
+    etcd = None if args.local_etcd is None else LocalEtcd(args.local_etcd)
+    UTMServer(args.tag, args.timer, args.backend, args.flush_interval, args.batch_size, args.read_after_watch, args.cell_size, args.conflict_interval, args.history, etcd, trace=args.trace, legacy_pickle=args.legacy_pickle, report_dir=args.report_dir, queue_size=args.queue_size, rcvbuf=args.rcvbuf)
   except KeyboardInterrupt:
     logging.info("Exiting UTM Server")
 
 
 
+  for exporter in exporters:
+    exporter.stop()